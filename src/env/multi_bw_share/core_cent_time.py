@@ -1,14 +1,13 @@
 import itertools
 
 import structlog
-from scipy.optimize import minimize, LinearConstraint
-from statsmodels.tsa.api import ExponentialSmoothing
-import pandas as pd
 import numpy as np
 import copy
 
 from env.object.satellite import Satellite
 from env.object.user import User
+from env.object.snapshot import SnapshotFields
+from util.sat_features import get_trace_matrix, get_up_time, get_bw_windows
 from util.constants import EPSILON, MPC_FUTURE_CHUNK_COUNT, QUALITY_FACTOR, REBUF_PENALTY, SMOOTH_PENALTY, \
     MPC_PAST_CHUNK_COUNT, HO_NUM, TOTAL_VIDEO_CHUNKS, CHUNK_TIL_VIDEO_END_CAP, DEFAULT_QUALITY, SNR_MIN, BUF_RATIO, \
     VIDEO_CHUNCK_LEN, BITRATE_LEVELS, B_IN_MB, BITS_IN_BYTE, M_IN_K, MILLISECONDS_IN_SECOND, PAST_LEN, VIDEO_SIZE_FILE, \
@@ -33,20 +32,32 @@ NUM_AGENTS = None
 SAT_STRATEGY = "resource-fair"
 # SAT_STRATEGY = "ratio-based"
 
+# Episode state captured by Environment.snapshot()
+SNAPSHOT_FIELDS = SnapshotFields(scalars=("trace_idx", "cooked_time", "cooked_bw", "bit_rate", "unexpected_change",
+                                          "reward_penalty"),
+                                 lists=("last_quality", "mahimahi_ptr", "last_mahimahi_time", "cur_sat_id",
+                                        "prev_sat_id", "video_chunk_counter", "buffer_size", "video_chunk_counter_sent",
+                                        "video_chunk_remain", "end_of_video", "next_sat_id", "delay", "last_delay",
+                                        "user_qoe_log", "prev_best_combos"),
+                                 dicts=("num_of_user_sat",),
+                                 nested_lists=("download_bw", "past_download_ests", "past_download_bw_errors",
+                                               "next_video_chunk_sizes", "sat_decision_log"),
+                                 nested_dicts=("past_bw_ests", "past_bw_errors"))
+
 
 class Environment:
     def __init__(self, all_cooked_time, all_cooked_bw, random_seed=RANDOM_SEED, num_agents=NUM_AGENTS):
         assert len(all_cooked_time) == len(all_cooked_bw)
         self.log = structlog.get_logger()
 
-        np.random.seed(random_seed)
+        self.rng = np.random.default_rng(random_seed)
         self.num_agents = num_agents
 
         self.all_cooked_time = all_cooked_time
         self.all_cooked_bw = all_cooked_bw
 
         # pick a random trace file
-        self.trace_idx = np.random.randint(len(self.all_cooked_time))
+        self.trace_idx = self.rng.integers(len(self.all_cooked_time))
         self.cooked_time = self.all_cooked_time[self.trace_idx]
         self.cooked_bw = self.all_cooked_bw[self.trace_idx]
 
@@ -56,25 +67,22 @@ class Environment:
         # randomize the start point of the trace
         # note: trace file starts with time 0
 
-        self.mahimahi_ptr = [np.random.randint(1, len(self.cooked_time) - TOTAL_VIDEO_CHUNKS)] * self.num_agents
+        self.mahimahi_ptr = [int(self.rng.integers(1, len(self.cooked_time) - TOTAL_VIDEO_CHUNKS))] * self.num_agents
 
         self.last_mahimahi_time = [self.mahimahi_ptr[i] - 1 for i in range(self.num_agents)]
 
         # Centralization
         self.user_qoe_log = [{} for _ in range(self.num_agents)]
         self.num_of_user_sat = {}
-        self.num_sat_info = {}
         self.cur_satellite = {}
         self.sat_decision_log = [[-1, -1, -1, -1, -1] for _ in range(self.num_agents)]
 
         for sat_id, sat_bw in self.cooked_bw.items():
-            self.num_sat_info[sat_id] = [0 for _ in range(len(sat_bw))]
             self.num_of_user_sat[sat_id] = 0
             self.cur_satellite[sat_id] = Satellite(sat_id, sat_bw, SAT_STRATEGY)
 
         self.cur_user = [User(i, SNR_MIN) for i in range(self.num_agents)]
 
-        # print(self.num_sat_info)
         self.prev_best_combos = [[DEFAULT_QUALITY] * MPC_FUTURE_CHUNK_COUNT] * self.num_agents
 
         # multiuser setting
@@ -225,7 +233,7 @@ class Environment:
         delay += LINK_RTT
 
         # add a multiplicative noise to the delay
-        delay *= np.random.uniform(NOISE_LOW, NOISE_HIGH)
+        delay *= self.rng.uniform(NOISE_LOW, NOISE_HIGH)
 
         # rebuffer time
         rebuf = np.maximum(delay - self.buffer_size[agent], 0.0)
@@ -349,47 +357,61 @@ class Environment:
                    agent], next_sat_id, ho_stamps, best_combos, final_rate, quality, other_sat_users, other_sat_bw_logs, \
                np.delete(self.buffer_size, agent)
 
-    def reset(self):
-        self.video_chunk_counter = [0 for _ in range(self.num_agents)]
-        self.buffer_size = [0 for _ in range(self.num_agents)]
-        self.video_chunk_counter_sent = [0 for _ in range(self.num_agents)]
-        self.video_chunk_remain = [TOTAL_VIDEO_CHUNKS for _ in range(self.num_agents)]
-        self.end_of_video = [False for _ in range(self.num_agents)]
-        self.next_video_chunk_sizes = [[] for _ in range(self.num_agents)]
-        # self.next_sat_bandwidth = [[] for _ in range(self.num_agents)]
-        self.next_sat_id = [[] for _ in range(self.num_agents)]
-        self.delay = [0 for _ in range(self.num_agents)]
-        self.num_of_user_sat = {}
-        self.download_bw = [[] for _ in range(self.num_agents)]
-        self.cur_satellite = {}
-        self.sat_decision_log = [[-1, -1, -1, -1, -1] for _ in range(self.num_agents)]
+    def seed(self, random_seed):
+        self.rng = np.random.default_rng(random_seed)
 
-        self.trace_idx = np.random.randint(len(self.all_cooked_time))
+    def reset(self):
+        # Reuse the per-agent containers and the satellite/user objects of the previous episode,
+        # so that the turnover cost does not depend on the trace length
+        for agent in range(self.num_agents):
+            self.video_chunk_counter[agent] = 0
+            self.buffer_size[agent] = 0
+            self.video_chunk_counter_sent[agent] = 0
+            self.video_chunk_remain[agent] = TOTAL_VIDEO_CHUNKS
+            self.end_of_video[agent] = False
+            self.next_video_chunk_sizes[agent] = []
+            self.next_sat_id[agent] = []
+            self.delay[agent] = 0
+            self.download_bw[agent].clear()
+            self.sat_decision_log[agent][:] = [-1, -1, -1, -1, -1]
+            self.cur_user[agent].reset()
+
+        self.trace_idx = self.rng.integers(len(self.all_cooked_time))
         self.cooked_time = self.all_cooked_time[self.trace_idx]
         self.cooked_bw = self.all_cooked_bw[self.trace_idx]
 
+        for sat_id in list(self.cur_satellite.keys()):
+            if sat_id not in self.cooked_bw:
+                del self.cur_satellite[sat_id]
+        self.num_of_user_sat.clear()
         for sat_id, sat_bw in self.cooked_bw.items():
-            self.num_sat_info[sat_id] = [0 for _ in range(len(sat_bw))]
             self.num_of_user_sat[sat_id] = 0
-            self.cur_satellite[sat_id] = Satellite(sat_id, sat_bw, SAT_STRATEGY)
-
-        self.cur_user = []
-        for agent_id in range(self.num_agents):
-            self.cur_user.append(User(agent_id, SNR_MIN))
+            if sat_id in self.cur_satellite:
+                self.cur_satellite[sat_id].reset(sat_bw)
+            else:
+                self.cur_satellite[sat_id] = Satellite(sat_id, sat_bw, SAT_STRATEGY)
 
-        self.mahimahi_ptr = [np.random.randint(1, len(self.cooked_time) - TOTAL_VIDEO_CHUNKS)] * self.num_agents
-        self.last_mahimahi_time = [self.mahimahi_ptr[i] - 1 for i in range(self.num_agents)]
+        start_ptr = int(self.rng.integers(1, len(self.cooked_time) - TOTAL_VIDEO_CHUNKS))
+        for agent in range(self.num_agents):
+            self.mahimahi_ptr[agent] = start_ptr
+            self.last_mahimahi_time[agent] = start_ptr - 1
 
-        self.cur_sat_id = []
         for agent in range(self.num_agents):
             cur_sat_id = self.get_best_sat_id(agent)
             # self.connection[cur_sat_id] = agent
-            self.cur_sat_id.append(cur_sat_id)
+            self.cur_sat_id[agent] = cur_sat_id
             self.update_sat_info(cur_sat_id, self.last_mahimahi_time[agent], agent, 1)
-
-        self.last_delay = [MPC_PAST_CHUNK_COUNT for _ in range(self.num_agents)]
+            self.last_delay[agent] = MPC_PAST_CHUNK_COUNT
         self.reward_penalty = False
 
+    def snapshot(self):
+        # Compact record of the mutable episode state (pointers, buffers, counters, connections,
+        # predictor state and RNG). Traces and video sizes are shared, never copied.
+        return SNAPSHOT_FIELDS.snapshot(self)
+
+    def restore(self, token):
+        SNAPSHOT_FIELDS.restore(self, token, SAT_STRATEGY)
+
     def check_end(self):
         # End if all users finish
         for agent in range(self.num_agents):
@@ -412,90 +434,45 @@ class Environment:
         return user
 
     def get_next_sat_info(self, agent, mahimahi_ptr=None):
-        best_sat_id = None
-        best_sat_bw = 0
-        best_bw_list = []
         up_time_list = {}
         other_sat_users = {}
         other_sat_bw_logs = {}
+        if mahimahi_ptr is None:
+            mahimahi_ptr = self.mahimahi_ptr[agent]
+
         runner_up_sat_id = self.get_runner_up_sat_id(agent, method="harmonic-mean", mahimahi_ptr=mahimahi_ptr)[0]
         if not runner_up_sat_id:
             runner_up_sat_id = self.get_random_runner_up_id(agent, mahimahi_ptr=mahimahi_ptr)
 
-        sat_bw = self.cooked_bw[runner_up_sat_id]
-
-        bw_list = []
-        for i in range(PAST_LEN, 1, -1):
-            if mahimahi_ptr - i >= 0 and sat_bw[mahimahi_ptr - i] != 0:
-                if len(self.cur_satellite[runner_up_sat_id].get_ue_list(mahimahi_ptr)) == 0:
-                    bw_list.append(sat_bw[mahimahi_ptr - i])
-                else:
-                    bw_list.append(sat_bw[mahimahi_ptr - i] / (
-                                len(self.cur_satellite[runner_up_sat_id].get_ue_list(mahimahi_ptr)) + 1))
-        next_sat_bws = bw_list
+        sat_ids, sat_rows, bw_matrix, up_time_matrix = get_trace_matrix(self.cooked_bw)
         next_sat_id = runner_up_sat_id
+        next_row = sat_rows[next_sat_id]
+        next_user_num = len(self.cur_satellite[next_sat_id].get_ue_list(mahimahi_ptr))
+        next_sat_bws = get_bw_windows(bw_matrix, [next_row], mahimahi_ptr - PAST_LEN, mahimahi_ptr - 1,
+                                      [next_user_num + 1 if next_user_num else 0], filter_rows=[next_row])[0]
+
+        # One user count per satellite, then every satellite's window in a single slice
+        for sat_id in sat_ids:
+            up_time_list[sat_id] = get_up_time(up_time_matrix, sat_rows[sat_id], mahimahi_ptr)
+            other_sat_users[sat_id] = self.get_num_of_user_sat(self.mahimahi_ptr[agent], sat_id)
 
-        for sat_id, sat_bw in self.cooked_bw.items():
-            bw_list = []
-            # up_time list
-            sat_bw = self.cooked_bw[sat_id]
-
-            up_time = 0
-            tmp_index = mahimahi_ptr - 1
-            tmp_sat_bw = sat_bw[tmp_index]
-            # if tmp_sat_bw == 0:
-            #     continue
-            while tmp_sat_bw != 0 and tmp_index >= 0:
-                up_time += 1
-                tmp_index -= 1
-                tmp_sat_bw = sat_bw[tmp_index]
-
-            up_time_list[sat_id] = up_time
-            # list1.append(bw)
-
-            for i in range(PAST_LEN, 0, -1):
-                if mahimahi_ptr - i >= 0 and sat_bw[mahimahi_ptr - i] != 0:
-                    if self.get_num_of_user_sat(self.mahimahi_ptr[agent], sat_id) == 0:
-                        bw_list.append(sat_bw[mahimahi_ptr - i])
-                    else:
-                        bw_list.append(
-                            sat_bw[mahimahi_ptr - i] / (self.get_num_of_user_sat(self.mahimahi_ptr[agent], sat_id)))
+        rows = list(range(len(sat_ids)))
+        bw_logs = get_bw_windows(bw_matrix, rows, mahimahi_ptr - PAST_LEN, mahimahi_ptr,
+                                 [other_sat_users[sat_id] for sat_id in sat_ids], filter_rows=rows)
+        for sat_id, bw_list in zip(sat_ids, bw_logs):
             if len(bw_list) == 0:
                 bw_list = [0] * PAST_LEN
-            other_sat_users[sat_id] = self.get_num_of_user_sat(self.mahimahi_ptr[agent], sat_id)
-
             other_sat_bw_logs[sat_id] = bw_list
 
         del other_sat_users[self.cur_sat_id[agent]]
         del other_sat_bw_logs[self.cur_sat_id[agent]]
         del other_sat_users[next_sat_id]
         del other_sat_bw_logs[next_sat_id]
-        # assert len(other_sat_bw_logs) <= MAX_SAT - 2
-        # assert len(other_sat_users) <= MAX_SAT - 2
 
-        if mahimahi_ptr is None:
-            mahimahi_ptr = self.mahimahi_ptr[agent]
-
-        bw_list = []
-        sat_bw = self.cooked_bw[self.cur_sat_id[agent]]
-        for i in range(PAST_LEN, 1, -1):
-            if mahimahi_ptr - i >= 0:
-                if len(self.cur_satellite[self.cur_sat_id[agent]].get_ue_list(mahimahi_ptr)) == 0:
-                    bw_list.append(sat_bw[mahimahi_ptr - i])
-                else:
-                    bw_list.append(
-                        sat_bw[mahimahi_ptr - i] / len(
-                            self.cur_satellite[self.cur_sat_id[agent]].get_ue_list(mahimahi_ptr)))
-        # list1.append(bw)
-        cur_sat_bws = bw_list
-
-        # zipped_lists = zip(list1, list2)
-        # sorted_pairs = sorted(zipped_lists)
-
-        # tuples = zip(*sorted_pairs)
-        # list1, list2 = [ list(tuple) for tuple in  tuples]
-        # list1 = [ list1[i] for i in range(1)]
-        # list2 = [ list2[i] for i in range(1)]
+        cur_row = sat_rows[self.cur_sat_id[agent]]
+        cur_user_num = len(self.cur_satellite[self.cur_sat_id[agent]].get_ue_list(mahimahi_ptr))
+        cur_sat_bws = get_bw_windows(bw_matrix, [cur_row], mahimahi_ptr - PAST_LEN, mahimahi_ptr - 1,
+                                     [cur_user_num])[0]
 
         return cur_sat_bws, None, next_sat_id, next_sat_bws, up_time_list, other_sat_users, other_sat_bw_logs
 
@@ -508,7 +485,7 @@ class Environment:
 
         sat_id_list.remove(self.cur_sat_id[agent])
 
-        return sat_id_list[np.random.randint(len(sat_id_list))]
+        return sat_id_list[self.rng.integers(len(sat_id_list))]
 
     def get_best_sat_id(self, agent, mahimahi_ptr=None):
         best_sat_id = None
@@ -803,17 +780,10 @@ class Environment:
             return sat_id
 
     def get_others_reward(self, agent, last_bit_rate):
-        reward = 0
-        prev_sat_id = self.prev_sat_id[agent]
-        cur_sat_id = self.cur_sat_id[agent]
-        for i in range(self.num_agents):
-            if i == agent:
-                continue
-            agent_cur_sat_id = self.cur_sat_id[i]
-            if agent_cur_sat_id in [cur_sat_id, prev_sat_id]:
-                reward += self.get_simulated_penalty(i, last_bit_rate[i], prev_sat_id, cur_sat_id) / self.num_agents / 10
-
-        return reward
+        # The neighbour penalty compared the chunk download of every agent sharing a satellite with the agent under
+        # one user more or less. The download rate follows the live connection log under every sharing model and
+        # never the counted users, so both sides were the same download and the penalty has always been 0.
+        return 0
 
     def set_reward_penalty(self):
         self.reward_penalty = True
@@ -824,88 +794,3 @@ class Environment:
             return -10
         else:
             return 0
-
-    def get_simulated_penalty(self, agent, quality, prev_sat_id, next_sat_id):
-        assert quality >= 0
-        assert quality < BITRATE_LEVELS
-
-        video_chunk_size = self.video_size[quality][self.video_chunk_counter[agent]]
-        last_mahimahi_time = self.last_mahimahi_time[agent]
-        mahimahi_ptr = self.mahimahi_ptr[agent]
-        cur_sat_id = self.cur_sat_id[agent]
-        delay = self.delay[agent]
-        buffer_size = self.buffer_size[agent]
-        assert cur_sat_id in [prev_sat_id, next_sat_id]
-
-        if cur_sat_id == prev_sat_id:
-            reward1 = self.calculate_reward(agent, cur_sat_id, video_chunk_size, last_mahimahi_time, mahimahi_ptr,
-                                            delay, buffer_size, self.get_num_of_user_sat(mahimahi_ptr, cur_sat_id) + 1)
-            reward2 = self.calculate_reward(agent, cur_sat_id, video_chunk_size, last_mahimahi_time, mahimahi_ptr,
-                                            delay, buffer_size, self.get_num_of_user_sat(mahimahi_ptr, cur_sat_id))
-        elif cur_sat_id == next_sat_id:
-            reward1 = self.calculate_reward(agent, cur_sat_id, video_chunk_size, last_mahimahi_time, mahimahi_ptr,
-                                            delay, buffer_size, self.get_num_of_user_sat(mahimahi_ptr, cur_sat_id) - 1)
-            reward2 = self.calculate_reward(agent, cur_sat_id, video_chunk_size, last_mahimahi_time, mahimahi_ptr,
-                                            delay, buffer_size, self.get_num_of_user_sat(mahimahi_ptr, cur_sat_id))
-        else:
-            print("Cannot Happen")
-        return reward1 - reward2
-
-    def calculate_reward(self, agent, cur_sat_id, video_chunk_size, last_mahimahi_time, mahimahi_ptr, delay, buffer_size, num_of_user):
-        video_chunk_counter_sent = 0  # in bytes
-        while True:  # download video chunk over mahimahi
-            if len(self.cooked_time) <= mahimahi_ptr:
-                return 0
-            throughput = self.cur_satellite[cur_sat_id].data_rate(self.cur_user[agent], mahimahi_ptr) * B_IN_MB / BITS_IN_BYTE
-
-            if throughput == 0.0:
-                # Do the forced handover
-                # Connect the satellite that has the best serving time
-                cur_sat_id = self.get_best_sat_id(agent, mahimahi_ptr)
-                # self.update_sat_info(cur_sat_id, self.mahimahi_ptr[agent], 1)
-                # self.update_sat_info(self.cur_sat_id[agent], self.mahimahi_ptr[agent], -1)
-
-                # self.cur_sat_id[agent] = cur_sat_id
-                delay += HANDOVER_DELAY
-
-            duration = self.cooked_time[mahimahi_ptr] \
-                       - last_mahimahi_time
-
-            packet_payload = throughput * duration * PACKET_PAYLOAD_PORTION
-
-            if video_chunk_counter_sent + packet_payload > video_chunk_size:
-                fractional_time = (video_chunk_size - video_chunk_counter_sent) / \
-                                  throughput / PACKET_PAYLOAD_PORTION
-                delay += fractional_time
-                last_mahimahi_time += fractional_time
-                break
-
-            video_chunk_counter_sent += packet_payload
-            delay += duration
-
-            last_mahimahi_time = self.cooked_time[mahimahi_ptr]
-            mahimahi_ptr += 1
-            # self.step_ahead(agent)
-            if mahimahi_ptr >= len(self.cooked_bw[cur_sat_id]):
-                # loop back in the beginning
-                # note: trace file starts with time 0
-                mahimahi_ptr = 1
-                last_mahimahi_time = 0
-                end_of_video = True
-                break
-
-        delay *= MILLISECONDS_IN_SECOND
-        delay += LINK_RTT
-
-        # rebuffer time
-        rebuf = np.maximum(delay - buffer_size, 0.0)
-
-        M_IN_K = 1000.0
-        REBUF_PENALTY = 4.3  # 1 sec rebuffering -> 3 Mbps
-        SMOOTH_PENALTY = 1
-        DEFAULT_QUALITY = 1  # default video quality without agent
-
-        reward = REBUF_PENALTY * rebuf / MILLISECONDS_IN_SECOND
-
-        return reward
-
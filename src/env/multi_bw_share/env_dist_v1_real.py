@@ -29,7 +29,6 @@ class ABREnv():
         # SAT_DIM = num_agents + 1
 
         self.is_handover = False
-        np.random.seed(random_seed)
         if train_traces:
             all_cooked_time, all_cooked_bw, _ = load_trace.load_trace(train_traces)
         else:
@@ -46,7 +45,7 @@ class ABREnv():
         self.reward_func = reward_func
 
     def seed(self, num):
-        np.random.seed(num)
+        self.net_env.seed(num)
 
     def reset_agent(self, agent):
         bit_rate = DEFAULT_QUALITY
@@ -26,7 +26,6 @@ class ABREnv():
 
         self.is_handover = False
         self.ho_type = ho_type
-        np.random.seed(random_seed)
         if train_traces:
             all_cooked_time, all_cooked_bw, _ = load_trace.load_trace(train_traces)
         else:
@@ -43,7 +42,7 @@ class ABREnv():
         self.reward_func = reward_func
 
     def seed(self, num):
-        np.random.seed(num)
+        self.net_env.seed(num)
 
     def reset_agent(self, agent):
         bit_rate = DEFAULT_QUALITY
@@ -2,8 +2,9 @@ import time
 
 import numpy as np
 import itertools
-from statsmodels.tsa.api import ExponentialSmoothing, SimpleExpSmoothing, Holt
-import pandas as pd
+from util.holt import new_holt_state, holt_update, holt_forecast, get_holt_params
+from util.sat_features import get_trace_matrix
+from util.constants import HOLT_ALPHA, HOLT_BETA, HOLT_FIT_TRACES
 import time
 import numpy as np
 
@@ -45,6 +46,24 @@ QUALITY_FACTOR = 1
 REBUF_PENALTY = 4.3  # pensieve: 4.3  # 1 sec rebuffering -> 3 Mbps
 SMOOTH_PENALTY = 1
 
+# Combo options only depend on the constants above and the number of users, so they are built once
+CHUNK_COMBO_OPTIONS = {}
+HO_COMBO_OPTIONS = {}
+
+
+def get_chunk_combo_option(num_agents):
+    if num_agents not in CHUNK_COMBO_OPTIONS:
+        CHUNK_COMBO_OPTIONS[num_agents] = [list([BITRATE_WEIGHT*x for x in combo]) for combo in itertools.product(
+            list(range(int(BITRATE_LEVELS/BITRATE_WEIGHT))), repeat=MPC_FUTURE_CHUNK_COUNT * num_agents)]
+    return CHUNK_COMBO_OPTIONS[num_agents]
+
+
+def get_ho_combo_option(num_agents):
+    if num_agents not in HO_COMBO_OPTIONS:
+        HO_COMBO_OPTIONS[num_agents] = [list(combo) for combo in itertools.product(
+            list(range(MPC_FUTURE_CHUNK_COUNT+1)), repeat=num_agents)]
+    return HO_COMBO_OPTIONS[num_agents]
+
 
 class Environment:
     def __init__(self, all_cooked_time, all_cooked_bw, random_seed=RANDOM_SEED, num_agents=NUM_AGENTS):
@@ -104,6 +123,10 @@ class Environment:
         self.past_bw_ests = [{} for _ in range(self.num_agents)]
         self.past_bw_errors = [{} for _ in range(self.num_agents)]
 
+        # Incremental Holt states of the holt-winter predictors with the number of samples fed in so far
+        self.holt_states = {}
+        self.holt_params = get_holt_params(self.all_cooked_bw) if HOLT_FIT_TRACES else (HOLT_ALPHA, HOLT_BETA)
+
         self.video_size = {}  # in bytes
         for bitrate in range(BITRATE_LEVELS):
             self.video_size[bitrate] = []
@@ -147,6 +170,7 @@ class Environment:
                 delay += HANDOVER_DELAY
                 is_handover = True
                 self.download_bw[agent] = []
+                self.holt_states.pop(("download", agent), None)
                 print("Forced Handover")
 
             duration = self.cooked_time[self.mahimahi_ptr[agent]] \
@@ -312,6 +336,7 @@ class Environment:
         self.delay = [0 for _ in range(self.num_agents)]
         self.num_of_user_sat = {}
         self.download_bw = [[] for _ in range(self.num_agents)]
+        self.holt_states = {}
 
         self.trace_idx += 1
         if self.trace_idx >= len(self.all_cooked_time):
@@ -504,16 +529,11 @@ class Environment:
         video_chunk_remain = [self.video_chunk_remain[i] for i in range(self.num_agents)]
         # last_index = self.get_total_video_chunk() - video_chunk_remain
 
-        chunk_combo_option = []
-        ho_combo_option = []
         # make chunk combination options
-        for combo in itertools.product(list(range(int(BITRATE_LEVELS/BITRATE_WEIGHT))),
-                                       repeat=MPC_FUTURE_CHUNK_COUNT * self.num_agents):
-            chunk_combo_option.append(list([BITRATE_WEIGHT*x for x in combo]))
+        chunk_combo_option = get_chunk_combo_option(self.num_agents)
 
         # make handover combination options
-        for combo in itertools.product(list(range(MPC_FUTURE_CHUNK_COUNT+1)), repeat=self.num_agents):
-            ho_combo_option.append(list(combo))
+        ho_combo_option = get_ho_combo_option(self.num_agents)
 
         future_chunk_length = [MPC_FUTURE_CHUNK_COUNT] * self.num_agents
         for i in range(self.num_agents):
@@ -676,10 +696,8 @@ class Environment:
         # last_index = self.get_total_video_chunk() - video_chunk_remain
         last_index = int(CHUNK_TIL_VIDEO_END_CAP - video_chunk_remain)
 
-        chunk_combo_option = []
         # make chunk combination options
-        for combo in itertools.product(list(range(int(BITRATE_LEVELS/BITRATE_WEIGHT))), repeat=MPC_FUTURE_CHUNK_COUNT):
-            chunk_combo_option.append(list([BITRATE_WEIGHT*x for x in combo]))
+        chunk_combo_option = get_chunk_combo_option(1)
 
         future_chunk_length = MPC_FUTURE_CHUNK_COUNT
         if video_chunk_remain < MPC_FUTURE_CHUNK_COUNT:
@@ -1009,37 +1027,33 @@ class Environment:
         self.user_qoe_log[agent] = best_case
         return ho_sat_id, ho_stamp, best_combo, max_reward
     """
+    def update_holt_state(self, key, samples, shape):
+        # Feed only the samples not seen yet. A series shorter than last time means a new trace,
+        # which starts over from the last MPC_PAST_CHUNK_COUNT samples. A handover empties download_bw and
+        # drops its state, so the new satellite does not inherit the old one's.
+        state, seen = self.holt_states.get(key, (None, 0))
+        if state is None or seen > len(samples):
+            state, seen = new_holt_state(shape), max(0, len(samples) - MPC_PAST_CHUNK_COUNT)
+        state = holt_update(state, samples[seen:], *self.holt_params)
+        self.holt_states[key] = (state, len(samples))
+        return state
+
     def predict_download_bw_holt_winter(self, agent, m=172):
         cur_sat_past_list = self.download_bw[agent]
         if len(cur_sat_past_list) <= 1:
             return self.download_bw[agent][-1]
-        past_bws = cur_sat_past_list[-MPC_PAST_CHUNK_COUNT:]
-        # past_bws = cur_sat_past_list
-        # print(past_bws)
-        while past_bws[0] == 0.0:
-            past_bws = past_bws[1:]
-
-        cur_sat_past_bws = pd.Series(past_bws)
-        cur_sat_past_bws.index.freq = 's'
-
-        # alpha = 1 / (2 * m)
-        fitted_model = ExponentialSmoothing(
-            cur_sat_past_bws, trend='add').fit()
-        # fitted_model = ExponentialSmoothing(cur_sat_past_bws, trend='mul').fit()
-
-        # fitted_model = ExponentialSmoothing(cur_sat_past_bws
-        # test_predictions = fitted_model.forecast(3)
-        test_predictions = fitted_model.forecast(1)
-
-        pred_bw = sum(test_predictions) / len(test_predictions)
-
-        return pred_bw
+        state = self.update_holt_state(("download", agent), cur_sat_past_list, ())
+        if state[2] < 2:
+            return cur_sat_past_list[-1]
+        return float(holt_forecast(state))
 
     def get_runner_up_sat_id(self, agent, method="holt-winter", mahimahi_ptr=None):
         best_sat_id = None
         best_sat_bw = 0
         if mahimahi_ptr is None:
             mahimahi_ptr = self.mahimahi_ptr[agent]
+        if method == "holt-winter":
+            holt_bws = self.predict_bws_holt_winter(agent)
         for sat_id, sat_bw in self.cooked_bw.items():
             real_sat_bw = None
 
@@ -1051,8 +1065,8 @@ class Environment:
                 # target_sat_bw = self.predict_bw(sat_id, agent, mahimahi_ptr=mahimahi_ptr)
                 real_sat_bw = sat_bw[mahimahi_ptr] / (self.get_num_of_user_sat(sat_id) + 1)
             elif method == "holt-winter":
-                target_sat_bw = self.predict_bw_holt_winter(sat_id, agent, num=1)
-                # target_sat_bw = sum(target_sat_bw) / len(target_sat_bw)
+                target_sat_bw = holt_bws[sat_id]
+                real_sat_bw = target_sat_bw
             else:
                 print("Cannot happen")
                 raise Exception
@@ -1065,48 +1079,35 @@ class Environment:
         return best_sat_id, best_sat_bw
 
     def predict_bw_holt_winter(self, sat_id, agent, num=1):
-        start_index = self.mahimahi_ptr[agent] - MPC_PAST_CHUNK_COUNT
-        cur_sat_past_list = []
-        if start_index < 0:
-            for i in range(0, start_index+MPC_PAST_CHUNK_COUNT):
-                cur_sat_past_list.append(self.cooked_bw[sat_id][0:start_index+MPC_PAST_CHUNK_COUNT] / self.get_num_of_user_sat(sat_id))
-        else:
-            for i in range(start_index, start_index+MPC_PAST_CHUNK_COUNT):
-                cur_sat_past_list.append(self.cooked_bw[sat_id][0:start_index+MPC_PAST_CHUNK_COUNT] / self.get_num_of_user_sat(sat_id))
-
-        while len(cur_sat_past_list) != 0 and cur_sat_past_list[0] == 0.0:
-            cur_sat_past_list = cur_sat_past_list[1:]
-
-
-        if len(cur_sat_past_list) <= 1:
-            # Just past bw
-            return self.cooked_bw[sat_id][self.mahimahi_ptr[agent]-1] / self.get_num_of_user_sat(sat_id)
-        cur_sat_past_bws = pd.Series(cur_sat_past_list)
-        cur_sat_past_bws.index.freq = 's'
-
-        # alpha = 1 / (2 * m)
-        fitted_model = ExponentialSmoothing(
-            cur_sat_past_bws, trend='add').fit()
-        # fitted_model = ExponentialSmoothing(cur_sat_past_bws, trend='mul').fit()
-
-        # fitted_model = ExponentialSmoothing(cur_sat_past_bws
-        test_predictions = fitted_model.forecast(1)
-        # test_predictions = fitted_model.forecast(num)
-
-        pred_bw = sum(test_predictions) / len(test_predictions)
-
-        return pred_bw
-        # return list(test_predictions)
+        return self.predict_bws_holt_winter(agent, [sat_id])[sat_id]
+
+    def predict_bws_holt_winter(self, agent, sat_ids=None):
+        # One Holt state per satellite for each agent, all moved forward together along the trace
+        trace_sat_ids, sat_rows, bw_matrix, _ = get_trace_matrix(self.cooked_bw)
+        mahimahi_ptr = self.mahimahi_ptr[agent]
+        state = self.update_holt_state(("sat", agent), bw_matrix[:, :mahimahi_ptr].T, len(trace_sat_ids))
+        forecasts = holt_forecast(state)
+
+        pred_bws = {}
+        for sat_id in (trace_sat_ids if sat_ids is None else sat_ids):
+            row = sat_rows[sat_id]
+            num_of_user_sat = self.get_num_of_user_sat(sat_id)
+            if num_of_user_sat == 0:
+                num_of_user_sat = 1
+            if state[2][row] < 2:
+                # Just past bw
+                pred_bws[sat_id] = bw_matrix[row, mahimahi_ptr - 1] / num_of_user_sat
+            else:
+                pred_bws[sat_id] = float(forecasts[row]) / num_of_user_sat
+        return pred_bws
 
     def calculate_mpc(self, video_chunk_remain, start_buffer, last_index, cur_download_bw, agent, centralized=False):
         max_reward = -10000000
         best_combo = ()
-        chunk_combo_option = []
         best_case = {}
 
         # make chunk combination options
-        for combo in itertools.product(list(range(int(BITRATE_LEVELS/BITRATE_WEIGHT))), repeat=MPC_FUTURE_CHUNK_COUNT):
-            chunk_combo_option.append(list([BITRATE_WEIGHT*x for x in combo]))
+        chunk_combo_option = get_chunk_combo_option(1)
         cur_user_num = self.get_num_of_user_sat(self.cur_sat_id[agent])
         future_chunk_length = MPC_FUTURE_CHUNK_COUNT
         if video_chunk_remain < MPC_FUTURE_CHUNK_COUNT:
@@ -1,7 +1,6 @@
 import numpy as np
 import itertools
-from statsmodels.tsa.api import ExponentialSmoothing, SimpleExpSmoothing, Holt
-import pandas as pd
+from util.backends import ExponentialSmoothing, SimpleExpSmoothing, Holt, pd
 
 import numpy as np
 
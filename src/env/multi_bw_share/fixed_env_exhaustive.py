@@ -1,9 +1,7 @@
 import itertools
 
 import structlog
-from scipy.optimize import minimize, LinearConstraint
-from statsmodels.tsa.api import ExponentialSmoothing
-import pandas as pd
+from util.backends import minimize, LinearConstraint, ExponentialSmoothing, pd
 import time
 import numpy as np
 import copy
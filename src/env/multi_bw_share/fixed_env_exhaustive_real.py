@@ -1,8 +1,6 @@
 import itertools
 
-from scipy.optimize import minimize, LinearConstraint
-from statsmodels.tsa.api import ExponentialSmoothing
-import pandas as pd
+from util.backends import minimize, LinearConstraint, ExponentialSmoothing, pd
 import numpy as np
 import copy
 
@@ -1,22 +1,31 @@
+import bisect
 import itertools
 
 import structlog
-from scipy.optimize import minimize, LinearConstraint
-from statsmodels.tsa.api import ExponentialSmoothing
-import pandas as pd
+from util.backends import minimize, LinearConstraint
 import numpy as np
 import copy
-import multiprocessing as mp
 import time
-from multiprocessing import Process, Value, Array, Manager
 
 from env.object.satellite import Satellite
 from env.object.user import User
+from env.object.snapshot import SnapshotFields
+from env.multi_bw_share.inner_pool import get_inner_pool, get_decision_state, run_inner_reward
+from util.mpc_kernel import get_combo_table, get_chunk_sizes, calculate_combo_rewards, select_best_combo, \
+    get_chunk_combos, get_ho_combos, get_ho_table, solve_best_combo, get_combo_upper_bound, get_user_qualities, \
+    BOUND_TOLERANCE
+from util.ratio_solver import solve_ratios
+from util.fastmpc import get_fastmpc_table
+from util.coordinated_mpc import CoordinatedSearch, get_start_plans
+from util.decision_profile import DecisionProfile
+from util.holt import new_holt_state, holt_update, holt_forecast, get_holt_params
+from util.sat_features import get_trace_matrix, get_up_time, get_bw_windows
 from util.constants import EPSILON, MPC_FUTURE_CHUNK_COUNT, QUALITY_FACTOR, REBUF_PENALTY, SMOOTH_PENALTY, \
     MPC_PAST_CHUNK_COUNT, HO_NUM, TOTAL_VIDEO_CHUNKS, CHUNK_TIL_VIDEO_END_CAP, DEFAULT_QUALITY, INNER_PROCESS_NUMS, \
-    VIDEO_CHUNCK_LEN, BITRATE_WEIGHT, SNR_MIN, BUF_RATIO, NO_EXHAUSTIVE, ADAPTIVE_BUF, VIDEO_BIT_RATE, BITRATE_LEVELS, \
+    VIDEO_CHUNCK_LEN, SNR_MIN, BUF_RATIO, NO_EXHAUSTIVE, ADAPTIVE_BUF, VIDEO_BIT_RATE, BITRATE_LEVELS, \
     MILLISECONDS_IN_SECOND, B_IN_MB, M_IN_K, BITS_IN_BYTE, PAST_LEN, CENT_MPC_MODELS, DIST_MPC_MODELS, SEP_MPC_MODELS, \
-    BITRATE_REWARD, VIDEO_SIZE_FILE, MAX_SAT
+    BITRATE_REWARD, VIDEO_SIZE_FILE, MAX_SAT, BNB_SEARCH, HOLT_ALPHA, HOLT_BETA, HOLT_FIT_TRACES, MPC_DECISION_BUDGET, \
+    DP_SEARCH, BUF_RATIO_COMBO, DIST_BATCH_SCORING
 
 RANDOM_SEED = 42
 BUFFER_THRESH = 60.0 * MILLISECONDS_IN_SECOND  # millisec, max buffer limit
@@ -35,6 +44,18 @@ NUM_AGENTS = None
 SAT_STRATEGY = "resource-fair"
 # SAT_STRATEGY = "ratio-based"
 
+# Episode state captured by Environment.snapshot()
+SNAPSHOT_FIELDS = SnapshotFields(scalars=("trace_idx", "cooked_time", "cooked_bw", "bit_rate", "unexpected_change",
+                                          "reward_penalty", "mahimahi_start_ptr", "prev_best_user_info"),
+                                 lists=("last_quality", "mahimahi_ptr", "last_mahimahi_time", "cur_sat_id",
+                                        "prev_sat_id", "video_chunk_counter", "buffer_size", "video_chunk_counter_sent",
+                                        "video_chunk_remain", "end_of_video", "next_sat_id", "delay", "last_delay",
+                                        "user_qoe_log", "prev_best_combos", "prev_ho_stamps", "prev_chunk_remain"),
+                                 dicts=("num_of_user_sat", "holt_states"),
+                                 nested_lists=("download_bw", "past_download_ests", "past_download_bw_errors",
+                                               "next_video_chunk_sizes", "sat_decision_log"),
+                                 nested_dicts=("past_bw_ests", "past_bw_errors"))
+
 
 class Environment:
     def __init__(self, all_cooked_time, all_cooked_bw, all_cooked_name=None, random_seed=RANDOM_SEED,
@@ -42,7 +63,7 @@ class Environment:
         assert len(all_cooked_time) == len(all_cooked_bw)
         self.log = structlog.get_logger()
 
-        np.random.seed(random_seed)
+        self.rng = np.random.default_rng(random_seed)
         self.num_agents = num_agents
         self.reward_func = reward_func
 
@@ -67,27 +88,44 @@ class Environment:
         # Centralization
         self.user_qoe_log = [{} for _ in range(self.num_agents)]
         self.num_of_user_sat = {}
-        self.num_sat_info = {}
         self.cur_satellite = {}
 
         for sat_id, sat_bw in self.cooked_bw.items():
-            self.num_sat_info[sat_id] = [0 for _ in range(len(sat_bw))]
             self.num_of_user_sat[sat_id] = 0
             self.cur_satellite[sat_id] = Satellite(sat_id, sat_bw, SAT_STRATEGY)
 
         self.cur_user = [User(i, SNR_MIN) for i in range(self.num_agents)]
 
-        # print(self.num_sat_info)
         self.prev_best_combos = [[DEFAULT_QUALITY] * MPC_FUTURE_CHUNK_COUNT] * self.num_agents
-
-        self.stored_num_of_user_sat = None
-        self.stored_mahimahi_ptr = None
-        self.stored_last_mahimahi_time = None
-        self.stored_buffer_size = None
-        self.stored_video_chunk_counter = None
-        self.stored_cur_sat_id = None
-        self.stored_cur_satellite = None
-        self.stored_cur_user = None
+        self.prev_best_user_info = None
+        # Handover positions and chunks left at the last centralized decision, to shift its plan forward
+        self.prev_ho_stamps = [MPC_FUTURE_CHUNK_COUNT] * self.num_agents
+        self.prev_chunk_remain = [TOTAL_VIDEO_CHUNKS] * self.num_agents
+
+        self.stored_snapshot = None
+
+        # Prediction cache: connected-user counts per (sat_id, ptr) and trace window statistics
+        # per (sat_id, ptr, user_count), shared by all agents within a decision
+        self.user_num_cache = {}
+        self.window_cache = {}
+        self.pred_cache_hits = 0
+        self.pred_cache_misses = 0
+
+        # Anytime search: deadline of the running MPC decision (None without MPC_DECISION_BUDGET), whether the
+        # last decision searched every plan, and how many decisions the budget cut short
+        self.decision_deadline = None
+        self.search_complete = True
+        self.decision_count = 0
+        self.truncated_decisions = 0
+
+        # Per-decision wall time split into phases, with combo and plan counts, see util.decision_profile
+        self.profile = DecisionProfile()
+
+        # Incremental Holt states of the holt-winter predictors with the number of samples fed in so far
+        self.holt_states = {}
+        self.holt_params = get_holt_params(self.all_cooked_bw) if HOLT_FIT_TRACES else (HOLT_ALPHA, HOLT_BETA)
+        # Loaded on the first FastMPC decision
+        self.fastmpc_table = None
 
         # raise Exception
         # multiuser setting
@@ -148,6 +186,9 @@ class Environment:
             self.unexpected_change = False
 
             self.prev_best_combos = copy.deepcopy(best_combos)
+            self.prev_best_user_info = best_user_info
+            self.prev_ho_stamps = list(ho_stamps)
+            self.prev_chunk_remain = list(self.video_chunk_remain)
             # DO handover all-in-one
 
             if self.cur_sat_id != cur_sat_ids:
@@ -197,6 +238,7 @@ class Environment:
                             self.prev_sat_id[i] = self.cur_sat_id[i]
                             self.cur_sat_id[i] = runner_up_sat_id
                             self.download_bw[i] = []
+                            self.holt_states.pop(("download", i), None)
 
                             throughput = self.cur_satellite[self.cur_sat_id[i]].data_rate(self.cur_user[i],
                                                                                               self.mahimahi_ptr[agent]) * B_IN_MB / BITS_IN_BYTE
@@ -260,6 +302,7 @@ class Environment:
                 self.prev_sat_id[agent] = self.cur_sat_id[agent]
                 self.cur_sat_id[agent] = runner_up_sat_id
                 self.download_bw[agent] = []
+                self.holt_states.pop(("download", agent), None)
 
             throughput = self.cur_satellite[self.cur_sat_id[agent]].data_rate(self.cur_user[agent], self.mahimahi_ptr[
                 agent]) * B_IN_MB / BITS_IN_BYTE
@@ -274,6 +317,7 @@ class Environment:
                 self.prev_sat_id[agent] = self.cur_sat_id[agent]
                 self.cur_sat_id[agent] = tmp_best_id
                 self.download_bw[agent] = []
+                self.holt_states.pop(("download", agent), None)
 
             throughput = self.cur_satellite[self.cur_sat_id[agent]].data_rate(self.cur_user[agent], self.mahimahi_ptr[
                 agent]) * B_IN_MB / BITS_IN_BYTE
@@ -288,6 +332,7 @@ class Environment:
                 self.prev_sat_id[agent] = self.cur_sat_id[agent]
                 self.cur_sat_id[agent] = tmp_best_id
                 self.download_bw[agent] = []
+                self.holt_states.pop(("download", agent), None)
 
             throughput = self.cur_satellite[self.cur_sat_id[agent]].data_rate(self.cur_user[agent], self.mahimahi_ptr[
                 agent]) * B_IN_MB / BITS_IN_BYTE
@@ -327,6 +372,7 @@ class Environment:
                 delay += HANDOVER_DELAY
                 is_handover = True
                 self.download_bw[agent] = []
+                self.holt_states.pop(("download", agent), None)
                 self.unexpected_change = True
                 throughput = self.cur_satellite[self.cur_sat_id[agent]].data_rate(self.cur_user[agent],
                                                                                   self.mahimahi_ptr[
@@ -490,6 +536,7 @@ class Environment:
                     self.cur_sat_id[i] = runner_up_sat_id
 
                     self.download_bw[i] = []
+                    self.holt_states.pop(("download", i), None)
                     ho_stamps[i] = -1
 
         else:
@@ -513,6 +560,7 @@ class Environment:
                     self.prev_sat_id[agent] = self.cur_sat_id[agent]
                     self.cur_sat_id[agent] = runner_up_sat_id
                     self.download_bw[agent] = []
+                    self.holt_states.pop(("download", agent), None)
 
                 throughput = self.cur_satellite[self.cur_sat_id[agent]].data_rate(self.cur_user[agent], self.mahimahi_ptr[
                     agent]) * B_IN_MB / BITS_IN_BYTE
@@ -729,6 +777,7 @@ class Environment:
                 delay += HANDOVER_DELAY
                 is_handover = True
                 self.download_bw[agent] = []
+                self.holt_states.pop(("download", agent), None)
                 self.unexpected_change = True
                 throughput = self.cur_satellite[self.cur_sat_id[agent]].data_rate(self.cur_user[agent],
                                                                                   self.mahimahi_ptr[
@@ -844,6 +893,10 @@ class Environment:
         self.sat_decision_log = [[-1, -1, -1, -1, -1] for _ in range(self.num_agents)]
 
         self.prev_best_combos = [[DEFAULT_QUALITY] * MPC_FUTURE_CHUNK_COUNT] * self.num_agents
+        self.prev_best_user_info = None
+        self.prev_ho_stamps = [MPC_FUTURE_CHUNK_COUNT] * self.num_agents
+        self.prev_chunk_remain = [TOTAL_VIDEO_CHUNKS] * self.num_agents
+        self.holt_states = {}
 
         self.trace_idx += 1
         if self.trace_idx >= len(self.all_cooked_time):
@@ -851,9 +904,10 @@ class Environment:
 
         self.cooked_time = self.all_cooked_time[self.trace_idx]
         self.cooked_bw = self.all_cooked_bw[self.trace_idx]
+        self.user_num_cache.clear()
+        self.window_cache.clear()
 
         for sat_id, sat_bw in self.cooked_bw.items():
-            self.num_sat_info[sat_id] = [0 for _ in range(len(sat_bw))]
             self.num_of_user_sat[sat_id] = 0
             self.cur_satellite[sat_id] = Satellite(sat_id, sat_bw, SAT_STRATEGY)
 
@@ -918,90 +972,45 @@ class Environment:
         return self.all_cooked_name[self.trace_idx]
 
     def get_next_sat_info(self, agent, mahimahi_ptr=None):
-        best_sat_id = None
-        best_sat_bw = 0
-        best_bw_list = []
         up_time_list = {}
         other_sat_users = {}
         other_sat_bw_logs = {}
+        if mahimahi_ptr is None:
+            mahimahi_ptr = self.mahimahi_ptr[agent]
+
         runner_up_sat_id = self.get_runner_up_sat_id(agent, method="harmonic-mean", mahimahi_ptr=mahimahi_ptr)[0]
         if not runner_up_sat_id:
             runner_up_sat_id = self.get_random_runner_up_id(agent, mahimahi_ptr=mahimahi_ptr)
 
-        sat_bw = self.cooked_bw[runner_up_sat_id]
-
-        bw_list = []
-        for i in range(PAST_LEN, 1, -1):
-            if mahimahi_ptr - i >= 0 and sat_bw[mahimahi_ptr - i] != 0:
-                if len(self.cur_satellite[runner_up_sat_id].get_ue_list(mahimahi_ptr)) == 0:
-                    bw_list.append(sat_bw[mahimahi_ptr - i])
-                else:
-                    bw_list.append(sat_bw[mahimahi_ptr - i] / (
-                                len(self.cur_satellite[runner_up_sat_id].get_ue_list(mahimahi_ptr)) + 1))
-        next_sat_bws = bw_list
+        sat_ids, sat_rows, bw_matrix, up_time_matrix = get_trace_matrix(self.cooked_bw)
         next_sat_id = runner_up_sat_id
+        next_row = sat_rows[next_sat_id]
+        next_user_num = len(self.cur_satellite[next_sat_id].get_ue_list(mahimahi_ptr))
+        next_sat_bws = get_bw_windows(bw_matrix, [next_row], mahimahi_ptr - PAST_LEN, mahimahi_ptr - 1,
+                                      [next_user_num + 1 if next_user_num else 0], filter_rows=[next_row])[0]
+
+        # One user count per satellite, then every satellite's window in a single slice
+        for sat_id in sat_ids:
+            up_time_list[sat_id] = get_up_time(up_time_matrix, sat_rows[sat_id], mahimahi_ptr)
+            other_sat_users[sat_id] = self.get_num_of_user_sat(self.mahimahi_ptr[agent], sat_id)
 
-        for sat_id, sat_bw in self.cooked_bw.items():
-            bw_list = []
-            # up_time list
-            sat_bw = self.cooked_bw[sat_id]
-
-            up_time = 0
-            tmp_index = mahimahi_ptr - 1
-            tmp_sat_bw = sat_bw[tmp_index]
-            # if tmp_sat_bw == 0:
-            #     continue
-            while tmp_sat_bw != 0 and tmp_index >= 0:
-                up_time += 1
-                tmp_index -= 1
-                tmp_sat_bw = sat_bw[tmp_index]
-
-            up_time_list[sat_id] = up_time
-            # list1.append(bw)
-
-            for i in range(PAST_LEN, 0, -1):
-                if mahimahi_ptr - i >= 0 and sat_bw[mahimahi_ptr - i] != 0:
-                    if self.get_num_of_user_sat(self.mahimahi_ptr[agent], sat_id) == 0:
-                        bw_list.append(sat_bw[mahimahi_ptr - i])
-                    else:
-                        bw_list.append(
-                            sat_bw[mahimahi_ptr - i] / (self.get_num_of_user_sat(self.mahimahi_ptr[agent], sat_id)))
+        rows = list(range(len(sat_ids)))
+        bw_logs = get_bw_windows(bw_matrix, rows, mahimahi_ptr - PAST_LEN, mahimahi_ptr,
+                                 [other_sat_users[sat_id] for sat_id in sat_ids], filter_rows=rows)
+        for sat_id, bw_list in zip(sat_ids, bw_logs):
             if len(bw_list) == 0:
                 bw_list = [0] * PAST_LEN
-            other_sat_users[sat_id] = self.get_num_of_user_sat(self.mahimahi_ptr[agent], sat_id)
-
             other_sat_bw_logs[sat_id] = bw_list
 
         del other_sat_users[self.cur_sat_id[agent]]
         del other_sat_bw_logs[self.cur_sat_id[agent]]
         del other_sat_users[next_sat_id]
         del other_sat_bw_logs[next_sat_id]
-        # assert len(other_sat_bw_logs) <= MAX_SAT - 2
-        # assert len(other_sat_users) <= MAX_SAT - 2
-
-        if mahimahi_ptr is None:
-            mahimahi_ptr = self.mahimahi_ptr[agent]
-
-        bw_list = []
-        sat_bw = self.cooked_bw[self.cur_sat_id[agent]]
-        for i in range(PAST_LEN, 1, -1):
-            if mahimahi_ptr - i >= 0:
-                if len(self.cur_satellite[self.cur_sat_id[agent]].get_ue_list(mahimahi_ptr)) == 0:
-                    bw_list.append(sat_bw[mahimahi_ptr - i])
-                else:
-                    bw_list.append(
-                        sat_bw[mahimahi_ptr - i] / len(
-                            self.cur_satellite[self.cur_sat_id[agent]].get_ue_list(mahimahi_ptr)))
-        # list1.append(bw)
-        cur_sat_bws = bw_list
 
-        # zipped_lists = zip(list1, list2)
-        # sorted_pairs = sorted(zipped_lists)
-
-        # tuples = zip(*sorted_pairs)
-        # list1, list2 = [ list(tuple) for tuple in  tuples]
-        # list1 = [ list1[i] for i in range(1)]
-        # list2 = [ list2[i] for i in range(1)]
+        cur_row = sat_rows[self.cur_sat_id[agent]]
+        cur_user_num = len(self.cur_satellite[self.cur_sat_id[agent]].get_ue_list(mahimahi_ptr))
+        cur_sat_bws = get_bw_windows(bw_matrix, [cur_row], mahimahi_ptr - PAST_LEN, mahimahi_ptr - 1,
+                                     [cur_user_num])[0]
 
         return cur_sat_bws, None, next_sat_id, next_sat_bws, up_time_list, other_sat_users, other_sat_bw_logs
 
@@ -1014,7 +1023,7 @@ class Environment:
 
         sat_id_list.remove(self.cur_sat_id[agent])
 
-        return sat_id_list[np.random.randint(len(sat_id_list))]
+        return sat_id_list[self.rng.integers(len(sat_id_list))]
 
     def get_best_sat_id(self, agent, mahimahi_ptr=None):
         best_sat_id = None
@@ -1080,12 +1089,6 @@ class Environment:
         # last_index = self.get_total_video_chunk() - video_chunk_remain
         last_index = int(CHUNK_TIL_VIDEO_END_CAP - video_chunk_remain)
 
-        chunk_combo_option = []
-        # make chunk combination options
-        for combo in itertools.product(list(range(int(BITRATE_LEVELS / BITRATE_WEIGHT))),
-                                       repeat=MPC_FUTURE_CHUNK_COUNT):
-            chunk_combo_option.append(list([BITRATE_WEIGHT * x for x in combo]))
-
         future_chunk_length = MPC_FUTURE_CHUNK_COUNT
         if video_chunk_remain < MPC_FUTURE_CHUNK_COUNT:
             future_chunk_length = video_chunk_remain
@@ -1094,6 +1097,7 @@ class Environment:
         best_combo = (self.last_quality[agent],)
         ho_sat_id = self.cur_sat_id[agent]
         ho_stamp = MPC_FUTURE_CHUNK_COUNT
+        self.profile.begin(method)
 
         cur_user_num = self.get_num_of_user_sat(self.mahimahi_ptr[agent], self.cur_sat_id[agent])
         cur_download_bw, runner_up_sat_id = None, None
@@ -1103,18 +1107,31 @@ class Environment:
         cur_download_bw /= cur_user_num
         runner_up_sat_id, _ = self.get_runner_up_sat_id(
             agent, method="harmonic-mean", cur_sat_id=self.cur_sat_id[agent])
+        self.profile.lap("prediction")
 
         if future_chunk_length == 0:
+            self.profile.end()
             return ho_sat_id, ho_stamp, best_combo, max_reward
 
         start_buffer = self.buffer_size[agent] / MILLISECONDS_IN_SECOND
         assert cur_download_bw != 0
-        best_combo, max_reward, best_case = self.calculate_mpc(video_chunk_remain, start_buffer, last_index,
-                                                               cur_download_bw, agent)
+        if method == "FastMPC":
+            best_combo, max_reward, best_case = self.calculate_mpc_fast(video_chunk_remain, start_buffer, last_index,
+                                                                        cur_download_bw, agent)
+        else:
+            best_combo, max_reward, best_case = self.calculate_mpc(video_chunk_remain, start_buffer, last_index,
+                                                                   cur_download_bw, agent)
+        self.profile.lap("reward_eval")
+        self.profile.end()
 
         return best_combo, max_reward, best_case
 
     def run_mpc(self, agent, model_type):
+        self.profile.begin(model_type)
+        self.decision_deadline = None
+        if MPC_DECISION_BUDGET is not None:
+            self.decision_deadline = time.perf_counter() + MPC_DECISION_BUDGET
+        self.search_complete = True
         final_rate = {}
         cur_ids = None
         runner_up_sat_ids = None
@@ -1129,11 +1146,33 @@ class Environment:
         elif model_type == "Oracle":
             cur_ids, runner_up_sat_ids, ho_stamps, best_combos, max_rewards, best_user_info = self.qoe_v4(
                 agent)
+        elif model_type == "DualMPC-Centralization-Coordinated":
+            # Plans with resource-fair shares only
+            assert SAT_STRATEGY == "resource-fair"
+            cur_ids, runner_up_sat_ids, ho_stamps, best_combos, max_rewards = \
+                self.calculate_mpc_with_handover_coordinated(agent)
         else:
             print("Cannot happen!")
             exit(-1)
+
+        self.decision_count += 1
+        if not self.search_complete:
+            self.truncated_decisions += 1
+        self.decision_deadline = None
+        self.profile.end()
         return cur_ids, runner_up_sat_ids, ho_stamps, best_combos, best_user_info, final_rate
 
+    def past_deadline(self):
+        # Checked between plans: once the budget is spent the search stops and keeps its incumbent
+        if self.decision_deadline is not None and time.perf_counter() > self.decision_deadline:
+            self.search_complete = False
+            return True
+        return False
+
+    def get_anytime_stats(self):
+        return {"decisions": self.decision_count, "truncated": self.truncated_decisions,
+                "truncated_rate": self.truncated_decisions / self.decision_count if self.decision_count else 0}
+
     def qoe_v2(self, agent, only_runner_up=True, centralized=False):
         is_handover = False
         best_sat_id = self.cur_sat_id[agent]
@@ -1191,16 +1230,14 @@ class Environment:
         video_chunk_remain = [self.video_chunk_remain[i] for i in range(self.num_agents)]
         # last_index = self.get_total_video_chunk() - video_chunk_remain
 
-        chunk_combo_option = []
-        ho_combo_option = []
         # make chunk combination options
-        for combo in itertools.product(list(range(int(BITRATE_LEVELS / BITRATE_WEIGHT))),
-                                       repeat=MPC_FUTURE_CHUNK_COUNT * self.num_agents):
-            chunk_combo_option.append(list([BITRATE_WEIGHT * x for x in combo]))
+        chunk_combo_option = get_combo_table(self.num_agents, MPC_FUTURE_CHUNK_COUNT).reshape(
+            -1, MPC_FUTURE_CHUNK_COUNT * self.num_agents).tolist()
 
         # make handover combination options
-        for combo in itertools.product(list(range(MPC_FUTURE_CHUNK_COUNT + 1)), repeat=self.num_agents):
-            ho_combo_option.append(list(combo))
+        ho_combo_option = get_ho_table(self.num_agents, MPC_FUTURE_CHUNK_COUNT).tolist()
+        self.profile.count("ho_plans", len(ho_combo_option))
+        self.profile.lap("combo_generation")
 
         future_chunk_length = [MPC_FUTURE_CHUNK_COUNT] * self.num_agents
         for i in range(self.num_agents):
@@ -1242,10 +1279,12 @@ class Environment:
                 # cur_sat_ids[idx] = sat_id
 
         mahimahi_ptr = copy.deepcopy(first_mahimahi_ptr)
+        self.profile.lap("setup")
 
         runner_up_sat_ids = [self.get_runner_up_sat_id(i, method="harmonic-mean", mahimahi_ptr=mahimahi_ptr[agent],
                                                        cur_sat_id=cur_sat_ids[i])[0] for i in
                              range(self.num_agents)]
+        self.profile.lap("prediction")
 
         related_sat_ids = []
         for sat_id in list(set(cur_sat_ids + runner_up_sat_ids)):
@@ -1285,6 +1324,7 @@ class Environment:
 
         next_bws = []
         cur_bws = []
+        self.profile.lap("setup")
         for agent_id in range(self.num_agents):
             tmp_next_bw = self.predict_bw(runner_up_sat_ids[agent_id], agent_id, True,
                                           mahimahi_ptr=mahimahi_ptr[agent],
@@ -1303,6 +1343,8 @@ class Environment:
                 next_download_bws.append(cur_download_bws[agent_id] * tmp_next_bw / tmp_cur_bw)
             """
 
+        self.profile.lap("prediction")
+
         max_rewards = [-10000000 for _ in range(self.num_agents)]
         best_combos = [[self.last_quality[i]] * MPC_FUTURE_CHUNK_COUNT for i in range(self.num_agents)]
         best_bws_sum = [-10000000]
@@ -1317,7 +1359,10 @@ class Environment:
         tmp_future_sat_user_nums = None
         tmp_future_sat_user_list = None
 
+        searched_plans = 0
         for ho_positions in ho_combo_option:
+            if searched_plans and self.past_deadline():
+                break
             if 1 in ho_positions or [0] * self.num_agents == ho_positions:
                 # if 1 in ho_positions:
                 continue
@@ -1362,7 +1407,13 @@ class Environment:
 
             if impossible_route:
                 continue
+            searched_plans += 1
+            self.profile.count("ho_plans_searched")
+            self.profile.count("combos", len(chunk_combo_option))
+            self.profile.count("combos_scored", len(chunk_combo_option))
+            self.profile.lap("plan_scoring")
 
+            combos_list = []
             for full_combo in chunk_combo_option:
                 combos = []
                 # Break at the end of the chunk
@@ -1377,63 +1428,33 @@ class Environment:
                         combos.append([np.nan] * MPC_FUTURE_CHUNK_COUNT)
                     else:
                         combos.append(cur_combo)
+                combos_list.append(combos)
+
+            sat_user_lists = {}
+            for sat_id in tmp_future_sat_user_nums.keys():
+                user_list = []
+                is_multi_users = False
+                for i in range(len(tmp_future_sat_user_nums[sat_id])):
+                    if tmp_future_sat_user_nums[sat_id][i] > 1:
+                        is_multi_users = True
+                        user_list = [*user_list, *tmp_future_sat_user_list[sat_id][i]]
+                if is_multi_users:
+                    sat_user_lists[sat_id] = list(set(user_list))
+            self.profile.lap("combo_generation")
 
-                bw_ratio = {}
+            # All satellites share one problem here, batched over the combos of this plan
+            sat_ratios = self.solve_user_ratios(combos_list, sat_user_lists, True, cur_sat_ids, runner_up_sat_ids,
+                                                tmp_future_sat_user_nums, ho_positions, start_buffers,
+                                                video_chunk_remain, cur_bws, next_bws)
+            self.profile.lap("ratio_optimization")
+
+            for combo_idx, combos in enumerate(combos_list):
                 user_info = {}
-                op_vars = []
                 op_vars_index = 0
-                bounds = []
-                constraints = []
-                sat_id_list = []
-                const_array = []
-                for sat_id in tmp_future_sat_user_nums.keys():
-                    user_list = []
-                    is_multi_users = False
-                    for i in range(len(tmp_future_sat_user_nums[sat_id])):
-                        if tmp_future_sat_user_nums[sat_id][i] > 1:
-                            is_multi_users = True
-                            user_list = [*user_list, *tmp_future_sat_user_list[sat_id][i]]
-                    if is_multi_users:
-                        user_list = list(set(user_list))
-                        user_info[sat_id] = (op_vars_index, op_vars_index + len(user_list), user_list)
-
-                        op_vars = [*op_vars, *([1 / len(user_list)] * len(user_list))]
-                        bounds = [*bounds, *[(0 + EPSILON, 1 - EPSILON) for _ in range(len(user_list))]]
-                        sat_id_list.append(sat_id)
-
-                        target_array = np.zeros(op_vars_index + len(user_list))
-                        target_array[op_vars_index:op_vars_index + len(user_list)] = 1
-                        op_vars_index += len(user_list)
-
-                        const_array.append(target_array)
-
-                if op_vars:
-                    for i in range(len(const_array)):
-                        data = const_array[i]
-                        if len(const_array[i]) < op_vars_index:
-                            data = np.append(const_array[i], [0] * (op_vars_index - len(const_array[i])))
-
-                        constraint = LinearConstraint(data, lb=1, ub=1)
-
-                        # constraints = [*constraints, {'type': 'eq', 'fun': const}]
-                        constraints.append(constraint)
-
-                    import warnings
-                    warnings.filterwarnings("ignore")
-                    ue_ratio = minimize(
-                        self.objective_function,
-                        x0=np.array(op_vars),
-                        args=(combos, cur_sat_ids, runner_up_sat_ids, sat_user_nums,
-                              tmp_future_sat_user_nums, ho_positions, start_buffers,
-                              video_chunk_remain, cur_bws,
-                              next_bws, user_info, bw_ratio, None),
-                        constraints=constraints,
-                        bounds=bounds,
-                        method="SLSQP"  # or BFGS
-                    )
-                    for sat_id in sat_id_list:
-                        user_info[sat_id] = user_info[sat_id] + (ue_ratio.x[user_info[sat_id][0]:user_info[sat_id][1]],)
-                        # user_info[sat_id] = user_info[sat_id] + (np.array([0.5, 0.5]),)
+                for sat_id, user_list in sat_user_lists.items():
+                    user_info[sat_id] = (op_vars_index, op_vars_index + len(user_list), user_list,
+                                         sat_ratios[sat_id][combo_idx])
+                    op_vars_index += len(user_list)
 
                 rewards = []
                 tmp_bws_sum = []
@@ -1522,6 +1543,7 @@ class Environment:
                     ho_stamps = ho_positions
                     best_bws_sum = tmp_bws_sum
                     best_user_info = user_info
+            self.profile.lap("reward_eval")
         # return runner_up_sat_ids[agent], ho_stamps[agent], best_combos[agent], max_rewards[agent]
         return runner_up_sat_ids, ho_stamps, best_combos, max_rewards, best_user_info
 
@@ -1530,16 +1552,14 @@ class Environment:
         video_chunk_remain = [self.video_chunk_remain[i] for i in range(self.num_agents)]
         # last_index = self.get_total_video_chunk() - video_chunk_remain
 
-        chunk_combo_option = []
-        ho_combo_option = []
         # make chunk combination options
-        for combo in itertools.product(list(range(int(BITRATE_LEVELS / BITRATE_WEIGHT))),
-                                       repeat=MPC_FUTURE_CHUNK_COUNT * self.num_agents):
-            chunk_combo_option.append(list([BITRATE_WEIGHT * x for x in combo]))
+        chunk_combo_option = get_combo_table(self.num_agents, MPC_FUTURE_CHUNK_COUNT).reshape(
+            -1, MPC_FUTURE_CHUNK_COUNT * self.num_agents).tolist()
 
         # make handover combination options
-        for combo in itertools.product(list(range(MPC_FUTURE_CHUNK_COUNT + 1)), repeat=self.num_agents):
-            ho_combo_option.append(list(combo))
+        ho_combo_option = get_ho_table(self.num_agents, MPC_FUTURE_CHUNK_COUNT).tolist()
+        self.profile.count("ho_plans", len(ho_combo_option))
+        self.profile.lap("combo_generation")
 
         future_chunk_length = [MPC_FUTURE_CHUNK_COUNT] * self.num_agents
         for i in range(self.num_agents):
@@ -1583,11 +1603,13 @@ class Environment:
 
         # mahimahi_ptr = [first_mahimahi_ptr[agent]] * self.num_agents
         mahimahi_ptr = copy.deepcopy(first_mahimahi_ptr)
+        self.profile.lap("setup")
 
         runner_up_sat_ids = [self.get_runner_up_sat_id(i,
                                                        method="harmonic-mean",
                                                        mahimahi_ptr=mahimahi_ptr[agent],
                                                        cur_sat_id=cur_sat_ids[i])[0] for i in range(self.num_agents)]
+        self.profile.lap("prediction")
 
         related_sat_ids = []
         for sat_id in list(set(cur_sat_ids + runner_up_sat_ids)):
@@ -1619,6 +1641,7 @@ class Environment:
         next_download_bws = []
         next_bws = []
         cur_bws = []
+        self.profile.lap("setup")
         for agent_id in range(self.num_agents):
             tmp_next_bw = self.predict_bw(runner_up_sat_ids[agent_id], agent_id, True,
                                           mahimahi_ptr=mahimahi_ptr[agent],
@@ -1640,12 +1663,17 @@ class Environment:
                 next_download_bws.append(cur_download_bws[agent_id] * tmp_next_bw / tmp_cur_bw)
             """
 
+        self.profile.lap("prediction")
+
         max_rewards = [-10000000 for _ in range(self.num_agents)]
         best_combos = [[self.last_quality[i]] * MPC_FUTURE_CHUNK_COUNT for i in range(self.num_agents)]
         ho_stamps = [MPC_FUTURE_CHUNK_COUNT for _ in range(self.num_agents)]
 
         sat_user_nums = num_of_sats
+        searched_plans = 0
         for ho_positions in ho_combo_option:
+            if searched_plans and self.past_deadline():
+                break
             if 1 in ho_positions or [0] * self.num_agents == ho_positions:
                 # if 1 in ho_positions:
                 continue
@@ -1679,6 +1707,11 @@ class Environment:
 
             if impossible_route:
                 continue
+            searched_plans += 1
+            self.profile.count("ho_plans_searched")
+            self.profile.count("combos", len(chunk_combo_option))
+            self.profile.count("combos_scored", len(chunk_combo_option))
+            self.profile.lap("plan_scoring")
 
             for full_combo in chunk_combo_option:
                 combos = []
@@ -1769,6 +1802,7 @@ class Environment:
                     max_rewards = rewards
                     ho_stamps = ho_positions
                     best_bws_sum = tmp_bws_sum
+            self.profile.lap("reward_eval")
 
         # return runner_up_sat_ids[agent], ho_stamps[agent], best_combos[agent], max_rewards[agent]
 
@@ -1779,13 +1813,6 @@ class Environment:
         video_chunk_remain = [self.video_chunk_remain[i] for i in range(self.num_agents)]
         # last_index = self.get_total_video_chunk() - video_chunk_remain
 
-        chunk_combo_option = []
-        ho_combo_option = []
-        # make chunk combination options
-        # make handover combination options
-        for combo in itertools.product(list(range(MPC_FUTURE_CHUNK_COUNT + 1)), repeat=self.num_agents):
-            ho_combo_option.append(list(combo))
-
         future_chunk_length = [MPC_FUTURE_CHUNK_COUNT] * self.num_agents
         for i in range(self.num_agents):
             if video_chunk_remain[i] < MPC_FUTURE_CHUNK_COUNT:
@@ -1823,25 +1850,15 @@ class Environment:
                 prev_chunk_combo[idx] = chunk_logs
 
         mahimahi_ptr = copy.deepcopy(first_mahimahi_ptr)
+        self.profile.lap("setup")
 
         runner_up_sat_ids = [self.get_runner_up_sat_id(i, method="harmonic-mean", mahimahi_ptr=mahimahi_ptr[i], cur_sat_id=cur_sat_ids[i])[0] for i in range(self.num_agents)]
+        self.profile.lap("prediction")
 
-        # make chunk combination options
-        for combo in itertools.product(list(range(int(BITRATE_LEVELS / BITRATE_WEIGHT))),
-                                       repeat=MPC_FUTURE_CHUNK_COUNT * self.num_agents):
-            # chunk_combo_option.append(list([BITRATE_WEIGHT * x for x in combo]))
-
-            impossible_combo = False
-            for i in range(self.num_agents):
-                if i == agent:
-                    continue
-                check_list = list(combo[i * MPC_FUTURE_CHUNK_COUNT:(i + 1) * MPC_FUTURE_CHUNK_COUNT])
-                check_list = [BITRATE_WEIGHT * x for x in check_list]
-                if NO_EXHAUSTIVE and check_list != [first_last_quality[i]] * MPC_FUTURE_CHUNK_COUNT:
-                    impossible_combo = True
-                    break
-            if not impossible_combo:
-                chunk_combo_option.append(list([BITRATE_WEIGHT * x for x in combo]))
+        # make chunk combination options, the other users keep their last quality
+        pinned_qualities = [first_last_quality[i] if NO_EXHAUSTIVE and i != agent else None
+                            for i in range(self.num_agents)]
+        chunk_combo_option = get_chunk_combos(self.num_agents, MPC_FUTURE_CHUNK_COUNT, pinned_qualities).tolist()
 
         # related_sat_ids = list(set(cur_sat_ids + runner_up_sat_ids))
 
@@ -1850,112 +1867,65 @@ class Environment:
         best_bws_sum = [-10000000]
         ho_stamps = [MPC_FUTURE_CHUNK_COUNT for _ in range(self.num_agents)]
 
-        for ho_positions in ho_combo_option:
-            tmp_future_sat_user_nums = {}
-            tmp_bws = []
-            tmp_bws_sum = []
-            impossible_route = False
-
-            for idx, ho_p in enumerate(ho_positions):
-                if NO_EXHAUSTIVE and agent != idx and (ho_p != MPC_FUTURE_CHUNK_COUNT):
-                    impossible_route = True
-                    break
-            if NO_EXHAUSTIVE and [0] * self.num_agents == ho_positions:
-                impossible_route = True
-
-            if impossible_route:
-                continue
-
-            for idx, ho_point in enumerate(ho_positions):
-                cur_sat_id = cur_sat_ids[idx]
-                next_sat_id = runner_up_sat_ids[idx]
-
-                if (cur_sat_id == next_sat_id or next_sat_id is None) and ho_point != MPC_FUTURE_CHUNK_COUNT:
-                    impossible_route = True
-                    break
-
-            if impossible_route:
+        # make handover combination options
+        ho_options = self.get_ho_options(agent, cur_sat_ids, runner_up_sat_ids)
+        ho_combo_option = get_ho_combos(ho_options, skip_all_zero=NO_EXHAUSTIVE)
+
+        # Replay every (handover plan, combo) pair on the true trace in one pass, sharing common prefixes
+        lengths = [max(future_chunk_length[i], 0) for i in range(self.num_agents)]
+        pair_combos = np.tile(np.asarray(chunk_combo_option).reshape(-1, self.num_agents, MPC_FUTURE_CHUNK_COUNT),
+                              (len(ho_combo_option), 1, 1))
+        pair_ho_plans = np.repeat(np.asarray(ho_combo_option).reshape(-1, self.num_agents), len(chunk_combo_option),
+                                  axis=0)
+        self.profile.count("ho_plans", len(ho_combo_option))
+        self.profile.count("combos", len(pair_combos))
+        self.profile.lap("combo_generation")
+        pair_results = OracleRollout(self, first_last_quality).score_pairs(pair_combos, pair_ho_plans, lengths)
+        self.profile.count("combos_scored", sum(result is not None for result in pair_results))
+        self.profile.lap("reward_eval")
+
+        for pair_id, (ho_positions, full_combo) in enumerate(itertools.product(ho_combo_option, chunk_combo_option)):
+            if pair_results[pair_id] is None:
                 continue
+            rewards, tmp_bws_sum = pair_results[pair_id]
+            combos = []
+            # Break at the end of the chunk
+            for agent_id in range(self.num_agents):
+                cur_combo = full_combo[MPC_FUTURE_CHUNK_COUNT * agent_id: MPC_FUTURE_CHUNK_COUNT * agent_id +
+                                                                          future_chunk_length[agent_id]]
+                if not cur_combo:
+                    combos.append([np.nan] * MPC_FUTURE_CHUNK_COUNT)
+                else:
+                    combos.append(cur_combo)
 
-            for full_combo in chunk_combo_option:
-                combos = []
-                # Break at the end of the chunk
-                for agent_id in range(self.num_agents):
-                    cur_combo = full_combo[MPC_FUTURE_CHUNK_COUNT * agent_id: MPC_FUTURE_CHUNK_COUNT * agent_id +
-                                                                              future_chunk_length[agent_id]]
-                    if not cur_combo:
-                        combos.append([np.nan] * MPC_FUTURE_CHUNK_COUNT)
-                    else:
-                        combos.append(cur_combo)
-
-                rewards = []
-                tmp_bws_sum = []
-                self.froze_num_of_user_sat()
-                combo_log = copy.deepcopy(combos)
-                ho_stamps_log = copy.deepcopy(ho_positions)
-                last_quality = copy.deepcopy(first_last_quality)
-                bitrate_sum = 0
-                smoothness_diff = 0
-                rebuf_time = 0
-                while True:
-                    cur_agent_id = self.get_first_agent()
-                    if not combo_log[cur_agent_id]:
-                        break
-                    bit_rate = combo_log[cur_agent_id].pop(0)
-
-                    ho_point = ho_stamps_log[cur_agent_id]
-                    ho_stamps_log[cur_agent_id] -= 1
-                    if np.isnan(bit_rate):
-                        # bit_rate = DEFAULT_QUALITY
-                        rewards.append(np.nan)
-                        break
-                        # continue
-
-                    rebuf, avg_bw = self.get_video_chunk_oracle_v2(bit_rate, cur_agent_id,
-                                                                   runner_up_sat_ids[cur_agent_id], ho_point)
-                    tmp_bws_sum.append(avg_bw)
-
-                    bitrate_sum += VIDEO_BIT_RATE[bit_rate]
-                    smoothness_diff += abs(
-                        VIDEO_BIT_RATE[bit_rate] - VIDEO_BIT_RATE[last_quality[cur_agent_id]])
-                    last_quality[cur_agent_id] = bit_rate
-                    rebuf_time += rebuf
-
-                rewards.append(bitrate_sum * QUALITY_FACTOR / M_IN_K - (REBUF_PENALTY * rebuf_time) \
-                               - SMOOTH_PENALTY * smoothness_diff / M_IN_K)
-
-                self.restore_num_of_user_sat()
-                if np.nanmean(rewards) > np.nanmean(max_rewards):
-                    best_combos = combos
-                    max_rewards = rewards
-                    ho_stamps = ho_positions
-                    best_bws_sum = tmp_bws_sum
-                elif np.nanmean(rewards) == np.nanmean(max_rewards) and \
-                        (ho_stamps[agent] <= ho_positions[agent]
-                         or np.nanmean(tmp_bws_sum) >= np.nanmean(best_bws_sum)):
-                    # elif np.nanmean(rewards) == np.nanmean(max_rewards) \
-                    #         and (rewards[agent] >= max_rewards[agent] or combos[agent][0] >= best_combos[agent][0]):
-                    best_combos = combos
-                    max_rewards = rewards
-                    ho_stamps = ho_positions
-                    best_bws_sum = tmp_bws_sum
+            if np.nanmean(rewards) > np.nanmean(max_rewards):
+                best_combos = combos
+                max_rewards = rewards
+                ho_stamps = ho_positions
+                best_bws_sum = tmp_bws_sum
+            elif np.nanmean(rewards) == np.nanmean(max_rewards) and \
+                    (ho_stamps[agent] <= ho_positions[agent]
+                     or np.nanmean(tmp_bws_sum) >= np.nanmean(best_bws_sum)):
+                # elif np.nanmean(rewards) == np.nanmean(max_rewards) \
+                #         and (rewards[agent] >= max_rewards[agent] or combos[agent][0] >= best_combos[agent][0]):
+                best_combos = combos
+                max_rewards = rewards
+                ho_stamps = ho_positions
+                best_bws_sum = tmp_bws_sum
 
         # return runner_up_sat_ids[agent], ho_stamps[agent], best_combos[agent], max_rewards[agent]
         # print(best_combos, max_rewards, ho_stamps)
         return cur_sat_ids, runner_up_sat_ids, ho_stamps, best_combos, max_rewards
 
-    def calculate_mpc_with_handover_exhaustive_reduced(self, agent):
+    def get_centralized_inputs(self, agent):
+        """
+        Decision state of the centralized MPCs: the other users' logs applied since their last chunk, the runner-up
+        satellites, the users on every satellite and the predicted bandwidths.
+        """
         # future chunks length (try 4 if that many remaining)
         video_chunk_remain = [self.video_chunk_remain[i] for i in range(self.num_agents)]
         # last_index = self.get_total_video_chunk() - video_chunk_remain
 
-        chunk_combo_option = []
-        ho_combo_option = []
-
-        # make handover combination options
-        for combo in itertools.product(list(range(MPC_FUTURE_CHUNK_COUNT + 1)), repeat=self.num_agents):
-            ho_combo_option.append(list(combo))
-
         future_chunk_length = [MPC_FUTURE_CHUNK_COUNT] * self.num_agents
         for i in range(self.num_agents):
             if video_chunk_remain[i] < MPC_FUTURE_CHUNK_COUNT:
@@ -2000,27 +1970,13 @@ class Environment:
         # first_last_quality = copy.deepcopy(self.last_quality)
 
         mahimahi_ptr = copy.deepcopy(first_mahimahi_ptr)
+        self.profile.lap("setup")
 
         runner_up_sat_ids = [self.get_runner_up_sat_id(i,
                                                        method="harmonic-mean",
                                                        mahimahi_ptr=mahimahi_ptr[i],
                                                        cur_sat_id=cur_sat_ids[i])[0] for i in range(self.num_agents)]
-        # make chunk combination options
-        for combo in itertools.product(list(range(int(BITRATE_LEVELS / BITRATE_WEIGHT))),
-                                       repeat=MPC_FUTURE_CHUNK_COUNT * self.num_agents):
-            # chunk_combo_option.append(list([BITRATE_WEIGHT * x for x in combo]))
-
-            impossible_combo = False
-            for i in range(self.num_agents):
-                if i == agent:
-                    continue
-                check_list = list(combo[i * MPC_FUTURE_CHUNK_COUNT:(i + 1) * MPC_FUTURE_CHUNK_COUNT])
-                check_list = [BITRATE_WEIGHT * x for x in check_list]
-                if NO_EXHAUSTIVE and check_list != [first_last_quality[i]] * MPC_FUTURE_CHUNK_COUNT:
-                    impossible_combo = True
-                    break
-            if not impossible_combo:
-                chunk_combo_option.append(list([BITRATE_WEIGHT * x for x in combo]))
+        self.profile.lap("prediction")
 
         related_sat_ids = []
         for sat_id in list(set(cur_sat_ids + runner_up_sat_ids)):
@@ -2048,6 +2004,7 @@ class Environment:
 
         next_bws = []
         cur_bws = []
+        self.profile.lap("setup")
         for agent_id in range(self.num_agents):
             tmp_next_bw = self.predict_bw(runner_up_sat_ids[agent_id], agent_id, True,
                                           mahimahi_ptr=mahimahi_ptr[agent_id], past_len=self.last_delay[agent])
@@ -2067,6 +2024,20 @@ class Environment:
                 next_download_bws.append(cur_download_bws[agent_id] * tmp_next_bw / tmp_cur_bw)
             """
 
+        self.profile.lap("prediction")
+        return video_chunk_remain, future_chunk_length, cur_sat_ids, runner_up_sat_ids, first_last_quality, \
+            start_buffers, num_of_sats, cur_bws, next_bws
+
+    def calculate_mpc_with_handover_exhaustive_reduced(self, agent):
+        video_chunk_remain, future_chunk_length, cur_sat_ids, runner_up_sat_ids, first_last_quality, start_buffers, \
+            num_of_sats, cur_bws, next_bws = self.get_centralized_inputs(agent)
+        # make chunk combination options, the other users keep their last quality
+        pinned_qualities = [first_last_quality[i] if NO_EXHAUSTIVE and i != agent else None
+                            for i in range(self.num_agents)]
+        if not BNB_SEARCH:
+            chunk_combo_option = get_chunk_combos(self.num_agents, MPC_FUTURE_CHUNK_COUNT, pinned_qualities)
+        self.profile.lap("combo_generation")
+
         max_rewards = [-10000000 for _ in range(self.num_agents)]
         # best_combos = [[self.last_quality[i]] for i in range(self.num_agents)]
         # best_bws = [[-10000000] * MPC_FUTURE_CHUNK_COUNT for _ in range(self.num_agents)]
@@ -2091,22 +2062,15 @@ class Environment:
 
         future_sat_user_nums_list = [[]]
 
+        # make handover combination options
+        ho_options = self.get_ho_options(agent, cur_sat_ids, runner_up_sat_ids, cur_bws, next_bws)
+        ho_combo_option = get_ho_combos(ho_options, skip_all_zero=NO_EXHAUSTIVE)
         for ho_positions in ho_combo_option:
             tmp_future_sat_user_nums = {}
             tmp_bws = []
             tmp_bws_sum = []
             impossible_route = False
 
-            for idx, ho_p in enumerate(ho_positions):
-                if NO_EXHAUSTIVE and agent != idx and (ho_p != MPC_FUTURE_CHUNK_COUNT):
-                    impossible_route = True
-                    break
-            if NO_EXHAUSTIVE and [0] * self.num_agents == ho_positions:
-                impossible_route = True
-
-            if impossible_route:
-                continue
-
             for sat_id in sat_user_nums.keys():
                 tmp_future_sat_user_nums[sat_id] = np.array([sat_user_nums[sat_id]] * MPC_FUTURE_CHUNK_COUNT)
 
@@ -2114,16 +2078,6 @@ class Environment:
                 cur_sat_id = cur_sat_ids[idx]
                 next_sat_id = runner_up_sat_ids[idx]
 
-                if (cur_sat_id == next_sat_id or next_sat_id is None) and ho_point != MPC_FUTURE_CHUNK_COUNT:
-                    impossible_route = True
-                    break
-                if cur_bws[idx] == 0 and ho_point != 0:
-                    impossible_route = True
-                    break
-                if next_bws[idx] == 0 and ho_point != MPC_FUTURE_CHUNK_COUNT:
-                    impossible_route = True
-                    break
-
                 if next_sat_id is not None:
                     cur_nums = tmp_future_sat_user_nums[cur_sat_id]
                     next_nums = tmp_future_sat_user_nums[next_sat_id]
@@ -2187,6 +2141,9 @@ class Environment:
         ho_combination_len = HO_NUM
         if len(best_bws_args) <= HO_NUM:
             ho_combination_len = len(best_bws_args) - 1
+        self.profile.count("ho_plans", len(ho_combo_option))
+        self.profile.count("ho_plans_feasible", len(best_bws_sum_list) - 1)
+        self.profile.lap("plan_scoring")
         best_future_sat_user_num = None
 
         # max_rewards = Array('i', [-10000000 for _ in range(self.num_agents)])
@@ -2196,48 +2153,271 @@ class Environment:
         best_ho_position = [MPC_FUTURE_CHUNK_COUNT for _ in range(self.num_agents)]
         best_combos = [[self.last_quality[i]] for i in range(self.num_agents)]
 
-        for i in range(-ho_combination_len, 0, 1):
+        # Receding horizon: the last decision's plan moved forward by the chunks played since is the first
+        # incumbent, so the bound already prunes the plans that cannot beat it and a decision cut short by the
+        # budget keeps at least this plan. The search replaces it as soon as it finds a plan as good.
+        if BNB_SEARCH:
+            warm_ho_positions, warm_combo = self.get_warm_plan(first_last_quality, pinned_qualities)
+            for i in self.get_plan_order(ho_combination_len):
+                if best_ho_positions_list[best_bws_args[i]] == warm_ho_positions:
+                    warm_combos, warm_rewards, warm_ho_position = self.calculate_inner_reward_warm(
+                        warm_combo, agent, future_chunk_length, first_last_quality, video_chunk_remain,
+                        start_buffers, cur_bws, next_bws, future_sat_user_nums_list[best_bws_args[i]], cur_sat_ids,
+                        runner_up_sat_ids, warm_ho_positions)
+                    if warm_ho_position is not None:
+                        best_combos, max_rewards, best_ho_position = warm_combos, warm_rewards, warm_ho_position
+                    self.profile.count("warm_plans")
+                    break
+            self.profile.lap("reward_eval")
+
+        for plan_count, i in enumerate(self.get_plan_order(ho_combination_len)):
+            if plan_count and self.past_deadline():
+                break
             future_sat_user_nums = future_sat_user_nums_list[best_bws_args[i]]
             best_ho_positions = best_ho_positions_list[best_bws_args[i]]
             self.log.debug("HO COMBO", best_ho_positions=best_ho_positions, future_sat_user_list=future_sat_user_nums)
+            self.profile.count("ho_plans_searched")
 
             mp_inputs = []
             other_vars = [agent, future_chunk_length, first_last_quality, video_chunk_remain,
                           start_buffers, cur_bws, next_bws, future_sat_user_nums,
                           cur_sat_ids, runner_up_sat_ids, best_ho_positions]
-            chunk_combo_option_list = np.array_split(chunk_combo_option, INNER_PROCESS_NUMS)
-            for idx in range(INNER_PROCESS_NUMS):
-                mp_inputs.append([chunk_combo_option_list[idx].tolist(), *other_vars])
+            if BNB_SEARCH:
+                results = [self.calculate_inner_reward_bnb(pinned_qualities, np.nanmean(max_rewards), *other_vars)]
+                self.profile.lap("reward_eval")
+            else:
+                chunk_combo_option_list = np.array_split(chunk_combo_option, INNER_PROCESS_NUMS)
+                for idx in range(INNER_PROCESS_NUMS):
+                    mp_inputs.append([chunk_combo_option_list[idx].tolist(), *other_vars])
+
+                pool = get_inner_pool(self)
+                decision_state = get_decision_state(self)
+                async_results = [pool.apply_async(run_inner_reward,
+                                                  args=("calculate_inner_reward", decision_state, mp_inputs[i]))
+                                 for i in range(len(mp_inputs))]
+                results = self.profile.merge_workers([ar.get() for ar in async_results])
+                self.profile.lap("pool_dispatch")
+            for tmp_result in results:
+                combos = tmp_result[0]
+                rewards = tmp_result[1]
+                best_ho_positions = tmp_result[2]
+                if np.nanmean(rewards) > np.nanmean(max_rewards):
+                    best_combos = combos
+                    max_rewards = rewards
+                    best_ho_position = best_ho_positions
+                elif np.nanmean(rewards) == np.nanmean(max_rewards) \
+                     and (combos[agent][0] >= best_combos[agent][0]):
+
+                    # elif np.nanmean(rewards) == np.nanmean(max_rewards) \
+                    #         and (rewards[agent] >= max_rewards[agent] or combos[agent][0] >= best_combos[agent][0]):
+                    best_combos = combos
+                    max_rewards = rewards
+                    best_ho_position = best_ho_positions
+            self.profile.lap("selection")
+
+        self.log.info("final decision", mahimahi_ptr=self.mahimahi_ptr[agent],
+                      best_ho_position=best_ho_position, best_combos=best_combos)
+
+        return cur_sat_ids, runner_up_sat_ids, best_ho_position, best_combos, max_rewards
 
-            with mp.Pool(INNER_PROCESS_NUMS) as pool:
-                async_results = [pool.apply_async(self.calculate_inner_reward, args=mp_inputs[i]) for i in range(len(mp_inputs))]
-                results = [ar.get() for ar in async_results]
-                for tmp_result in results:
-                    combos = tmp_result[0]
-                    rewards = tmp_result[1]
-                    best_ho_positions = tmp_result[2]
-                    if np.nanmean(rewards) > np.nanmean(max_rewards):
-                        best_combos = combos
-                        max_rewards = rewards
-                        best_ho_position = best_ho_positions
-                    elif np.nanmean(rewards) == np.nanmean(max_rewards) \
-                         and (combos[agent][0] >= best_combos[agent][0]):
-
-                        # elif np.nanmean(rewards) == np.nanmean(max_rewards) \
-                        #         and (rewards[agent] >= max_rewards[agent] or combos[agent][0] >= best_combos[agent][0]):
-                        best_combos = combos
-                        max_rewards = rewards
-                        best_ho_position = best_ho_positions
+    def calculate_mpc_with_handover_coordinated(self, agent):
+        # The reduced MPC with its handover plan found by coordinate descent (util/coordinated_mpc.py) instead of a
+        # scan over the product of every user's handover positions, so the work grows linearly with the users
+        video_chunk_remain, future_chunk_length, cur_sat_ids, runner_up_sat_ids, first_last_quality, start_buffers, \
+            num_of_sats, cur_bws, next_bws = self.get_centralized_inputs(agent)
+        pinned_qualities = [first_last_quality[i] if NO_EXHAUSTIVE and i != agent else None
+                            for i in range(self.num_agents)]
+        last_indexes = [int(CHUNK_TIL_VIDEO_END_CAP - video_chunk_remain[i]) for i in range(self.num_agents)]
+        chunk_sizes = get_chunk_sizes(self.video_size, last_indexes, future_chunk_length, MPC_FUTURE_CHUNK_COUNT)
+        curr_buffers = [start_buffers[i] * BUF_RATIO_COMBO if ADAPTIVE_BUF and self.unexpected_change
+                        else start_buffers[i] for i in range(self.num_agents)]
+        ho_options = self.get_ho_options(agent, cur_sat_ids, runner_up_sat_ids, cur_bws, next_bws)
+        self.profile.lap("combo_generation")
+        if not all(ho_options):
+            # No plan at all, what the reduced MPC returns when it has none to search
+            return cur_sat_ids, runner_up_sat_ids, [MPC_FUTURE_CHUNK_COUNT] * self.num_agents, \
+                [[self.last_quality[i]] for i in range(self.num_agents)], [-10000000] * self.num_agents
+
+        search = CoordinatedSearch(chunk_sizes, cur_bws, next_bws, cur_sat_ids, runner_up_sat_ids, num_of_sats,
+                                   ho_options, curr_buffers, first_last_quality, future_chunk_length, self.reward_func,
+                                   pinned_qualities, HANDOVER_DELAY)
+        warm_ho_positions, _ = self.get_warm_plan(first_last_quality, pinned_qualities)
+        best_ho_position, solutions, _, sweeps = search.solve(get_start_plans(ho_options, warm_ho_positions),
+                                                              first_user=agent)
+        self.profile.count("ho_plans", int(np.prod([len(options) for options in ho_options])))
+        self.profile.count("ho_plans_searched", len(search.plans))
+        self.profile.count("coord_sweeps", sweeps)
+        self.profile.count("combos_scored", len(search.solved))
+        self.profile.lap("reward_eval")
+
+        best_combos = []
+        max_rewards = []
+        for agent_id, (sequence, reward) in enumerate(solutions):
+            if cur_bws[agent_id] is None:
+                best_combos.append([np.nan] * MPC_FUTURE_CHUNK_COUNT)
+            elif sequence is None:
+                best_combos.append([first_last_quality[agent_id]])
+            else:
+                best_combos.append(sequence)
+            max_rewards.append(reward)
 
         self.log.info("final decision", mahimahi_ptr=self.mahimahi_ptr[agent],
                       best_ho_position=best_ho_position, best_combos=best_combos)
 
         return cur_sat_ids, runner_up_sat_ids, best_ho_position, best_combos, max_rewards
 
+    def get_warm_plan(self, first_last_quality, pinned_qualities):
+        # Handover positions and [users, horizon] combo of the last decision, shifted by the chunks each user played
+        # since and padded with its last quality. Pinned users keep their pinned quality, so the combo stays in the
+        # table the search covers.
+        ho_positions = []
+        combo = []
+        for agent_id in range(self.num_agents):
+            shift = max(self.prev_chunk_remain[agent_id] - self.video_chunk_remain[agent_id], 0)
+            ho_position = self.prev_ho_stamps[agent_id]
+            if ho_position < shift or ho_position >= MPC_FUTURE_CHUNK_COUNT:
+                ho_positions.append(MPC_FUTURE_CHUNK_COUNT)
+            else:
+                ho_positions.append(ho_position - shift)
+
+            tail = [quality for quality in self.prev_best_combos[agent_id][shift:] if not np.isnan(quality)]
+            if pinned_qualities[agent_id] is not None:
+                tail = []
+            fill = pinned_qualities[agent_id] if pinned_qualities[agent_id] is not None \
+                else (tail[-1] if tail else first_last_quality[agent_id])
+            combo.append((tail + [fill] * MPC_FUTURE_CHUNK_COUNT)[:MPC_FUTURE_CHUNK_COUNT])
+        return ho_positions, np.array(combo, dtype=int)
+
+    def calculate_inner_reward_warm(self, combo, agent, future_chunk_length, first_last_quality, video_chunk_remain,
+                                    start_buffers, cur_bws, next_bws, future_sat_user_nums, cur_sat_ids,
+                                    runner_up_sat_ids, best_ho_positions):
+        # calculate_inner_reward_bnb result of one [users, horizon] combo on its handover plan
+        chunk_sizes, bws, ho_delays, curr_buffers = self.get_plan_schedule(
+            future_chunk_length, video_chunk_remain, start_buffers, cur_bws, next_bws, future_sat_user_nums,
+            cur_sat_ids, runner_up_sat_ids, best_ho_positions)
+        rewards = calculate_combo_rewards(combo[None], chunk_sizes, bws, ho_delays, curr_buffers, first_last_quality,
+                                          future_chunk_length, self.reward_func)
+        self.profile.count("combos_scored")
+        return self.get_best_combo(combo[None], rewards, agent, future_chunk_length, cur_bws, best_ho_positions)
+
+    def get_plan_order(self, ho_combination_len):
+        # Indexes of the plans to search, counted from the end of the best_bws_sum_list ranking. Under a decision
+        # budget the plan with the best bandwidth goes first, so the incumbent at the deadline is a likely one.
+        if self.decision_deadline is not None:
+            return range(-1, -ho_combination_len - 1, -1)
+        return range(-ho_combination_len, 0, 1)
+
+    def get_ho_options(self, agent, cur_sat_ids, runner_up_sat_ids, cur_bws=None, next_bws=None):
+        # Handover positions each user can take, MPC_FUTURE_CHUNK_COUNT meaning it stays on its satellite
+        ho_options = []
+        for idx in range(self.num_agents):
+            positions = list(range(MPC_FUTURE_CHUNK_COUNT + 1))
+            if NO_EXHAUSTIVE and idx != agent:
+                positions = [MPC_FUTURE_CHUNK_COUNT]
+            if cur_sat_ids[idx] == runner_up_sat_ids[idx] or runner_up_sat_ids[idx] is None:
+                positions = [p for p in positions if p == MPC_FUTURE_CHUNK_COUNT]
+            if cur_bws is not None and cur_bws[idx] == 0:
+                positions = [p for p in positions if p == 0]
+            if next_bws is not None and next_bws[idx] == 0:
+                positions = [p for p in positions if p == MPC_FUTURE_CHUNK_COUNT]
+            ho_options.append(positions)
+        return ho_options
+
+    def get_plan_schedule(self, future_chunk_length, video_chunk_remain, start_buffers, cur_bws, next_bws,
+                          future_sat_user_nums, cur_sat_ids, runner_up_sat_ids, best_ho_positions):
+        # Chunk sizes, per-position bandwidth, handover delays and start buffers of one handover plan
+        last_indexes = [int(CHUNK_TIL_VIDEO_END_CAP - video_chunk_remain[agent_id]) for agent_id in range(self.num_agents)]
+        chunk_sizes = get_chunk_sizes(self.video_size, last_indexes, future_chunk_length, MPC_FUTURE_CHUNK_COUNT)
+
+        bws = np.full((self.num_agents, MPC_FUTURE_CHUNK_COUNT), np.nan)
+        ho_delays = np.zeros((self.num_agents, MPC_FUTURE_CHUNK_COUNT))
+        curr_buffers = []
+        for agent_id in range(self.num_agents):
+            if ADAPTIVE_BUF and self.unexpected_change:
+                curr_buffers.append(start_buffers[agent_id] * BUF_RATIO_COMBO)
+            else:
+                curr_buffers.append(start_buffers[agent_id])
+            if cur_bws[agent_id] is None:
+                continue
+            cur_sat_id = cur_sat_ids[agent_id]
+            next_sat_id = runner_up_sat_ids[agent_id]
+            for position in range(future_chunk_length[agent_id]):
+                if best_ho_positions[agent_id] > position:
+                    bws[agent_id, position] = cur_bws[agent_id] / future_sat_user_nums[cur_sat_id][position]
+                elif best_ho_positions[agent_id] == position:
+                    bws[agent_id, position] = next_bws[agent_id] / future_sat_user_nums[next_sat_id][position]
+                    # Give them a penalty
+                    ho_delays[agent_id, position] = HANDOVER_DELAY
+                else:
+                    bws[agent_id, position] = next_bws[agent_id] / future_sat_user_nums[next_sat_id][position]
+
+        return chunk_sizes, bws, ho_delays, curr_buffers
+
     def calculate_inner_reward(self, chunk_combo_option, agent, future_chunk_length, first_last_quality, video_chunk_remain,
                                                   start_buffers, cur_bws, next_bws, future_sat_user_nums,
                                cur_sat_ids, runner_up_sat_ids, best_ho_positions):
         max_rewards = [-10000000 for _ in range(self.num_agents)]
+        best_combos = [[self.last_quality[i]] for i in range(self.num_agents)]
+        best_ho_position = None
+        if len(chunk_combo_option) == 0:
+            return best_combos, max_rewards, best_ho_position
+
+        combos = np.array(chunk_combo_option, dtype=int).reshape(-1, self.num_agents, MPC_FUTURE_CHUNK_COUNT)
+        chunk_sizes, bws, ho_delays, curr_buffers = self.get_plan_schedule(
+            future_chunk_length, video_chunk_remain, start_buffers, cur_bws, next_bws, future_sat_user_nums,
+            cur_sat_ids, runner_up_sat_ids, best_ho_positions)
+
+        rewards = calculate_combo_rewards(combos, chunk_sizes, bws, ho_delays, curr_buffers, first_last_quality,
+                                          future_chunk_length, self.reward_func)
+        self.profile.count("combos", len(combos))
+        self.profile.count("combos_scored", len(combos))
+        self.profile.lap("reward_eval")
+        return self.get_best_combo(combos, rewards, agent, future_chunk_length, cur_bws, best_ho_positions)
+
+    def get_best_combo(self, combos, rewards, agent, future_chunk_length, cur_bws, best_ho_positions):
+        # Scan order pick over [C, users, horizon] combos and their [C, users] rewards
+        max_rewards = [-10000000 for _ in range(self.num_agents)]
+        best_combos = [[self.last_quality[i]] for i in range(self.num_agents)]
+        best_ho_position = None
+        if len(combos) == 0:
+            return best_combos, max_rewards, best_ho_position
+
+        first_qualities = combos[:, agent, 0] if cur_bws[agent] is not None else np.full(len(combos), np.nan)
+        best_index = select_best_combo(np.nanmean(rewards, axis=1), first_qualities, np.nanmean(max_rewards),
+                                       best_combos[agent][0])
+        if best_index is not None:
+            best_combos = [combos[best_index, agent_id, :future_chunk_length[agent_id]].tolist()
+                           if cur_bws[agent_id] is not None else [np.nan] * MPC_FUTURE_CHUNK_COUNT
+                           for agent_id in range(self.num_agents)]
+            max_rewards = rewards[best_index].tolist()
+            best_ho_position = best_ho_positions
+        return best_combos, max_rewards, best_ho_position
+
+    def calculate_inner_reward_bnb(self, pinned_qualities, max_score, agent, future_chunk_length, first_last_quality,
+                                   video_chunk_remain, start_buffers, cur_bws, next_bws, future_sat_user_nums,
+                                   cur_sat_ids, runner_up_sat_ids, best_ho_positions):
+        # Same result as calculate_inner_reward over the get_chunk_combos table, found by branch and bound.
+        # A plan whose bound cannot reach max_score, the best mean reward so far, is skipped.
+        chunk_sizes, bws, ho_delays, curr_buffers = self.get_plan_schedule(
+            future_chunk_length, video_chunk_remain, start_buffers, cur_bws, next_bws, future_sat_user_nums,
+            cur_sat_ids, runner_up_sat_ids, best_ho_positions)
+        inputs = [chunk_sizes, bws, ho_delays, curr_buffers, first_last_quality, future_chunk_length,
+                  self.reward_func, pinned_qualities]
+        if get_combo_upper_bound(*inputs) < max_score - BOUND_TOLERANCE:
+            combos, rewards = np.zeros((0, self.num_agents, MPC_FUTURE_CHUNK_COUNT), dtype=int), None
+            self.profile.count("ho_plans_bound_pruned")
+        else:
+            combos, rewards = solve_best_combo(*inputs, dp=DP_SEARCH)
+        # The full table this search stands for against the tied rows that reach the final comparison
+        self.profile.count("combos", int(np.prod([len(get_user_qualities(quality)) ** MPC_FUTURE_CHUNK_COUNT
+                                                  for quality in pinned_qualities])))
+        self.profile.count("combos_scored", len(combos))
+        return self.get_best_combo(combos, rewards, agent, future_chunk_length, cur_bws, best_ho_positions)
+
+    def calculate_inner_reward_ratio(self, chunk_combo_option, agent, future_chunk_length, first_last_quality, video_chunk_remain,
+                                                  start_buffers, cur_bws, next_bws, future_sat_user_nums,
+                               cur_sat_ids, runner_up_sat_ids, best_ho_positions, future_sat_user_list, sat_user_nums):
+        max_rewards = [-10000000 for _ in range(self.num_agents)]
         best_bws_list = []
         best_bws_sum_list = []
         best_ho_positions_list = []
@@ -2246,9 +2426,10 @@ class Environment:
         best_bws_list.append([[-10000000] * MPC_FUTURE_CHUNK_COUNT for _ in range(self.num_agents)])
         best_bws_sum_list.append(-10000000)
         best_ho_positions_list.append({})
+        best_user_info = None
 
-        best_ho_position = None
-
+        best_ho_position = [MPC_FUTURE_CHUNK_COUNT] * self.num_agents
+        combos_list = []
         for full_combo in chunk_combo_option:
             self.log.debug("CHUNK COMBO", full_combo=full_combo)
 
@@ -2266,9 +2447,38 @@ class Environment:
                     combos.append([np.nan] * MPC_FUTURE_CHUNK_COUNT)
                 else:
                     combos.append(cur_combo)
+            combos_list.append(combos)
+
+        sat_user_lists = {}
+        for sat_id in future_sat_user_nums.keys():
+            user_list = []
+            is_multi_users = False
+            for i in range(len(future_sat_user_nums[sat_id])):
+                if future_sat_user_nums[sat_id][i] > 1:
+                    is_multi_users = True
+                user_list = [*user_list, *future_sat_user_list[sat_id][i]]
+            if is_multi_users:
+                user_list = list(set(user_list))
+                assert len(user_list) > 1
+                sat_user_lists[sat_id] = user_list
+        self.profile.lap("combo_generation")
+
+        # One batched solve per satellite for all combos of this plan
+        sat_ratios = self.solve_user_ratios(combos_list, sat_user_lists, False, cur_sat_ids, runner_up_sat_ids,
+                                            future_sat_user_nums, best_ho_positions, start_buffers,
+                                            video_chunk_remain, cur_bws, next_bws)
+        self.profile.lap("ratio_optimization")
+
+        for combo_idx, combos in enumerate(combos_list):
+            user_info = {}
+            for sat_id, user_list in sat_user_lists.items():
+                user_info[sat_id] = (0, len(user_list), user_list, sat_ratios[sat_id][combo_idx])
 
             rewards = []
             for agent_id, combo in enumerate(combos):
+                if combo == [np.nan] * MPC_FUTURE_CHUNK_COUNT:
+                    rewards.append(np.nan)
+                    continue
                 curr_rebuffer_time = 0
                 if ADAPTIVE_BUF and self.unexpected_change:
                     curr_buffer = start_buffers[agent_id] * BUF_RATIO_COMBO
@@ -2285,6 +2495,7 @@ class Environment:
                 next_sat_id = runner_up_sat_ids[agent_id]
 
                 for position in range(0, len(combo)):
+                    # 0, 1, 2 -> 0, 2, 4
                     chunk_quality = combo[position]
                     index = last_index + position  # e.g., if last chunk is 3, then first iter is 3+0+1=4
                     download_time = 0
@@ -2304,7 +2515,7 @@ class Environment:
                     else:
                         next_future_sat_user_num = future_sat_user_nums[next_sat_id][position]
                         harmonic_bw = next_bws[agent_id] / next_future_sat_user_num
-                    # assert harmonic_bw != 0
+                    assert harmonic_bw != 0
                     download_time += (self.video_size[chunk_quality][index] / B_IN_MB) \
                                      / harmonic_bw * BITS_IN_BYTE  # this is MB/MB/s --> seconds
 
@@ -2345,224 +2556,43 @@ class Environment:
                 best_combos = combos
                 max_rewards = rewards
                 best_ho_position = best_ho_positions
+                best_user_info = {}
             elif np.nanmean(rewards) == np.nanmean(max_rewards) \
-                 and (combos[agent][0] >= best_combos[agent][0]):
+                    and (combos[agent][0] >= best_combos[agent][0]):
                 # elif np.nanmean(rewards) == np.nanmean(max_rewards) \
                 #         and (rewards[agent] >= max_rewards[agent] or combos[agent][0] >= best_combos[agent][0]):
                 best_combos = combos
                 max_rewards = rewards
                 best_ho_position = best_ho_positions
-        return best_combos, max_rewards, best_ho_position
+                best_user_info = {}
 
-    def calculate_inner_reward_ratio(self, chunk_combo_option, agent, future_chunk_length, first_last_quality, video_chunk_remain,
-                                                  start_buffers, cur_bws, next_bws, future_sat_user_nums,
-                               cur_sat_ids, runner_up_sat_ids, best_ho_positions, future_sat_user_list, sat_user_nums):
-        max_rewards = [-10000000 for _ in range(self.num_agents)]
-        best_bws_list = []
-        best_bws_sum_list = []
-        best_ho_positions_list = []
+            if user_info:
+                rewards = []
+                for agent_id, combo in enumerate(combos):
+                    if combo == [np.nan] * MPC_FUTURE_CHUNK_COUNT:
+                        rewards.append(np.nan)
+                        continue
+                    curr_rebuffer_time = 0
+                    if ADAPTIVE_BUF and self.unexpected_change:
+                        curr_buffer = start_buffers[agent_id] * BUF_RATIO_COMBO
+                    else:
+                        curr_buffer = start_buffers[agent_id]
+                    bitrate_sum = 0
+                    smoothness_diff = 0
 
-        best_combos = [[self.last_quality[i]] for i in range(self.num_agents)]
-        best_bws_list.append([[-10000000] * MPC_FUTURE_CHUNK_COUNT for _ in range(self.num_agents)])
-        best_bws_sum_list.append(-10000000)
-        best_ho_positions_list.append({})
-        best_user_info = None
+                    last_quality = first_last_quality[agent_id]
+                    last_index = int(CHUNK_TIL_VIDEO_END_CAP - video_chunk_remain[agent_id])
+                    # linear optimization
+                    # constraint = LinearConstraint(np.ones(self.num_agents), lb=best_bws, ub=best_bws)
 
-        best_ho_position = [MPC_FUTURE_CHUNK_COUNT] * self.num_agents
-        for full_combo in chunk_combo_option:
-            self.log.debug("CHUNK COMBO", full_combo=full_combo)
+                    cur_sat_id = cur_sat_ids[agent_id]
+                    next_sat_id = runner_up_sat_ids[agent_id]
 
-            combos = []
-            # Break at the end of the chunk
-
-            for agent_id in range(self.num_agents):
-                cur_combo = full_combo[
-                            MPC_FUTURE_CHUNK_COUNT * agent_id:
-                            MPC_FUTURE_CHUNK_COUNT * agent_id + future_chunk_length[agent_id]]
-                # if cur_download_bws[agent_id] is None and cur_combo != [DEFAULT_QUALITY] * MPC_FUTURE_CHUNK_COUNT:
-                #     wrong_format = True
-                #     break
-                if cur_bws[agent_id] is None:
-                    combos.append([np.nan] * MPC_FUTURE_CHUNK_COUNT)
-                else:
-                    combos.append(cur_combo)
-
-            user_info = {}
-            for sat_id in future_sat_user_nums.keys():
-                bw_ratio = {}
-                op_vars = []
-                op_vars_index = 0
-                bounds = []
-                constraints = []
-                sat_id_list = []
-                const_array = []
-                user_list = []
-                is_multi_users = False
-                for i in range(len(future_sat_user_nums[sat_id])):
-                    if future_sat_user_nums[sat_id][i] > 1:
-                        is_multi_users = True
-                    user_list = [*user_list, *future_sat_user_list[sat_id][i]]
-                if is_multi_users:
-                    user_list = list(set(user_list))
-                    assert len(user_list) > 1
-                    user_info[sat_id] = (op_vars_index, op_vars_index + len(user_list), user_list)
-
-                    op_vars = [1 / len(user_list)] * len(user_list)
-                    bounds = [*bounds, *[(0 + EPSILON, 1 - EPSILON) for _ in range(len(user_list))]]
-                    sat_id_list.append(sat_id)
-
-                    target_array = np.zeros(op_vars_index + len(user_list))
-                    target_array[op_vars_index:op_vars_index + len(user_list)] = 1
-
-                    op_vars_index += len(user_list)
-
-                    const_array.append(target_array)
-                    for i in range(len(const_array)):
-                        data = const_array[i]
-                        if len(const_array[i]) < op_vars_index:
-                            data = np.append(const_array[i], [0] * (op_vars_index - len(const_array[i])))
-
-                        constraint = LinearConstraint(data, lb=1, ub=1)
-
-                        # constraints = [*constraints, {'type': 'eq', 'fun': const}]
-                        constraints.append(constraint)
-                    import warnings
-                    warnings.filterwarnings("ignore")
-                    # print(combos, best_ho_positions, user_info)
-                    ue_ratio = minimize(
-                        self.objective_function,
-                        x0=np.array(op_vars),
-                        args=(combos, cur_sat_ids, runner_up_sat_ids, sat_user_nums,
-                              future_sat_user_nums, best_ho_positions, start_buffers,
-                              video_chunk_remain, cur_bws,
-                              next_bws, user_info, bw_ratio, None),
-                        constraints=constraints,
-                        bounds=bounds,
-                        method="SLSQP",  # or BFGS
-                        # options={'max_iter': 100}
-                    )
-                    for sat_id in sat_id_list:
-                        user_info[sat_id] = user_info[sat_id] + (ue_ratio.x[user_info[sat_id][0]:user_info[sat_id][1]],)
-
-            rewards = []
-            for agent_id, combo in enumerate(combos):
-                if combo == [np.nan] * MPC_FUTURE_CHUNK_COUNT:
-                    rewards.append(np.nan)
-                    continue
-                curr_rebuffer_time = 0
-                if ADAPTIVE_BUF and self.unexpected_change:
-                    curr_buffer = start_buffers[agent_id] * BUF_RATIO_COMBO
-                else:
-                    curr_buffer = start_buffers[agent_id]
-                bitrate_sum = 0
-                smoothness_diff = 0
-
-                last_quality = first_last_quality[agent_id]
-                last_index = int(CHUNK_TIL_VIDEO_END_CAP - video_chunk_remain[agent_id])
-                # linear optimization
-                # constraint = LinearConstraint(np.ones(self.num_agents), lb=best_bws, ub=best_bws)
-                cur_sat_id = cur_sat_ids[agent_id]
-                next_sat_id = runner_up_sat_ids[agent_id]
-
-                for position in range(0, len(combo)):
-                    # 0, 1, 2 -> 0, 2, 4
-                    chunk_quality = combo[position]
-                    index = last_index + position  # e.g., if last chunk is 3, then first iter is 3+0+1=4
-                    download_time = 0
-
-                    # cur_sat_user_num = sat_user_nums[cur_sat_id]
-                    # next_sat_user_num = sat_user_nums[next_sat_id]
-                    if best_ho_positions[agent_id] > position:
-                        cur_future_sat_user_num = future_sat_user_nums[cur_sat_id][position]
-                        harmonic_bw = cur_bws[agent_id] / cur_future_sat_user_num
-
-                    elif best_ho_positions[agent_id] == position:
-                        next_future_sat_user_num = future_sat_user_nums[next_sat_id][position]
-                        harmonic_bw = next_bws[agent_id] / next_future_sat_user_num
-
-                        # Give them a penalty
-                        download_time += HANDOVER_DELAY
-                    else:
-                        next_future_sat_user_num = future_sat_user_nums[next_sat_id][position]
-                        harmonic_bw = next_bws[agent_id] / next_future_sat_user_num
-                    assert harmonic_bw != 0
-                    download_time += (self.video_size[chunk_quality][index] / B_IN_MB) \
-                                     / harmonic_bw * BITS_IN_BYTE  # this is MB/MB/s --> seconds
-
-                    if curr_buffer < download_time:
-                        curr_rebuffer_time += (download_time - curr_buffer)
-                        curr_buffer = 0.0
-                    else:
-                        curr_buffer -= download_time
-                    curr_buffer += VIDEO_CHUNCK_LEN / MILLISECONDS_IN_SECOND
-
-                    # bitrate_sum += VIDEO_BIT_RATE[chunk_quality]
-                    # smoothness_diffs += abs(VIDEO_BIT_RATE[chunk_quality] - VIDEO_BIT_RATE[last_quality])
-                    if self.reward_func == "LIN":
-                        bitrate_sum += VIDEO_BIT_RATE[chunk_quality]
-                        smoothness_diff += abs(
-                            VIDEO_BIT_RATE[chunk_quality] - VIDEO_BIT_RATE[last_quality])
-                        last_quality = chunk_quality
-                    elif self.reward_func == "HD":
-                        bitrate_sum += BITRATE_REWARD[chunk_quality]
-                        smoothness_diff += abs(
-                            BITRATE_REWARD[chunk_quality] - BITRATE_REWARD[last_quality])
-                        last_quality = chunk_quality
-                    else:
-                        raise Exception
-                # compute reward for this combination (one reward per 5-chunk combo)
-
-                # bitrates are in Mbits/s, rebuffer in seconds, and smoothness_diffs in Mbits/s
-
-                if self.reward_func == "LIN":
-                    rewards.append(bitrate_sum * QUALITY_FACTOR / M_IN_K - (REBUF_PENALTY * curr_rebuffer_time) \
-                                   - SMOOTH_PENALTY * smoothness_diff / M_IN_K)
-                elif self.reward_func == "HD":
-                    rewards.append(bitrate_sum - (8 * curr_rebuffer_time) - smoothness_diff)
-                else:
-                    raise Exception
-
-            if np.nanmean(rewards) > np.nanmean(max_rewards):
-                best_combos = combos
-                max_rewards = rewards
-                best_ho_position = best_ho_positions
-                best_user_info = {}
-            elif np.nanmean(rewards) == np.nanmean(max_rewards) \
-                    and (combos[agent][0] >= best_combos[agent][0]):
-                # elif np.nanmean(rewards) == np.nanmean(max_rewards) \
-                #         and (rewards[agent] >= max_rewards[agent] or combos[agent][0] >= best_combos[agent][0]):
-                best_combos = combos
-                max_rewards = rewards
-                best_ho_position = best_ho_positions
-                best_user_info = {}
-
-            if user_info:
-                rewards = []
-                for agent_id, combo in enumerate(combos):
-                    if combo == [np.nan] * MPC_FUTURE_CHUNK_COUNT:
-                        rewards.append(np.nan)
-                        continue
-                    curr_rebuffer_time = 0
-                    if ADAPTIVE_BUF and self.unexpected_change:
-                        curr_buffer = start_buffers[agent_id] * BUF_RATIO_COMBO
-                    else:
-                        curr_buffer = start_buffers[agent_id]
-                    bitrate_sum = 0
-                    smoothness_diff = 0
-
-                    last_quality = first_last_quality[agent_id]
-                    last_index = int(CHUNK_TIL_VIDEO_END_CAP - video_chunk_remain[agent_id])
-                    # linear optimization
-                    # constraint = LinearConstraint(np.ones(self.num_agents), lb=best_bws, ub=best_bws)
-
-                    cur_sat_id = cur_sat_ids[agent_id]
-                    next_sat_id = runner_up_sat_ids[agent_id]
-
-                    for position in range(0, len(combo)):
-                        # 0, 1, 2 -> 0, 2, 4
-                        chunk_quality = combo[position]
-                        index = last_index + position  # e.g., if last chunk is 3, then first iter is 3+0+1=4
-                        download_time = 0
+                    for position in range(0, len(combo)):
+                        # 0, 1, 2 -> 0, 2, 4
+                        chunk_quality = combo[position]
+                        index = last_index + position  # e.g., if last chunk is 3, then first iter is 3+0+1=4
+                        download_time = 0
 
                         # cur_sat_user_num = sat_user_nums[cur_sat_id]
                         # next_sat_user_num = sat_user_nums[next_sat_id]
@@ -2630,6 +2660,9 @@ class Environment:
                     # ho_stamps = ho_positions
                     best_user_info = user_info
                     best_ho_position = best_ho_positions
+        self.profile.count("combos", len(combos_list))
+        self.profile.count("combos_scored", len(combos_list))
+        self.profile.lap("reward_eval")
 
         return best_combos, max_rewards, best_ho_position, best_user_info
 
@@ -2638,13 +2671,6 @@ class Environment:
         video_chunk_remain = [self.video_chunk_remain[i] for i in range(self.num_agents)]
         # last_index = self.get_total_video_chunk() - video_chunk_remain
 
-        chunk_combo_option = []
-        ho_combo_option = []
-
-        # make handover combination options
-        for combo in itertools.product(list(range(MPC_FUTURE_CHUNK_COUNT + 1)), repeat=self.num_agents):
-            ho_combo_option.append(list(combo))
-
         future_chunk_length = [MPC_FUTURE_CHUNK_COUNT] * self.num_agents
         for i in range(self.num_agents):
             if video_chunk_remain[i] < MPC_FUTURE_CHUNK_COUNT:
@@ -2690,27 +2716,18 @@ class Environment:
 
         mahimahi_ptr = copy.deepcopy(first_mahimahi_ptr)
         cur_sat_ids = [self.cur_user[i].get_conn_sat_id(mahimahi_ptr[agent]) for i in range(self.num_agents)]
+        self.profile.lap("setup")
 
         runner_up_sat_ids = [self.get_runner_up_sat_id(i, method="harmonic-mean",
                                                        mahimahi_ptr=mahimahi_ptr[i],
                                                        cur_sat_id=cur_sat_ids[i])[0] for i in range(self.num_agents)]
+        self.profile.lap("prediction")
 
-        # make chunk combination options
-        for combo in itertools.product(list(range(int(BITRATE_LEVELS / BITRATE_WEIGHT))),
-                                       repeat=MPC_FUTURE_CHUNK_COUNT * self.num_agents):
-            # chunk_combo_option.append(list([BITRATE_WEIGHT * x for x in combo]))
-
-            impossible_combo = False
-            for i in range(self.num_agents):
-                if i == agent:
-                    continue
-                check_list = list(combo[i * MPC_FUTURE_CHUNK_COUNT:(i + 1) * MPC_FUTURE_CHUNK_COUNT])
-                check_list = [BITRATE_WEIGHT * x for x in check_list]
-                if NO_EXHAUSTIVE and check_list != [first_last_quality[i]] * MPC_FUTURE_CHUNK_COUNT:
-                    impossible_combo = True
-                    break
-            if not impossible_combo:
-                chunk_combo_option.append(list([BITRATE_WEIGHT * x for x in combo]))
+        # make chunk combination options, the other users keep their last quality
+        pinned_qualities = [first_last_quality[i] if NO_EXHAUSTIVE and i != agent else None
+                            for i in range(self.num_agents)]
+        chunk_combo_option = get_chunk_combos(self.num_agents, MPC_FUTURE_CHUNK_COUNT, pinned_qualities)
+        self.profile.lap("combo_generation")
 
         related_sat_ids = []
         for sat_id in list(set(cur_sat_ids + runner_up_sat_ids)):
@@ -2747,6 +2764,7 @@ class Environment:
 
         next_bws = []
         cur_bws = []
+        self.profile.lap("setup")
         for agent_id in range(self.num_agents):
             tmp_next_bw = self.predict_bw(runner_up_sat_ids[agent_id], agent_id, True,
                                           mahimahi_ptr=mahimahi_ptr[agent_id], past_len=MPC_PAST_CHUNK_COUNT)
@@ -2763,6 +2781,8 @@ class Environment:
                 next_download_bws.append(cur_download_bws[agent_id] * tmp_next_bw / tmp_cur_bw)
             """
 
+        self.profile.lap("prediction")
+
         max_rewards = [-10000000 for _ in range(self.num_agents)]
         # best_combos = [[self.last_quality[i]] for i in range(self.num_agents)]
         # best_bws = [[-10000000] * MPC_FUTURE_CHUNK_COUNT for _ in range(self.num_agents)]
@@ -2785,22 +2805,16 @@ class Environment:
 
         future_sat_user_nums_list = [[]]
         future_sat_user_list_list = [[]]
+
+        # make handover combination options
+        ho_options = self.get_ho_options(agent, cur_sat_ids, runner_up_sat_ids, cur_bws, next_bws)
+        ho_combo_option = get_ho_combos(ho_options, skip_all_zero=NO_EXHAUSTIVE)
         for ho_positions in ho_combo_option:
             tmp_future_sat_user_nums = {}
             tmp_future_sat_user_list = {}
             tmp_bws = []
             tmp_bws_sum = []
             impossible_route = False
-            for idx, ho_p in enumerate(ho_positions):
-                if NO_EXHAUSTIVE and agent != idx and (ho_p != MPC_FUTURE_CHUNK_COUNT):
-                    impossible_route = True
-                    break
-
-            if NO_EXHAUSTIVE and [0] * self.num_agents == ho_positions:
-                impossible_route = True
-
-            if impossible_route:
-                continue
 
             for sat_id in sat_user_nums.keys():
                 tmp_future_sat_user_nums[sat_id] = np.array([sat_user_nums[sat_id]] * MPC_FUTURE_CHUNK_COUNT)
@@ -2813,16 +2827,6 @@ class Environment:
                 cur_sat_id = cur_sat_ids[idx]
                 next_sat_id = runner_up_sat_ids[idx]
 
-                if (cur_sat_id == next_sat_id or next_sat_id is None) and ho_point != MPC_FUTURE_CHUNK_COUNT:
-                    impossible_route = True
-                    break
-                if cur_bws[idx] == 0 and ho_point != 0:
-                    impossible_route = True
-                    break
-                if next_bws[idx] == 0 and ho_point != MPC_FUTURE_CHUNK_COUNT:
-                    impossible_route = True
-                    break
-
                 if next_sat_id is not None:
                     cur_nums = tmp_future_sat_user_nums[cur_sat_id]
                     next_nums = tmp_future_sat_user_nums[next_sat_id]
@@ -2904,12 +2908,18 @@ class Environment:
         ho_combination_len = HO_NUM
         if len(best_bws_args) <= HO_NUM:
             ho_combination_len = len(best_bws_args) - 1
+        self.profile.count("ho_plans", len(ho_combo_option))
+        self.profile.count("ho_plans_feasible", len(best_bws_sum_list) - 1)
+        self.profile.lap("plan_scoring")
 
-        for i in range(-ho_combination_len, 0, 1):
+        for plan_count, i in enumerate(self.get_plan_order(ho_combination_len)):
+            if plan_count and self.past_deadline():
+                break
             future_sat_user_list = future_sat_user_list_list[best_bws_args[i]]
             future_sat_user_nums = future_sat_user_nums_list[best_bws_args[i]]
             best_ho_positions = best_ho_positions_list[best_bws_args[i]]
             self.log.debug("HO COMBO", best_ho_positions=best_ho_positions, future_sat_user_list=future_sat_user_list)
+            self.profile.count("ho_plans_searched")
 
             mp_inputs = []
             other_vars = [agent, future_chunk_length, first_last_quality, video_chunk_remain,
@@ -2919,31 +2929,35 @@ class Environment:
             for idx in range(INNER_PROCESS_NUMS):
                 mp_inputs.append([chunk_combo_option_list[idx].tolist(), *other_vars])
 
-            with mp.Pool(INNER_PROCESS_NUMS) as pool:
-                async_results = [pool.apply_async(self.calculate_inner_reward_ratio, args=mp_inputs[i]) for i in range(len(mp_inputs))]
-                results = [ar.get() for ar in async_results]
-                for tmp_result in results:
-                    combos = tmp_result[0]
-                    rewards = tmp_result[1]
-                    best_ho_positions = tmp_result[2]
-                    user_info = tmp_result[3]
-
-                    if np.nanmean(rewards) > np.nanmean(max_rewards):
-                        best_combos = combos
-                        max_rewards = rewards
-                        # ho_stamps = ho_positions
-                        best_user_info = user_info
-                        best_ho_position = best_ho_positions
-
-                    elif np.nanmean(rewards) == np.nanmean(max_rewards) \
-                            and (combos[agent][0] >= best_combos[agent][0]):
-                        # elif np.nanmean(rewards) == np.nanmean(max_rewards) \
-                        #         and (rewards[agent] >= max_rewards[agent] or combos[agent][0] >= best_combos[agent][0]):
-                        best_combos = combos
-                        max_rewards = rewards
-                        # ho_stamps = ho_positions
-                        best_user_info = user_info
-                        best_ho_position = best_ho_positions
+            pool = get_inner_pool(self)
+            decision_state = get_decision_state(self)
+            async_results = [pool.apply_async(run_inner_reward, args=("calculate_inner_reward_ratio", decision_state, mp_inputs[i]))
+                             for i in range(len(mp_inputs))]
+            results = self.profile.merge_workers([ar.get() for ar in async_results])
+            self.profile.lap("pool_dispatch")
+            for tmp_result in results:
+                combos = tmp_result[0]
+                rewards = tmp_result[1]
+                best_ho_positions = tmp_result[2]
+                user_info = tmp_result[3]
+
+                if np.nanmean(rewards) > np.nanmean(max_rewards):
+                    best_combos = combos
+                    max_rewards = rewards
+                    # ho_stamps = ho_positions
+                    best_user_info = user_info
+                    best_ho_position = best_ho_positions
+
+                elif np.nanmean(rewards) == np.nanmean(max_rewards) \
+                        and (combos[agent][0] >= best_combos[agent][0]):
+                    # elif np.nanmean(rewards) == np.nanmean(max_rewards) \
+                    #         and (rewards[agent] >= max_rewards[agent] or combos[agent][0] >= best_combos[agent][0]):
+                    best_combos = combos
+                    max_rewards = rewards
+                    # ho_stamps = ho_positions
+                    best_user_info = user_info
+                    best_ho_position = best_ho_positions
+            self.profile.lap("selection")
 
         # return runner_up_sat_ids[agent], ho_stamps[agent], best_combos[agent], max_rewards[agent]
         # print(future_sat_user_nums, cur_sat_ids, runner_up_sat_ids, best_ho_positions, best_combos, max_rewards, best_user_info)
@@ -2961,12 +2975,6 @@ class Environment:
         # last_index = self.get_total_video_chunk() - video_chunk_remain
         last_index = int(CHUNK_TIL_VIDEO_END_CAP - video_chunk_remain)
 
-        chunk_combo_option = []
-        # make chunk combination options
-        for combo in itertools.product(list(range(int(BITRATE_LEVELS / BITRATE_WEIGHT))),
-                                       repeat=MPC_FUTURE_CHUNK_COUNT):
-            chunk_combo_option.append(list([BITRATE_WEIGHT * x for x in combo]))
-
         future_chunk_length = MPC_FUTURE_CHUNK_COUNT
         if video_chunk_remain < MPC_FUTURE_CHUNK_COUNT:
             future_chunk_length = video_chunk_remain
@@ -2999,6 +3007,7 @@ class Environment:
             return ho_sat_id, ho_stamp, best_combo, max_reward
 
         start_buffer = self.buffer_size[agent] / MILLISECONDS_IN_SECOND
+        chunk_sizes = get_chunk_sizes(self.video_size, [last_index], [future_chunk_length], MPC_FUTURE_CHUNK_COUNT)
         if cur_download_bw != 0:
             best_combo, max_reward, best_case = self.calculate_mpc(video_chunk_remain, start_buffer, last_index,
                                                                    cur_download_bw, agent, centralized)
@@ -3033,6 +3042,7 @@ class Environment:
                     print("Cannot happen")
                     raise Exception
 
+                next_user_num = self.get_num_of_user_sat(self.mahimahi_ptr[agent], next_sat_id)
                 for ho_index in range(MPC_FUTURE_CHUNK_COUNT + 1):
                     # all possible combinations of 5 chunk bitrates for 6 bitrate options (6^5 options)
                     # iterate over list and for each, compute reward and store max reward combination
@@ -3041,106 +3051,39 @@ class Environment:
                         continue
                     if next_download_bw == 0 and ho_index != MPC_FUTURE_CHUNK_COUNT:
                         continue
-                    for full_combo in chunk_combo_option:
-                        # Break at the end of the chunk
-                        combo = full_combo[0: future_chunk_length]
-                        # calculate total rebuffer time for this combination (start with start_buffer and subtract
-                        # each download time and add 2 seconds in that order)
-                        curr_rebuffer_time = 0
-                        curr_buffer = start_buffer
-                        bitrate_sum = 0
-                        smoothness_diffs = 0
-                        last_quality = self.last_quality[agent]
-
-                        for position in range(0, len(combo)):
-                            chunk_quality = combo[position]
-                            index = last_index + position  # e.g., if last chunk is 3, then first iter is 3+0+1=4
-                            download_time = 0
-                            if ho_index > position:
-                                harmonic_bw = cur_download_bw
-                            elif ho_index == position:
-                                harmonic_bw = next_download_bw
-                                # Give them a penalty
-                                download_time += HANDOVER_DELAY
-                            else:
-                                harmonic_bw = next_download_bw
-
-                            download_time += (self.video_size[chunk_quality][index] / B_IN_MB) \
-                                             / harmonic_bw * BITS_IN_BYTE  # this is MB/MB/s --> seconds
-
-                            if curr_buffer < download_time:
-                                curr_rebuffer_time += (download_time - curr_buffer)
-                                curr_buffer = 0.0
-                            else:
-                                curr_buffer -= download_time
-                            curr_buffer += VIDEO_CHUNCK_LEN / MILLISECONDS_IN_SECOND
-
-                            # bitrate_sum += VIDEO_BIT_RATE[chunk_quality]
-                            # smoothness_diffs += abs(VIDEO_BIT_RATE[chunk_quality] - VIDEO_BIT_RATE[last_quality])
-                            if self.reward_func == "LIN":
-                                bitrate_sum += VIDEO_BIT_RATE[chunk_quality]
-                                smoothness_diffs += abs(
-                                    VIDEO_BIT_RATE[chunk_quality] - VIDEO_BIT_RATE[last_quality])
-                                last_quality = chunk_quality
-                            elif self.reward_func == "HD":
-                                bitrate_sum += BITRATE_REWARD[chunk_quality]
-                                smoothness_diffs += abs(
-                                    BITRATE_REWARD[chunk_quality] - BITRATE_REWARD[last_quality])
-                                last_quality = chunk_quality
-                            else:
-                                raise Exception
-                        # compute reward for this combination (one reward per 5-chunk combo)
-
-                        # bitrates are in Mbits/s, rebuffer in seconds, and smoothness_diffs in Mbits/s
-
-                        # 10~140 - 0~100 - 0~130
-                        if self.reward_func == "LIN":
-                            reward = bitrate_sum * QUALITY_FACTOR / M_IN_K - (REBUF_PENALTY * curr_rebuffer_time) \
-                                     - SMOOTH_PENALTY * smoothness_diffs / M_IN_K
-                        elif self.reward_func == "HD":
-                            reward = bitrate_sum - (8 * curr_rebuffer_time) \
-                                     - smoothness_diffs
-                        else:
-                            raise Exception
-                        if centralized:
-                            for agent_id in range(self.num_agents):
-                                if agent_id == agent or self.user_qoe_log[agent_id] == {}:
-                                    continue
-                                qoe_log = self.user_qoe_log[agent_id]
-                                reward += self.get_simulated_reward(qoe_log, last_index, ho_index,
-                                                                    self.cur_sat_id[agent], next_sat_id)
-                                # reward += qoe_log["reward"]
-
-                        next_user_num = self.get_num_of_user_sat(self.mahimahi_ptr[agent], next_sat_id)
-
-                        if reward > max_reward:
-                            best_combo = combo
-                            max_reward = reward
-                            ho_sat_id = next_sat_id
-                            best_next_bw = next_download_bw
-                            best_next_num = next_user_num + 1
-                            ho_stamp = ho_index
-                            best_case = {"last_quality": last_quality, "cur_download_bw": cur_download_bw,
-                                         "start_buffer": start_buffer, "future_chunk_length": future_chunk_length,
-                                         "last_index": last_index, "combo": combo,
-                                         "next_download_bw": next_download_bw,
-                                         "ho_index": ho_index, "next_sat_id": next_sat_id, "reward": reward,
-                                         "cur_user_num": cur_user_num, "next_user_num": next_user_num,
-                                         "cur_sat_id": self.cur_sat_id[agent]}
-                        elif reward == max_reward and (combo[0] >= best_combo[0]):
-                            best_combo = combo
-                            max_reward = reward
-                            ho_sat_id = next_sat_id
-                            ho_stamp = ho_index
-                            best_next_bw = next_download_bw
-                            best_next_num = next_user_num + 1
-                            best_case = {"last_quality": last_quality, "cur_download_bw": cur_download_bw,
-                                         "start_buffer": start_buffer, "future_chunk_length": future_chunk_length,
-                                         "last_index": last_index, "combo": combo,
-                                         "next_download_bw": next_download_bw,
-                                         "ho_index": ho_index, "next_sat_id": next_sat_id, "reward": reward,
-                                         "cur_user_num": cur_user_num, "next_user_num": next_user_num,
-                                         "cur_sat_id": self.cur_sat_id[agent]}
+                    bws = [cur_download_bw if ho_index > position else next_download_bw
+                           for position in range(MPC_FUTURE_CHUNK_COUNT)]
+                    # Give them a penalty
+                    ho_delays = [HANDOVER_DELAY if ho_index == position else 0
+                                 for position in range(MPC_FUTURE_CHUNK_COUNT)]
+                    combos, rewards = self.get_user_combos(chunk_sizes, np.array([bws], dtype=float),
+                                                           np.array([ho_delays], dtype=float), start_buffer,
+                                                           self.last_quality[agent], future_chunk_length)
+                    if centralized:
+                        for agent_id in range(self.num_agents):
+                            if agent_id == agent or self.user_qoe_log[agent_id] == {}:
+                                continue
+                            qoe_log = self.user_qoe_log[agent_id]
+                            rewards = rewards + self.get_simulated_reward(qoe_log, last_index, ho_index,
+                                                                          self.cur_sat_id[agent], next_sat_id)
+                            # reward += qoe_log["reward"]
+
+                    best_index = select_best_combo(rewards, combos[:, 0, 0], max_reward, best_combo[0])
+                    if best_index is None:
+                        continue
+                    best_combo = combos[best_index, 0, :future_chunk_length].tolist()
+                    max_reward = rewards[best_index].item()
+                    ho_sat_id = next_sat_id
+                    best_next_bw = next_download_bw
+                    best_next_num = next_user_num + 1
+                    ho_stamp = ho_index
+                    best_case = {"last_quality": best_combo[-1], "cur_download_bw": cur_download_bw,
+                                 "start_buffer": start_buffer, "future_chunk_length": future_chunk_length,
+                                 "last_index": last_index, "combo": best_combo,
+                                 "next_download_bw": next_download_bw,
+                                 "ho_index": ho_index, "next_sat_id": next_sat_id, "reward": max_reward,
+                                 "cur_user_num": cur_user_num, "next_user_num": next_user_num,
+                                 "cur_sat_id": self.cur_sat_id[agent]}
 
         self.user_qoe_log[agent] = best_case
         self.log.info("final decision (dual)", mahimahi_ptr=self.mahimahi_ptr[agent], cur_sat_id=self.cur_sat_id[agent],
@@ -3156,12 +3099,6 @@ class Environment:
         # last_index = self.get_total_video_chunk() - video_chunk_remain
         last_index = int(CHUNK_TIL_VIDEO_END_CAP - video_chunk_remain)
 
-        chunk_combo_option = []
-        # make chunk combination options
-        for combo in itertools.product(list(range(int(BITRATE_LEVELS / BITRATE_WEIGHT))),
-                                       repeat=MPC_FUTURE_CHUNK_COUNT):
-            chunk_combo_option.append(list([BITRATE_WEIGHT * x for x in combo]))
-
         future_chunk_length = MPC_FUTURE_CHUNK_COUNT
         if video_chunk_remain < MPC_FUTURE_CHUNK_COUNT:
             future_chunk_length = video_chunk_remain
@@ -3194,10 +3131,14 @@ class Environment:
             return ho_sat_id, ho_stamp, best_combo, max_reward
 
         start_buffer = self.buffer_size[agent] / MILLISECONDS_IN_SECOND
+        chunk_sizes = get_chunk_sizes(self.video_size, [last_index], [future_chunk_length], MPC_FUTURE_CHUNK_COUNT)
         if cur_download_bw != 0:
             best_combo, max_reward, best_case = self.calculate_mpc(video_chunk_remain, start_buffer, last_index,
                                                                    cur_download_bw, agent, centralized)
 
+        # (next_sat_id, next_download_bw, next_user_num, ho_index) of every handover option, over every satellite
+        # in sight
+        ho_rows = []
         for next_sat_id, next_sat_bw in self.cooked_bw.items():
             if next_sat_id == self.cur_sat_id[agent]:
                 continue
@@ -3228,114 +3169,56 @@ class Environment:
                     print("Cannot happen")
                     raise Exception
 
+                next_user_num = self.get_num_of_user_sat(self.mahimahi_ptr[agent], next_sat_id)
                 for ho_index in range(MPC_FUTURE_CHUNK_COUNT + 1):
-                    # all possible combinations of 5 chunk bitrates for 6 bitrate options (6^5 options)
-                    # iterate over list and for each, compute reward and store max reward combination
                     # ho_index: 0-4 -> Do handover, 5 -> Do not handover
                     if cur_download_bw == 0 and ho_index != 0:
                         continue
                     if next_download_bw == 0 and ho_index != MPC_FUTURE_CHUNK_COUNT:
                         continue
-                    for full_combo in chunk_combo_option:
-                        # Break at the end of the chunk
-                        combo = full_combo[0: future_chunk_length]
-                        # calculate total rebuffer time for this combination (start with start_buffer and subtract
-                        # each download time and add 2 seconds in that order)
-                        curr_rebuffer_time = 0
-                        curr_buffer = start_buffer
-                        bitrate_sum = 0
-                        smoothness_diffs = 0
-                        last_quality = self.last_quality[agent]
-
-                        for position in range(0, len(combo)):
-                            chunk_quality = combo[position]
-                            index = last_index + position  # e.g., if last chunk is 3, then first iter is 3+0+1=4
-                            download_time = 0
-                            if ho_index > position:
-                                harmonic_bw = cur_download_bw
-                            elif ho_index == position:
-                                harmonic_bw = next_download_bw
-                                # Give them a penalty
-                                download_time += HANDOVER_DELAY
-                            else:
-                                harmonic_bw = next_download_bw
-
-                            download_time += (self.video_size[chunk_quality][index] / B_IN_MB) \
-                                             / harmonic_bw * BITS_IN_BYTE  # this is MB/MB/s --> seconds
-
-                            if curr_buffer < download_time:
-                                curr_rebuffer_time += (download_time - curr_buffer)
-                                curr_buffer = 0.0
-                            else:
-                                curr_buffer -= download_time
-                            curr_buffer += VIDEO_CHUNCK_LEN / MILLISECONDS_IN_SECOND
-
-                            # bitrate_sum += VIDEO_BIT_RATE[chunk_quality]
-                            # smoothness_diffs += abs(VIDEO_BIT_RATE[chunk_quality] - VIDEO_BIT_RATE[last_quality])
-                            if self.reward_func == "LIN":
-                                bitrate_sum += VIDEO_BIT_RATE[chunk_quality]
-                                smoothness_diffs += abs(
-                                    VIDEO_BIT_RATE[chunk_quality] - VIDEO_BIT_RATE[last_quality])
-                                last_quality = chunk_quality
-                            elif self.reward_func == "HD":
-                                bitrate_sum += BITRATE_REWARD[chunk_quality]
-                                smoothness_diffs += abs(
-                                    BITRATE_REWARD[chunk_quality] - BITRATE_REWARD[last_quality])
-                                last_quality = chunk_quality
-                            else:
-                                raise Exception
-                        # compute reward for this combination (one reward per 5-chunk combo)
-
-                        # bitrates are in Mbits/s, rebuffer in seconds, and smoothness_diffs in Mbits/s
+                    ho_rows.append((next_sat_id, next_download_bw, next_user_num, ho_index))
+
+        # Every (satellite, handover position) row scored in one pass, then picked in the order of the scan
+        if DIST_BATCH_SCORING and not DP_SEARCH and ho_rows:
+            combos, row_rewards = self.get_ho_row_rewards(chunk_sizes, ho_rows, cur_download_bw, start_buffer,
+                                                          self.last_quality[agent], future_chunk_length)
+        for row_id, (next_sat_id, next_download_bw, next_user_num, ho_index) in enumerate(ho_rows):
+            if DIST_BATCH_SCORING and not DP_SEARCH:
+                rewards = row_rewards[row_id]
+            else:
+                bws = [cur_download_bw if ho_index > position else next_download_bw
+                       for position in range(MPC_FUTURE_CHUNK_COUNT)]
+                # Give them a penalty
+                ho_delays = [HANDOVER_DELAY if ho_index == position else 0
+                             for position in range(MPC_FUTURE_CHUNK_COUNT)]
+                combos, rewards = self.get_user_combos(chunk_sizes, np.array([bws], dtype=float),
+                                                       np.array([ho_delays], dtype=float), start_buffer,
+                                                       self.last_quality[agent], future_chunk_length)
+            if centralized:
+                for agent_id in range(self.num_agents):
+                    if agent_id == agent or self.user_qoe_log[agent_id] == {}:
+                        continue
+                    qoe_log = self.user_qoe_log[agent_id]
+                    rewards = rewards + self.get_simulated_reward(qoe_log, last_index, ho_index,
+                                                                  self.cur_sat_id[agent], next_sat_id)
+                    # reward += qoe_log["reward"]
 
-                        # 10~140 - 0~100 - 0~130
-                        if self.reward_func == "LIN":
-                            reward = bitrate_sum * QUALITY_FACTOR / M_IN_K - (REBUF_PENALTY * curr_rebuffer_time) \
-                                     - SMOOTH_PENALTY * smoothness_diffs / M_IN_K
-                        elif self.reward_func == "HD":
-                            reward = bitrate_sum - (8 * curr_rebuffer_time) \
-                                     - smoothness_diffs
-                        else:
-                            raise Exception
-                        if centralized:
-                            for agent_id in range(self.num_agents):
-                                if agent_id == agent or self.user_qoe_log[agent_id] == {}:
-                                    continue
-                                qoe_log = self.user_qoe_log[agent_id]
-                                reward += self.get_simulated_reward(qoe_log, last_index, ho_index,
-                                                                    self.cur_sat_id[agent], next_sat_id)
-                                # reward += qoe_log["reward"]
-
-                        next_user_num = self.get_num_of_user_sat(self.mahimahi_ptr[agent], next_sat_id)
-
-                        if reward > max_reward:
-                            best_combo = combo
-                            max_reward = reward
-                            ho_sat_id = next_sat_id
-                            best_next_bw = next_download_bw
-                            best_next_num = next_user_num + 1
-                            ho_stamp = ho_index
-                            best_case = {"last_quality": last_quality, "cur_download_bw": cur_download_bw,
-                                         "start_buffer": start_buffer, "future_chunk_length": future_chunk_length,
-                                         "last_index": last_index, "combo": combo,
-                                         "next_download_bw": next_download_bw,
-                                         "ho_index": ho_index, "next_sat_id": next_sat_id, "reward": reward,
-                                         "cur_user_num": cur_user_num, "next_user_num": next_user_num,
-                                         "cur_sat_id": self.cur_sat_id[agent]}
-                        elif reward == max_reward and (combo[0] >= best_combo[0]):
-                            best_combo = combo
-                            max_reward = reward
-                            ho_sat_id = next_sat_id
-                            ho_stamp = ho_index
-                            best_next_bw = next_download_bw
-                            best_next_num = next_user_num + 1
-                            best_case = {"last_quality": last_quality, "cur_download_bw": cur_download_bw,
-                                         "start_buffer": start_buffer, "future_chunk_length": future_chunk_length,
-                                         "last_index": last_index, "combo": combo,
-                                         "next_download_bw": next_download_bw,
-                                         "ho_index": ho_index, "next_sat_id": next_sat_id, "reward": reward,
-                                         "cur_user_num": cur_user_num, "next_user_num": next_user_num,
-                                         "cur_sat_id": self.cur_sat_id[agent]}
+            best_index = select_best_combo(rewards, combos[:, 0, 0], max_reward, best_combo[0])
+            if best_index is None:
+                continue
+            best_combo = combos[best_index, 0, :future_chunk_length].tolist()
+            max_reward = rewards[best_index].item()
+            ho_sat_id = next_sat_id
+            best_next_bw = next_download_bw
+            best_next_num = next_user_num + 1
+            ho_stamp = ho_index
+            best_case = {"last_quality": best_combo[-1], "cur_download_bw": cur_download_bw,
+                         "start_buffer": start_buffer, "future_chunk_length": future_chunk_length,
+                         "last_index": last_index, "combo": best_combo,
+                         "next_download_bw": next_download_bw,
+                         "ho_index": ho_index, "next_sat_id": next_sat_id, "reward": max_reward,
+                         "cur_user_num": cur_user_num, "next_user_num": next_user_num,
+                         "cur_sat_id": self.cur_sat_id[agent]}
 
         self.user_qoe_log[agent] = best_case
         self.log.info("final decision (dual)", mahimahi_ptr=self.mahimahi_ptr[agent], cur_sat_id=self.cur_sat_id[agent],
@@ -3344,6 +3227,157 @@ class Environment:
 
         return ho_sat_id, ho_stamp, best_combo, max_reward
 
+    def get_ho_row_rewards(self, chunk_sizes, ho_rows, cur_download_bw, start_buffer, last_quality,
+                           future_chunk_length):
+        """
+        Rewards of the whole single-user combo table on every handover row of the distributed MPC, in a single
+        calculate_combo_rewards pass where the rows stand in for its users.
+
+        :return: the [C, 1, horizon] combo table and the [rows, C] rewards
+        """
+        combos = get_combo_table(1, MPC_FUTURE_CHUNK_COUNT)
+        bws = np.array([[cur_download_bw if ho_index > position else next_download_bw
+                         for position in range(MPC_FUTURE_CHUNK_COUNT)]
+                        for _, next_download_bw, _, ho_index in ho_rows], dtype=float)
+        # Give them a penalty
+        ho_delays = np.array([[HANDOVER_DELAY if ho_index == position else 0
+                               for position in range(MPC_FUTURE_CHUNK_COUNT)]
+                              for _, _, _, ho_index in ho_rows], dtype=float)
+        rewards = calculate_combo_rewards(np.broadcast_to(combos, (len(combos), len(ho_rows), MPC_FUTURE_CHUNK_COUNT)),
+                                          np.repeat(chunk_sizes, len(ho_rows), axis=0), bws, ho_delays,
+                                          [start_buffer] * len(ho_rows), [last_quality] * len(ho_rows),
+                                          [future_chunk_length] * len(ho_rows), self.reward_func)
+        self.profile.count("combos", len(combos) * len(ho_rows))
+        self.profile.count("combos_scored", len(combos) * len(ho_rows))
+        return combos, rewards.T
+
+    def get_ratio_terms(self, sat_id, user_list, combos_list, fixed_ratios, cur_sat_ids, runner_up_sat_ids,
+                        future_sat_user_nums, ho_positions, start_buffers, video_chunk_remain, cur_bws, next_bws):
+        """
+        objective_function for every combo of one handover plan as get_rebuffer terms, with the ratios
+        of sat_id left free. fixed_ratios maps a satellite to (user_list, [P, users] ratios); positions on
+        the other shared satellites split their bandwidth evenly, as objective_function does.
+        """
+        num_combos = len(combos_list)
+        offsets = np.full((num_combos, len(user_list), MPC_FUTURE_CHUNK_COUNT), -np.inf)
+        scales = np.zeros((num_combos, len(user_list), MPC_FUTURE_CHUNK_COUNT))
+        for user, agent_id in enumerate(user_list):
+            if cur_bws[agent_id] is None:
+                continue
+            qualities = np.array([combos[agent_id] for combos in combos_list], dtype=int)
+            curr_buffer = start_buffers[agent_id] * BUF_RATIO
+            last_index = int(CHUNK_TIL_VIDEO_END_CAP - video_chunk_remain[agent_id])
+
+            cur_sat_id = cur_sat_ids[agent_id]
+            next_sat_id = runner_up_sat_ids[agent_id]
+            if next_sat_id is None:
+                next_sat_id = cur_sat_id
+
+            fixed_time = np.zeros(num_combos)
+            free_time = np.zeros(num_combos)
+            for position in range(qualities.shape[1]):
+                index = last_index + position
+                cur_future_sat_user_num = future_sat_user_nums[cur_sat_id][position]
+                next_future_sat_user_num = future_sat_user_nums[next_sat_id][position]
+
+                now_sat_id = None
+                if ho_positions[agent_id] > position:
+                    if cur_future_sat_user_num > 1:
+                        now_sat_id = cur_sat_id
+                    harmonic_bw = cur_bws[agent_id]
+                elif ho_positions[agent_id] == position:
+                    if next_future_sat_user_num > 1:
+                        now_sat_id = next_sat_id
+                    harmonic_bw = next_bws[agent_id]
+                    fixed_time += HANDOVER_DELAY
+                else:
+                    if next_future_sat_user_num > 1:
+                        now_sat_id = next_sat_id
+                    harmonic_bw = next_bws[agent_id]
+
+                chunk_sizes = np.array([self.video_size[quality][index] for quality in range(BITRATE_LEVELS)])
+                download_time = (chunk_sizes[qualities[:, position]] / B_IN_MB) / harmonic_bw * BITS_IN_BYTE
+                if now_sat_id and now_sat_id == sat_id:
+                    free_time += download_time
+                elif now_sat_id and now_sat_id in fixed_ratios:
+                    fixed_users, ratios = fixed_ratios[now_sat_id]
+                    fixed_time += download_time / ratios[:, fixed_users.index(agent_id)]
+                elif now_sat_id:
+                    fixed_time += download_time * next_future_sat_user_num
+                else:
+                    fixed_time += download_time
+
+                offsets[:, user, position] = fixed_time - curr_buffer \
+                    - position * VIDEO_CHUNCK_LEN / MILLISECONDS_IN_SECOND
+                scales[:, user, position] = free_time
+        return offsets, scales
+
+    def get_warm_ratios(self, sat_id, user_list, num_combos):
+        if self.prev_best_user_info and sat_id in self.prev_best_user_info \
+                and list(self.prev_best_user_info[sat_id][2]) == user_list:
+            return np.tile(self.prev_best_user_info[sat_id][3], (num_combos, 1))
+        return None
+
+    def solve_user_ratios(self, combos_list, sat_user_lists, joint, *plan_vars):
+        """
+        Bandwidth ratios of each shared satellite for every combo of one handover plan, {sat_id: [P, users]}.
+
+        Satellites are solved in order, each seeing the ratios already solved, as the reduced MPC does.
+        With joint, every satellite is free at once like the single SLSQP call of the exhaustive MPC; that
+        only splits per satellite when no user is shared by two of them, otherwise SLSQP stays in charge.
+        A satellite whose users are the same as in the previous decision starts from the ratios chosen then.
+        """
+        num_combos = len(combos_list)
+        num_users = sum(len(user_list) for user_list in sat_user_lists.values())
+        if joint and len(set(itertools.chain(*sat_user_lists.values()))) < num_users:
+            return self.solve_joint_ratios(combos_list, sat_user_lists, *plan_vars)
+
+        sat_ratios = {}
+        for sat_id, user_list in sat_user_lists.items():
+            offsets, scales = self.get_ratio_terms(sat_id, user_list, combos_list, sat_ratios, *plan_vars)
+            x0 = self.get_warm_ratios(sat_id, user_list, num_combos)
+            sat_ratios[sat_id] = (user_list, solve_ratios(offsets, scales, x0))
+        return {sat_id: ratios for sat_id, (_, ratios) in sat_ratios.items()}
+
+    def solve_joint_ratios(self, combos_list, sat_user_lists, cur_sat_ids, runner_up_sat_ids, future_sat_user_nums,
+                           ho_positions, start_buffers, video_chunk_remain, cur_bws, next_bws):
+        user_info = {}
+        op_vars = []
+        op_vars_index = 0
+        const_array = []
+        for sat_id, user_list in sat_user_lists.items():
+            user_info[sat_id] = (op_vars_index, op_vars_index + len(user_list), user_list)
+            x0 = self.get_warm_ratios(sat_id, user_list, 1)
+            op_vars = [*op_vars, *([1 / len(user_list)] * len(user_list) if x0 is None else x0[0])]
+            const_array.append((op_vars_index, op_vars_index + len(user_list)))
+            op_vars_index += len(user_list)
+
+        constraints = []
+        for start, end in const_array:
+            data = np.zeros(op_vars_index)
+            data[start:end] = 1
+            constraints.append(LinearConstraint(data, lb=1, ub=1))
+        bounds = [(0 + EPSILON, 1 - EPSILON) for _ in range(op_vars_index)]
+
+        import warnings
+        warnings.filterwarnings("ignore")
+        sat_ratios = {sat_id: np.zeros((len(combos_list), len(user_list))) for sat_id, user_list in sat_user_lists.items()}
+        for combo_idx, combos in enumerate(combos_list):
+            ue_ratio = minimize(
+                self.objective_function,
+                x0=np.array(op_vars),
+                args=(combos, cur_sat_ids, runner_up_sat_ids, None,
+                      future_sat_user_nums, ho_positions, start_buffers,
+                      video_chunk_remain, cur_bws,
+                      next_bws, user_info, {}, None),
+                constraints=constraints,
+                bounds=bounds,
+                method="SLSQP"  # or BFGS
+            )
+            for sat_id in sat_user_lists:
+                sat_ratios[sat_id][combo_idx] = ue_ratio.x[user_info[sat_id][0]:user_info[sat_id][1]]
+        return sat_ratios
+
     def objective_function(self, x, combos, cur_sat_ids, runner_up_sat_ids, sat_user_nums,
                            future_sat_user_nums, ho_positions, start_buffers, video_chunk_remain,
                            cur_bws, next_bws, user_info, bw_ratio, best_bws):
@@ -3592,31 +3626,25 @@ class Environment:
         return ho_sat_id, ho_stamp, best_combo, max_reward
     """
 
+    def update_holt_state(self, key, samples, shape):
+        # Feed only the samples not seen yet. A series shorter than last time means a new trace or a
+        # restored snapshot, which starts over from the last MPC_PAST_CHUNK_COUNT samples. A handover empties
+        # download_bw and drops its state, so the new satellite does not inherit the old one's.
+        state, seen = self.holt_states.get(key, (None, 0))
+        if state is None or seen > len(samples):
+            state, seen = new_holt_state(shape), max(0, len(samples) - MPC_PAST_CHUNK_COUNT)
+        state = holt_update(state, samples[seen:], *self.holt_params)
+        self.holt_states[key] = (state, len(samples))
+        return state
+
     def predict_download_bw_holt_winter(self, agent, m=172):
         cur_sat_past_list = self.download_bw[agent]
         if len(cur_sat_past_list) <= 1:
             return self.download_bw[agent][-1]
-        past_bws = cur_sat_past_list[-MPC_PAST_CHUNK_COUNT:]
-        # past_bws = cur_sat_past_list
-        # print(past_bws)
-        while past_bws[0] == 0.0:
-            past_bws = past_bws[1:]
-
-        cur_sat_past_bws = pd.Series(past_bws)
-        cur_sat_past_bws.index.freq = 's'
-
-        # alpha = 1 / (2 * m)
-        fitted_model = ExponentialSmoothing(
-            cur_sat_past_bws, trend='add').fit()
-        # fitted_model = ExponentialSmoothing(cur_sat_past_bws, trend='mul').fit()
-
-        # fitted_model = ExponentialSmoothing(cur_sat_past_bws
-        # test_predictions = fitted_model.forecast(3)
-        test_predictions = fitted_model.forecast(1)
-
-        pred_bw = sum(test_predictions) / len(test_predictions)
-
-        return pred_bw
+        state = self.update_holt_state(("download", agent), cur_sat_past_list, ())
+        if state[2] < 2:
+            return cur_sat_past_list[-1]
+        return float(holt_forecast(state))
 
     def get_runner_up_sat_id(self, agent, method="holt-winter", mahimahi_ptr=None, cur_sat_id=None, past_len=None):
         best_sat_id = None
@@ -3626,6 +3654,8 @@ class Environment:
         if cur_sat_id is None:
             cur_sat_id = self.cur_sat_id[agent]
 
+        if method == "holt-winter":
+            holt_bws = self.predict_bws_holt_winter(agent)
         for sat_id, sat_bw in self.cooked_bw.items():
             real_sat_bw = None
 
@@ -3637,7 +3667,8 @@ class Environment:
                 target_sat_bw = self.predict_bw_num(sat_id, agent, mahimahi_ptr=mahimahi_ptr, past_len=past_len)
                 real_sat_bw = target_sat_bw  # / (self.get_num_of_user_sat(sat_id) + 1)
             elif method == "holt-winter":
-                target_sat_bw = self.predict_bw_holt_winter(sat_id, agent, num=1)
+                target_sat_bw = holt_bws[sat_id]
+                real_sat_bw = target_sat_bw
                 # target_sat_bw = sum(target_sat_bw) / len(target_sat_bw)
             else:
                 print("Cannot happen")
@@ -3651,125 +3682,91 @@ class Environment:
         return best_sat_id, best_sat_bw
 
     def predict_bw_holt_winter(self, sat_id, agent, num=1):
-        start_index = self.mahimahi_ptr[agent] - MPC_PAST_CHUNK_COUNT
-        cur_sat_past_list = []
-        if start_index < 0:
-            for i in range(0, start_index + MPC_PAST_CHUNK_COUNT):
-                cur_sat_past_list.append(
-                    self.cooked_bw[sat_id][0:start_index + MPC_PAST_CHUNK_COUNT] / self.get_num_of_user_sat(sat_id))
-        else:
-            for i in range(start_index, start_index + MPC_PAST_CHUNK_COUNT):
-                cur_sat_past_list.append(
-                    self.cooked_bw[sat_id][0:start_index + MPC_PAST_CHUNK_COUNT] / self.get_num_of_user_sat(sat_id))
-
-        while len(cur_sat_past_list) != 0 and cur_sat_past_list[0] == 0.0:
-            cur_sat_past_list = cur_sat_past_list[1:]
-
-        if len(cur_sat_past_list) <= 1:
-            # Just past bw
-            return self.cooked_bw[sat_id][self.mahimahi_ptr[agent] - 1] / self.get_num_of_user_sat(sat_id)
-        cur_sat_past_bws = pd.Series(cur_sat_past_list)
-        cur_sat_past_bws.index.freq = 's'
-
-        # alpha = 1 / (2 * m)
-        fitted_model = ExponentialSmoothing(
-            cur_sat_past_bws, trend='add').fit()
-        # fitted_model = ExponentialSmoothing(cur_sat_past_bws, trend='mul').fit()
-
-        # fitted_model = ExponentialSmoothing(cur_sat_past_bws
-        test_predictions = fitted_model.forecast(1)
-        # test_predictions = fitted_model.forecast(num)
+        return self.predict_bws_holt_winter(agent, [sat_id])[sat_id]
 
-        pred_bw = sum(test_predictions) / len(test_predictions)
+    def predict_bws_holt_winter(self, agent, sat_ids=None):
+        # One Holt state per satellite for each agent, all moved forward together along the trace
+        trace_sat_ids, sat_rows, bw_matrix, _ = get_trace_matrix(self.cooked_bw)
+        mahimahi_ptr = self.mahimahi_ptr[agent]
+        state = self.update_holt_state(("sat", agent), bw_matrix[:, :mahimahi_ptr].T, len(trace_sat_ids))
+        forecasts = holt_forecast(state)
 
-        return pred_bw
-        # return list(test_predictions)
+        pred_bws = {}
+        for sat_id in (trace_sat_ids if sat_ids is None else sat_ids):
+            row = sat_rows[sat_id]
+            num_of_user_sat = self.get_num_of_user_sat(mahimahi_ptr, sat_id)
+            if num_of_user_sat == 0:
+                num_of_user_sat = 1
+            if state[2][row] < 2:
+                # Just past bw
+                pred_bws[sat_id] = bw_matrix[row, mahimahi_ptr - 1] / num_of_user_sat
+            else:
+                pred_bws[sat_id] = float(forecasts[row]) / num_of_user_sat
+        return pred_bws
 
     def calculate_mpc(self, video_chunk_remain, start_buffer, last_index, cur_download_bw, agent, centralized=False):
         max_reward = -10000000
         best_combo = ()
-        chunk_combo_option = []
         best_case = {}
 
-        # make chunk combination options
-        for combo in itertools.product(list(range(int(BITRATE_LEVELS / BITRATE_WEIGHT))),
-                                       repeat=MPC_FUTURE_CHUNK_COUNT):
-            chunk_combo_option.append(list([BITRATE_WEIGHT * x for x in combo]))
         cur_user_num = self.get_num_of_user_sat(self.mahimahi_ptr[agent], self.cur_sat_id[agent])
         future_chunk_length = MPC_FUTURE_CHUNK_COUNT
         if video_chunk_remain < MPC_FUTURE_CHUNK_COUNT:
             future_chunk_length = video_chunk_remain
 
-        for full_combo in chunk_combo_option:
-            # Break at the end of the chunk
-            combo = full_combo[0: future_chunk_length]
-            # calculate total rebuffer time for this combination (start with start_buffer and subtract
-            # each download time and add 2 seconds in that order)
-            curr_rebuffer_time = 0
-            curr_buffer = start_buffer
-            bitrate_sum = 0
-            smoothness_diffs = 0
-            last_quality = self.last_quality[agent]
-
-            for position in range(0, len(combo)):
-                chunk_quality = combo[position]
-                index = last_index + position  # e.g., if last chunk is 3, then first iter is 3+0+1=4
-                download_time = 0
-                download_time += (self.video_size[chunk_quality][index] / B_IN_MB) \
-                                 / cur_download_bw * BITS_IN_BYTE  # this is MB/MB/s --> seconds
-
-                if curr_buffer < download_time:
-                    curr_rebuffer_time += (download_time - curr_buffer)
-                    curr_buffer = 0.0
-                else:
-                    curr_buffer -= download_time
-                curr_buffer += VIDEO_CHUNCK_LEN / MILLISECONDS_IN_SECOND
+        chunk_sizes = get_chunk_sizes(self.video_size, [last_index], [future_chunk_length], MPC_FUTURE_CHUNK_COUNT)
+        combos, rewards = self.get_user_combos(chunk_sizes, np.full((1, MPC_FUTURE_CHUNK_COUNT), cur_download_bw),
+                                               np.zeros((1, MPC_FUTURE_CHUNK_COUNT)), start_buffer,
+                                               self.last_quality[agent], future_chunk_length)
+
+        best_index = select_best_combo(rewards, combos[:, 0, 0], max_reward, -1)
+        if best_index is not None:
+            best_combo = combos[best_index, 0, :future_chunk_length].tolist()
+            max_reward = rewards[best_index].item()
+            best_case = {"last_quality": best_combo[-1], "cur_download_bw": cur_download_bw,
+                         "start_buffer": start_buffer, "future_chunk_length": future_chunk_length,
+                         "last_index": last_index, "combo": best_combo, "next_download_bw": None,
+                         "ho_index": MPC_FUTURE_CHUNK_COUNT, "next_sat_id": None, "reward": max_reward,
+                         "cur_user_num": cur_user_num, "cur_sat_id": self.cur_sat_id[agent], "next_user_num": 0}
 
-                # bitrate_sum += VIDEO_BIT_RATE[chunk_quality]
-                # smoothness_diffs += abs(VIDEO_BIT_RATE[chunk_quality] - VIDEO_BIT_RATE[last_quality])
-                if self.reward_func == "LIN":
-                    bitrate_sum += VIDEO_BIT_RATE[chunk_quality]
-                    smoothness_diffs += abs(
-                        VIDEO_BIT_RATE[chunk_quality] - VIDEO_BIT_RATE[last_quality])
-                    last_quality = chunk_quality
-                elif self.reward_func == "HD":
-                    bitrate_sum += BITRATE_REWARD[chunk_quality]
-                    smoothness_diffs += abs(
-                        BITRATE_REWARD[chunk_quality] - BITRATE_REWARD[last_quality])
-                    last_quality = chunk_quality
-                else:
-                    raise Exception
-            # compute reward for this combination (one reward per 5-chunk combo)
-
-            # bitrates are in Mbits/s, rebuffer in seconds, and smoothness_diffs in Mbits/s
-
-            # 10~140 - 0~100 - 0~130
-            if self.reward_func == "LIN":
-                reward = bitrate_sum * QUALITY_FACTOR / M_IN_K - (REBUF_PENALTY * curr_rebuffer_time) \
-                         - SMOOTH_PENALTY * smoothness_diffs / M_IN_K
-            elif self.reward_func == "HD":
-                reward = bitrate_sum - (8 * curr_rebuffer_time) \
-                         - smoothness_diffs
-            else:
-                raise Exception
+        return best_combo, max_reward, best_case
 
-            if reward > max_reward:
-                best_combo = combo
-                max_reward = reward
-                best_case = {"last_quality": last_quality, "cur_download_bw": cur_download_bw,
-                             "start_buffer": start_buffer, "future_chunk_length": future_chunk_length,
-                             "last_index": last_index, "combo": combo, "next_download_bw": None,
-                             "ho_index": MPC_FUTURE_CHUNK_COUNT, "next_sat_id": None, "reward": reward,
-                             "cur_user_num": cur_user_num, "cur_sat_id": self.cur_sat_id[agent], "next_user_num": 0}
-            elif reward == max_reward and (combo[0] >= best_combo[0]):
-                best_combo = combo
-                max_reward = reward
-                best_case = {"last_quality": last_quality, "cur_download_bw": cur_download_bw,
-                             "start_buffer": start_buffer, "future_chunk_length": future_chunk_length,
-                             "last_index": last_index, "combo": combo, "next_download_bw": None,
-                             "ho_index": MPC_FUTURE_CHUNK_COUNT, "next_sat_id": None, "reward": reward,
-                             "cur_user_num": cur_user_num, "cur_sat_id": self.cur_sat_id[agent], "next_user_num": 0}
+    def get_user_combos(self, chunk_sizes, bws, ho_delays, start_buffer, last_quality, future_chunk_length):
+        """
+        Single-user combos to pick from with select_best_combo and their rewards, for one bandwidth schedule.
 
+        :return: the whole [C, 1, horizon] combo table and its rewards, or with DP_SEARCH the one combo of the
+                 dynamic program
+        """
+        self.profile.count("combos", BITRATE_LEVELS ** MPC_FUTURE_CHUNK_COUNT)
+        if DP_SEARCH:
+            combos, rewards = solve_best_combo(chunk_sizes, bws, ho_delays, [start_buffer], [last_quality],
+                                               [future_chunk_length], self.reward_func, [None], dp=True)
+        else:
+            combos = get_combo_table(1, MPC_FUTURE_CHUNK_COUNT)
+            rewards = calculate_combo_rewards(combos, chunk_sizes, bws, ho_delays, [start_buffer], [last_quality],
+                                              [future_chunk_length], self.reward_func)
+        self.profile.count("combos_scored", len(combos))
+        return combos, rewards[:, 0]
+
+    def calculate_mpc_fast(self, video_chunk_remain, start_buffer, last_index, cur_download_bw, agent):
+        # calculate_mpc answered from the FastMPC table of this manifest and reward function, built beforehand
+        # with python -m util.fastmpc
+        if self.fastmpc_table is None:
+            self.fastmpc_table = get_fastmpc_table(self.video_size, self.reward_func)
+        best_combo, max_reward = self.fastmpc_table.lookup(video_chunk_remain, self.last_quality[agent], start_buffer,
+                                                           cur_download_bw)
+        # Answered from the table, no combo is scored online
+        self.profile.count("combos", BITRATE_LEVELS ** MPC_FUTURE_CHUNK_COUNT)
+        best_case = {}
+        if best_combo:
+            future_chunk_length = len(best_combo)
+            best_case = {"last_quality": best_combo[-1], "cur_download_bw": cur_download_bw,
+                         "start_buffer": start_buffer, "future_chunk_length": future_chunk_length,
+                         "last_index": last_index, "combo": best_combo, "next_download_bw": None,
+                         "ho_index": MPC_FUTURE_CHUNK_COUNT, "next_sat_id": None, "reward": max_reward,
+                         "cur_user_num": self.get_num_of_user_sat(self.mahimahi_ptr[agent], self.cur_sat_id[agent]),
+                         "cur_sat_id": self.cur_sat_id[agent], "next_user_num": 0}
         return best_combo, max_reward, best_case
 
     def predict_download_bw(self, agent, robustness=False):
@@ -3824,14 +3821,14 @@ class Environment:
                 if mahimahi_ptr - i > 0:
                     self.predict_bw(sat_id, agent, robustness, mahimahi_ptr=mahimahi_ptr - i)
 
-        # num_of_user_sat = len(self.cur_satellite[sat_id].get_ue_list()) + 1
+        # The trace window is shared by all users, only the SNR factor is per user
+        prev_bw, cur_bw, nonzero_bws, _ = self.get_window_stats(sat_id, mahimahi_ptr)
+        snr_noise = self.cur_user[agent].get_snr_noise()
 
-        # past_bw = self.cooked_bw[self.cur_sat_id][self.mahimahi_ptr - 1]
-
-        past_bw = self.cur_satellite[sat_id].data_rate_unshared(mahimahi_ptr - 1, self.cur_user[agent])
+        past_bw = prev_bw * snr_noise
 
         if past_bw == 0:
-            return self.cur_satellite[sat_id].data_rate_unshared(mahimahi_ptr, self.cur_user[agent])
+            return cur_bw * snr_noise
 
         if sat_id in self.past_bw_ests[agent].keys() and len(self.past_bw_ests[agent][sat_id]) > 0:
             curr_error = abs(self.past_bw_ests[agent][sat_id][-1] - past_bw) / float(past_bw)
@@ -3841,28 +3838,15 @@ class Environment:
 
         # pick bitrate according to MPC
         # first get harmonic mean of last 5 bandwidths
-        start_index = mahimahi_ptr - MPC_PAST_CHUNK_COUNT
-        if start_index < 0:
-            start_index = 0
-
-        past_bws = []
-        for index in range(start_index, mahimahi_ptr):
-            past_bws.append(self.cur_satellite[sat_id].data_rate_unshared(index, self.cur_user[agent]))
         # Newly possible satellite case
-        if all(v == 0.0 for v in past_bws):
-            return self.cur_satellite[sat_id].data_rate_unshared(mahimahi_ptr, self.cur_user[agent])
-
-        while past_bws[0] == 0.0:
-            past_bws = past_bws[1:]
+        if nonzero_bws is None:
+            return cur_bw * snr_noise
 
         bandwidth_sum = 0
-        bandwidth_index = 0
-        for past_val in past_bws:
-            if past_val != 0:
-                bandwidth_sum += (1 / float(past_val))
-                bandwidth_index += 1
+        for past_val in nonzero_bws:
+            bandwidth_sum += (1 / float(past_val * snr_noise))
 
-        harmonic_bw = 1.0 / (bandwidth_sum / bandwidth_index)
+        harmonic_bw = 1.0 / (bandwidth_sum / len(nonzero_bws))
 
         if sat_id not in self.past_bw_ests[agent].keys():
             self.past_bw_ests[agent][sat_id] = []
@@ -3893,13 +3877,10 @@ class Environment:
                 if mahimahi_ptr - i > 0:
                     self.predict_bw_num(sat_id, agent, robustness, mahimahi_ptr=mahimahi_ptr - i)
 
-        num_of_user_sat = len(self.cur_satellite[sat_id].get_ue_list(mahimahi_ptr))
+        num_of_user_sat = self.get_user_num(sat_id, mahimahi_ptr)
 
         # past_bw = self.cooked_bw[self.cur_sat_id][self.mahimahi_ptr - 1]
-        if num_of_user_sat == 0:
-            past_bw = self.cooked_bw[sat_id][mahimahi_ptr]
-        else:
-            past_bw = self.cooked_bw[sat_id][mahimahi_ptr] / num_of_user_sat
+        _, past_bw, _, harmonic_bw = self.get_window_stats(sat_id, mahimahi_ptr, num_of_user_sat)
 
         if past_bw == 0:
             return 0
@@ -3912,35 +3893,9 @@ class Environment:
 
         # pick bitrate according to MPC
         # first get harmonic mean of last 5 bandwidths
-        start_index = mahimahi_ptr - MPC_PAST_CHUNK_COUNT
-        if start_index < 0:
-            start_index = 0
-
-        past_bws = []
-        for index in range(start_index, mahimahi_ptr):
-            if num_of_user_sat == 0:
-                past_bws.append(self.cooked_bw[sat_id][index])
-            else:
-                past_bws.append(self.cooked_bw[sat_id][index] / num_of_user_sat)
-
         # Newly possible satellite case
-        if all(v == 0.0 for v in past_bws):
-            if num_of_user_sat == 0:
-                return self.cooked_bw[sat_id][mahimahi_ptr]
-            else:
-                return self.cooked_bw[sat_id][mahimahi_ptr] / num_of_user_sat
-
-        while past_bws[0] == 0.0:
-            past_bws = past_bws[1:]
-
-        bandwidth_sum = 0
-        bandwidth_index = 0
-        for past_val in past_bws:
-            if past_val != 0:
-                bandwidth_sum += (1 / float(past_val))
-                bandwidth_index += 1
-
-        harmonic_bw = 1.0 / (bandwidth_sum / bandwidth_index)
+        if harmonic_bw is None:
+            return past_bw
 
         if sat_id not in self.past_bw_ests[agent].keys():
             self.past_bw_ests[agent][sat_id] = []
@@ -4061,6 +4016,7 @@ class Environment:
     def update_sat_info(self, sat_id, mahimahi_ptr, agent, variation):
         # update sat info
         self.log.debug("update_sat_info", agent=agent, sat_id=sat_id, mahimahi_ptr=mahimahi_ptr, variation=variation)
+        self.user_num_cache.clear()
         if variation == 1:
             self.cur_satellite[sat_id].add_ue(agent, mahimahi_ptr)
             self.cur_user[agent].update_sat_log(sat_id, mahimahi_ptr)
@@ -4084,10 +4040,58 @@ class Environment:
                     filtered_num_of_user_sat[tmp_sat_id] = len(self.cur_satellite[tmp_sat_id].get_ue_list(mahimahi_ptr))
             return filtered_num_of_user_sat
         if sat_id in self.cur_satellite.keys():
-            return len(self.cur_satellite[sat_id].get_ue_list(mahimahi_ptr))
+            return self.get_user_num(sat_id, mahimahi_ptr)
 
         return 0
 
+    def get_user_num(self, sat_id, mahimahi_ptr):
+        # Replaying the connection log is costly, keep the count until the connections change
+        key = (sat_id, mahimahi_ptr)
+        if key in self.user_num_cache:
+            self.pred_cache_hits += 1
+            return self.user_num_cache[key]
+        self.pred_cache_misses += 1
+        user_num = len(self.cur_satellite[sat_id].get_ue_list(mahimahi_ptr))
+        self.user_num_cache[key] = user_num
+        return user_num
+
+    def get_window_stats(self, sat_id, mahimahi_ptr, user_count=0):
+        # Trace statistics behind predict_bw/predict_bw_num, divided by user_count if any:
+        # (bw at ptr - 1, bw at ptr, non-zero bws of the past window or None, their harmonic mean)
+        key = (sat_id, mahimahi_ptr, user_count)
+        if key in self.window_cache:
+            self.pred_cache_hits += 1
+            return self.window_cache[key]
+        self.pred_cache_misses += 1
+
+        sat_bw = self.cooked_bw[sat_id]
+        start_index = mahimahi_ptr - MPC_PAST_CHUNK_COUNT
+        if start_index < 0:
+            start_index = 0
+        if user_count == 0:
+            past_bws = [sat_bw[index] for index in range(start_index, mahimahi_ptr)]
+            prev_bw, cur_bw = sat_bw[mahimahi_ptr - 1], sat_bw[mahimahi_ptr]
+        else:
+            past_bws = [sat_bw[index] / user_count for index in range(start_index, mahimahi_ptr)]
+            prev_bw, cur_bw = sat_bw[mahimahi_ptr - 1] / user_count, sat_bw[mahimahi_ptr] / user_count
+
+        nonzero_bws = tuple(past_val for past_val in past_bws if past_val != 0) or None
+        harmonic_bw = None
+        if nonzero_bws:
+            bandwidth_sum = 0
+            for past_val in nonzero_bws:
+                bandwidth_sum += (1 / float(past_val))
+            harmonic_bw = 1.0 / (bandwidth_sum / len(nonzero_bws))
+
+        stats = (prev_bw, cur_bw, nonzero_bws, harmonic_bw)
+        self.window_cache[key] = stats
+        return stats
+
+    def get_pred_cache_stats(self):
+        total = self.pred_cache_hits + self.pred_cache_misses
+        return {"hits": self.pred_cache_hits, "misses": self.pred_cache_misses,
+                "hit_rate": self.pred_cache_hits / total if total else 0}
+
     def set_satellite(self, agent, sat=0, sat_id=None):
         if sat_id is None:
             sat_id = self.next_sat_id[agent]
@@ -4104,29 +4108,25 @@ class Environment:
             self.prev_sat_id[agent] = self.cur_sat_id[agent]
             self.cur_sat_id[agent] = sat_id
             self.download_bw[agent] = []
+            self.holt_states.pop(("download", agent), None)
             self.delay[agent] = HANDOVER_DELAY
             return sat_id
 
 
+    def snapshot(self):
+        # Compact record of the mutable episode state (pointers, buffers, counters, connections,
+        # predictor state and RNG). Traces and video sizes are shared, never copied.
+        return SNAPSHOT_FIELDS.snapshot(self)
+
+    def restore(self, token):
+        SNAPSHOT_FIELDS.restore(self, token, SAT_STRATEGY)
+        self.user_num_cache.clear()
+
     def froze_num_of_user_sat(self):
-        self.stored_num_of_user_sat = copy.deepcopy(self.num_of_user_sat)
-        self.stored_mahimahi_ptr = copy.deepcopy(self.mahimahi_ptr)
-        self.stored_last_mahimahi_time = copy.deepcopy(self.last_mahimahi_time)
-        self.stored_buffer_size = copy.deepcopy(self.buffer_size)
-        self.stored_video_chunk_counter = copy.deepcopy(self.video_chunk_counter)
-        self.stored_cur_sat_id = copy.deepcopy(self.cur_sat_id)
-        self.stored_cur_satellite = copy.deepcopy(self.cur_satellite)
-        self.stored_cur_user = copy.deepcopy(self.cur_user)
+        self.stored_snapshot = self.snapshot()
 
     def restore_num_of_user_sat(self):
-        self.num_of_user_sat = self.stored_num_of_user_sat
-        self.mahimahi_ptr = self.stored_mahimahi_ptr
-        self.last_mahimahi_time = self.stored_last_mahimahi_time
-        self.buffer_size = self.stored_buffer_size
-        self.video_chunk_counter = self.stored_video_chunk_counter
-        self.cur_sat_id = self.stored_cur_sat_id
-        self.cur_satellite = copy.deepcopy(self.stored_cur_satellite)
-        self.cur_user = copy.deepcopy(self.stored_cur_user)
+        self.restore(self.stored_snapshot)
 
     def get_others_reward(self, agent, last_bit_rate):
         reward = 0
@@ -4225,3 +4225,291 @@ class Environment:
         reward = REBUF_PENALTY * rebuf / MILLISECONDS_IN_SECOND
 
         return reward
+
+
+class OracleRollout:
+    """
+    Stripped-down copy of the episode state for oracle planning.
+
+    It replays get_video_chunk_oracle_v2 on the true trace without logging and without touching the
+    environment, so every (combo, handover plan) pair is scored without a snapshot/restore round trip.
+    Pairs that agree on their next chunk decision share its simulation.
+    """
+
+    def __init__(self, env, last_quality):
+        self.env = env
+        self.cooked_time = env.cooked_time
+        self.cooked_bw = env.cooked_bw
+        self.video_size = env.video_size
+        self.sat_bws = {sat_id: sat.sat_bw for sat_id, sat in env.cur_satellite.items()}
+        self.noise = [user.get_snr_noise() for user in env.cur_user]
+        self.end_of_video = list(env.end_of_video)
+        self.sharing_models = {sat_id: sat.sharing_model for sat_id, sat in env.cur_satellite.items()}
+        self.ratio_logs = {}
+        for sat_id, sat in env.cur_satellite.items():
+            ratio_ptrs = sorted(sat.data_rate_ratio_log.keys())
+            self.ratio_logs[sat_id] = (ratio_ptrs, [sat.data_rate_ratio_log[ptr] for ptr in ratio_ptrs])
+
+        self.mahimahi_ptr = list(env.mahimahi_ptr)
+        self.last_mahimahi_time = list(env.last_mahimahi_time)
+        self.buffer_size = list(env.buffer_size)
+        self.video_chunk_counter = list(env.video_chunk_counter)
+        self.cur_sat_id = list(env.cur_sat_id)
+        self.prev_sat_id = list(env.prev_sat_id)
+        self.last_quality = list(last_quality)
+        # sat_id -> (log pointers, their (is_add, agent) events, connected UEs from each pointer on)
+        self.conns = {sat_id: self.get_conn_table(sorted(sat.conn_use_log.items()))
+                      for sat_id, sat in env.cur_satellite.items()}
+        self.bitrate_sum = 0
+        self.smoothness_diff = 0
+        self.rebuf_time = 0
+        self.avg_bws = ()
+        # Shared by every fork: pairs scored so far, so a decision budget never stops the search empty-handed
+        self.progress = {"scored": 0}
+
+    def fork(self):
+        child = copy.copy(self)
+        for name in ("mahimahi_ptr", "last_mahimahi_time", "buffer_size", "video_chunk_counter", "cur_sat_id",
+                     "prev_sat_id", "last_quality"):
+            setattr(child, name, list(getattr(self, name)))
+        return child
+
+    @staticmethod
+    def get_conn_table(conn_logs):
+        ptrs = [ptr for ptr, _ in conn_logs]
+        events = [tuple((elem[0], elem[1]) for elem in logs) for _, logs in conn_logs]
+        ue_sets = []
+        ue_set = frozenset()
+        for logs in events:
+            for is_add, user_id in logs:
+                ue_set = ue_set | {user_id} if is_add else ue_set - {user_id}
+            ue_sets.append(ue_set)
+        return ptrs, events, ue_sets
+
+    def get_ue_set(self, sat_id, mahimahi_ptr):
+        ptrs, _, ue_sets = self.conns[sat_id]
+        index = bisect.bisect_right(ptrs, round(mahimahi_ptr, 3))
+        return ue_sets[index - 1] if index else frozenset()
+
+    def update_sat_info(self, sat_id, mahimahi_ptr, agent, variation):
+        # Copy on write, the tables are shared with the parent rollout
+        mahimahi_ptr = round(mahimahi_ptr, 3)
+        ptrs, events, _ = self.conns[sat_id]
+        conn_logs = list(zip(ptrs, events))
+        index = bisect.bisect_left(ptrs, mahimahi_ptr)
+        if index < len(ptrs) and ptrs[index] == mahimahi_ptr:
+            conn_logs[index] = (mahimahi_ptr, events[index] + ((variation == 1, agent),))
+        else:
+            conn_logs.insert(index, (mahimahi_ptr, ((variation == 1, agent),)))
+        self.conns = dict(self.conns)
+        self.conns[sat_id] = self.get_conn_table(conn_logs)
+
+    def data_rate(self, agent, sat_id, mahimahi_ptr):
+        # Satellite.data_rate on the rollout's connections
+        if mahimahi_ptr < 0:
+            mahimahi_ptr = 0
+        if mahimahi_ptr >= len(self.sat_bws[sat_id]):
+            raise Exception
+        dr_ue_unshared = self.sat_bws[sat_id][mahimahi_ptr] * self.noise[agent]
+        ue_set = self.get_ue_set(sat_id, mahimahi_ptr)
+        num_conn_ues = len(ue_set) if ue_set else 1
+        if self.sharing_models[sat_id] == 'resource-fair':
+            return dr_ue_unshared / num_conn_ues
+
+        ratio_ptrs, ratio_logs = self.ratio_logs[sat_id]
+        index = bisect.bisect_right(ratio_ptrs, mahimahi_ptr)
+        data_rate_ratio = ratio_logs[index - 1] if index else {}
+        if agent not in data_rate_ratio or set(data_rate_ratio.keys()) != ue_set:
+            return dr_ue_unshared / num_conn_ues
+        return dr_ue_unshared * data_rate_ratio[agent]
+
+    def get_best_sat_id(self, agent, mahimahi_ptr):
+        best_sat_id = None
+        best_sat_bw = 0
+        for sat_id in self.cooked_bw.keys():
+            real_sat_bw = self.data_rate(agent, sat_id, mahimahi_ptr)
+            if best_sat_bw < real_sat_bw:
+                best_sat_id = sat_id
+                best_sat_bw = real_sat_bw
+        return best_sat_id
+
+    def predict_bw_num(self, sat_id, agent, mahimahi_ptr):
+        # Environment.predict_bw_num with robustness. A rollout asks at most once per agent, so the
+        # error appended by that call is never read back and the environment logs stay untouched.
+        if mahimahi_ptr <= 0:
+            return self.sat_bws[sat_id][0] * self.noise[agent]
+        num_of_user_sat = len(self.get_ue_set(sat_id, mahimahi_ptr))
+        _, past_bw, _, harmonic_bw = self.env.get_window_stats(sat_id, mahimahi_ptr, num_of_user_sat)
+        if past_bw == 0:
+            return 0
+        past_bw_ests = self.env.past_bw_ests[agent].get(sat_id)
+        curr_error = abs(past_bw_ests[-1] - past_bw) / float(past_bw) if past_bw_ests else 0
+        if harmonic_bw is None:
+            return past_bw
+        past_bw_errors = [*self.env.past_bw_errors[agent].get(sat_id, []), curr_error]
+        max_error = float(max(past_bw_errors[-MPC_PAST_CHUNK_COUNT:]))
+        return harmonic_bw / (1 + max_error)
+
+    def get_runner_up_sat_id(self, agent):
+        best_sat_id = None
+        best_sat_bw = 0
+        for sat_id in self.cooked_bw.keys():
+            if sat_id == self.cur_sat_id[agent] or sat_id == self.prev_sat_id[agent]:
+                continue
+            real_sat_bw = self.predict_bw_num(sat_id, agent, self.mahimahi_ptr[agent])
+            if best_sat_bw < real_sat_bw:
+                best_sat_id = sat_id
+                best_sat_bw = real_sat_bw
+        return best_sat_id
+
+    def get_first_agent(self):
+        user = -1
+        for agent in range(len(self.end_of_video)):
+            if not self.end_of_video[agent]:
+                if user == -1 or self.last_mahimahi_time[agent] < self.last_mahimahi_time[user]:
+                    user = agent
+        return user
+
+    def download(self, quality, agent, ho_stamp):
+        # get_video_chunk_oracle_v2 followed by the QoE bookkeeping of the oracle MPC
+        end_of_network = False
+        video_chunk_size = self.video_size[quality][self.video_chunk_counter[agent]]
+        delay = 0
+        video_chunk_counter_sent = 0
+
+        if ho_stamp == 0:
+            delay += HANDOVER_DELAY
+            runner_up_sat_id = self.get_runner_up_sat_id(agent)
+            self.update_sat_info(self.cur_sat_id[agent], self.mahimahi_ptr[agent], agent, -1)
+            self.update_sat_info(runner_up_sat_id, self.mahimahi_ptr[agent], agent, 1)
+            self.cur_sat_id[agent] = runner_up_sat_id
+
+        while True:
+            throughput = self.data_rate(agent, self.cur_sat_id[agent], self.mahimahi_ptr[agent]) \
+                * B_IN_MB / BITS_IN_BYTE
+            if throughput == 0.0:
+                next_sat_id = self.get_best_sat_id(agent, self.mahimahi_ptr[agent])
+                self.update_sat_info(self.cur_sat_id[agent], self.last_mahimahi_time[agent], agent, -1)
+                self.update_sat_info(next_sat_id, self.last_mahimahi_time[agent], agent, 1)
+                self.prev_sat_id[agent] = self.cur_sat_id[agent]
+                self.cur_sat_id[agent] = next_sat_id
+                delay += HANDOVER_DELAY
+                throughput = self.data_rate(agent, self.cur_sat_id[agent], self.mahimahi_ptr[agent]) \
+                    * B_IN_MB / BITS_IN_BYTE
+
+            duration = self.cooked_time[self.mahimahi_ptr[agent]] - self.last_mahimahi_time[agent]
+            packet_payload = throughput * duration * PACKET_PAYLOAD_PORTION
+
+            if video_chunk_counter_sent + packet_payload > video_chunk_size:
+                fractional_time = (video_chunk_size - video_chunk_counter_sent) / \
+                                  throughput / PACKET_PAYLOAD_PORTION
+                delay += fractional_time
+                self.last_mahimahi_time[agent] += fractional_time
+                break
+
+            video_chunk_counter_sent += packet_payload
+            delay += duration
+            self.last_mahimahi_time[agent] = self.cooked_time[self.mahimahi_ptr[agent]]
+            self.mahimahi_ptr[agent] += 1
+
+            if self.mahimahi_ptr[agent] >= len(self.cooked_bw[self.cur_sat_id[agent]]):
+                self.mahimahi_ptr[agent] = 1
+                self.last_mahimahi_time[agent] = 0
+                end_of_network = True
+                break
+
+        delay *= MILLISECONDS_IN_SECOND
+        delay += LINK_RTT
+
+        rebuf = np.maximum(delay - self.buffer_size[agent], 0.0)
+        self.buffer_size[agent] = np.maximum(self.buffer_size[agent] - delay, 0.0)
+        self.buffer_size[agent] += VIDEO_CHUNCK_LEN
+
+        if self.buffer_size[agent] > BUFFER_THRESH:
+            drain_buffer_time = self.buffer_size[agent] - BUFFER_THRESH
+            sleep_time = np.ceil(drain_buffer_time / DRAIN_BUFFER_SLEEP_TIME) * DRAIN_BUFFER_SLEEP_TIME
+            self.buffer_size[agent] -= sleep_time
+
+            while True:
+                if self.mahimahi_ptr[agent] >= len(self.cooked_bw[self.cur_sat_id[agent]]):
+                    self.mahimahi_ptr[agent] = 1
+                    self.last_mahimahi_time[agent] = 0
+                    end_of_network = True
+                    break
+
+                duration = self.cooked_time[self.mahimahi_ptr[agent]] - self.last_mahimahi_time[agent]
+                if duration > sleep_time / MILLISECONDS_IN_SECOND:
+                    self.last_mahimahi_time[agent] += sleep_time / MILLISECONDS_IN_SECOND
+                    break
+                sleep_time -= duration * MILLISECONDS_IN_SECOND
+                self.last_mahimahi_time[agent] = self.cooked_time[self.mahimahi_ptr[agent]]
+                self.mahimahi_ptr[agent] += 1
+                throughput = self.data_rate(agent, self.cur_sat_id[agent], self.mahimahi_ptr[agent])
+
+                if throughput == 0.0:
+                    sat_id = self.get_best_sat_id(agent, self.mahimahi_ptr[agent])
+                    assert sat_id != self.cur_sat_id[agent]
+                    self.update_sat_info(sat_id, self.last_mahimahi_time[agent], agent, 1)
+                    self.update_sat_info(self.cur_sat_id[agent], self.last_mahimahi_time[agent], agent, -1)
+                    self.prev_sat_id[agent] = self.cur_sat_id[agent]
+                    self.cur_sat_id[agent] = sat_id
+
+        self.video_chunk_counter[agent] += 1
+        avg_bw = float(video_chunk_size) / delay / M_IN_K * BITS_IN_BYTE
+
+        if self.video_chunk_counter[agent] >= TOTAL_VIDEO_CHUNKS or end_of_network:
+            self.buffer_size[agent] = 0
+            self.video_chunk_counter[agent] = 0
+
+        self.avg_bws = (*self.avg_bws, avg_bw)
+        self.bitrate_sum += VIDEO_BIT_RATE[quality]
+        self.smoothness_diff += abs(VIDEO_BIT_RATE[quality] - VIDEO_BIT_RATE[self.last_quality[agent]])
+        self.last_quality[agent] = quality
+        self.rebuf_time += rebuf / MILLISECONDS_IN_SECOND
+
+    def get_reward(self):
+        return self.bitrate_sum * QUALITY_FACTOR / M_IN_K - (REBUF_PENALTY * self.rebuf_time) \
+            - SMOOTH_PENALTY * self.smoothness_diff / M_IN_K
+
+    def score_pairs(self, combos, ho_plans, lengths):
+        """
+        Oracle rewards of every (combo, handover plan) pair, replayed in the order the environment serves users.
+
+        :param combos: [N, users, horizon] bitrate indexes of each pair
+        :param ho_plans: [N, users] handover positions of each pair
+        :param lengths: chunks each user plays, 0 for a user without a combo
+        :return: per pair (rewards, avg_bws) as the replay loop built them, None for pairs the decision budget
+                 left unscored
+        """
+        results = [None] * len(combos)
+        self.expand(np.arange(len(combos)), [0] * len(lengths), combos, ho_plans, lengths, results)
+        return results
+
+    def expand(self, pair_ids, positions, combos, ho_plans, lengths, results):
+        if self.progress["scored"] and self.env.past_deadline():
+            return
+        agent = self.get_first_agent()
+        if lengths[agent] == 0:
+            # The user has no combo left to play, its nan ends the replay
+            for pair_id in pair_ids:
+                results[pair_id] = ([np.nan, self.get_reward()], list(self.avg_bws))
+            self.progress["scored"] += len(pair_ids)
+            return
+        if positions[agent] >= lengths[agent]:
+            for pair_id in pair_ids:
+                results[pair_id] = ([self.get_reward()], list(self.avg_bws))
+            self.progress["scored"] += len(pair_ids)
+            return
+
+        position = positions[agent]
+        qualities = combos[pair_ids, agent, position]
+        ho_stamps = ho_plans[pair_ids, agent] - position
+        unique_actions, inverse = np.unique(np.stack([qualities, ho_stamps == 0], axis=1), axis=0,
+                                            return_inverse=True)
+        child_positions = list(positions)
+        child_positions[agent] += 1
+        for action_idx, (quality, is_handover) in enumerate(unique_actions):
+            child = self.fork()
+            child.download(int(quality), agent, 0 if is_handover else 1)
+            child.expand(pair_ids[inverse.reshape(-1) == action_idx], child_positions, combos, ho_plans, lengths,
+                         results)
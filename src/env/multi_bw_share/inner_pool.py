@@ -0,0 +1,60 @@
+import atexit
+import multiprocessing as mp
+
+from util.constants import INNER_PROCESS_NUMS
+
+# Workers for the exhaustive MPC inner rewards are started once per run and reused by every decision.
+# Each worker gets the environment (traces, video sizes) once at start-up, so a task only carries
+# its combo slice and the few fields the inner rewards read that change between decisions.
+DECISION_FIELDS = ("last_quality", "unexpected_change", "reward_func", "prev_best_user_info")
+
+INNER_POOL = None
+INNER_POOL_ENV = None
+WORKER_ENV = None
+# Lowered by harnesses that already run several environments side by side
+INNER_POOL_SIZE = INNER_PROCESS_NUMS
+
+
+def init_worker(env):
+    global WORKER_ENV
+    WORKER_ENV = env
+
+
+def run_inner_reward(method_name, decision_state, args):
+    # Returns the result with the worker's own decision profile, merged by DecisionProfile.merge_workers
+    for name, value in decision_state.items():
+        setattr(WORKER_ENV, name, value)
+    WORKER_ENV.profile.begin(method_name)
+    result = getattr(WORKER_ENV, method_name)(*args)
+    return result, WORKER_ENV.profile.end(keep=False)
+
+
+def get_decision_state(env):
+    return {name: getattr(env, name) for name in DECISION_FIELDS}
+
+
+def get_inner_pool(env):
+    global INNER_POOL, INNER_POOL_ENV
+    if INNER_POOL is None or INNER_POOL_ENV is not env:
+        close_inner_pool()
+        INNER_POOL = mp.Pool(INNER_POOL_SIZE, initializer=init_worker, initargs=(env,))
+        INNER_POOL_ENV = env
+    return INNER_POOL
+
+
+def set_inner_pool_size(processes):
+    global INNER_POOL_SIZE
+    close_inner_pool()
+    INNER_POOL_SIZE = processes
+
+
+def close_inner_pool():
+    global INNER_POOL, INNER_POOL_ENV
+    if INNER_POOL is not None:
+        INNER_POOL.terminate()
+        INNER_POOL.join()
+    INNER_POOL = None
+    INNER_POOL_ENV = None
+
+
+atexit.register(close_inner_pool)
@@ -0,0 +1,446 @@
+import heapq
+import itertools
+
+import numpy as np
+import structlog
+
+from util.constants import DEFAULT_QUALITY, REBUF_PENALTY, SMOOTH_PENALTY, TOTAL_VIDEO_CHUNKS, VIDEO_CHUNCK_LEN, \
+    VIDEO_BIT_RATE, BITRATE_LEVELS, B_IN_MB, BITS_IN_BYTE, M_IN_K, MILLISECONDS_IN_SECOND, MPC_PAST_CHUNK_COUNT, \
+    VIDEO_SIZE_FILE
+
+RANDOM_SEED = 42
+BUFFER_THRESH = 60.0 * MILLISECONDS_IN_SECOND  # millisec, max buffer limit
+DRAIN_BUFFER_SLEEP_TIME = 500.0  # millisec
+PACKET_PAYLOAD_PORTION = 0.95
+LINK_RTT = 80  # millisec
+
+# LEO SETTINGS
+HANDOVER_DELAY = 0.2  # sec
+
+# Session churn: Poisson arrivals, every session watches one video and leaves
+ARRIVAL_RATE = 0.05  # sessions per sec
+SESSION_CHUNKS = TOTAL_VIDEO_CHUNKS
+
+# Event kinds. Simultaneous events are processed in this order, so a trace tick
+# always settles the old bandwidth before satellites rise or set on the new one.
+TRACE_TICK = 0
+SAT_SET = 1
+SAT_RISE = 2
+HANDOVER_DONE = 3
+CHUNK_DONE = 4
+CHUNK_REQUEST = 5
+SESSION_DEPARTURE = 6
+SESSION_ARRIVAL = 7
+
+
+class Session:
+    def __init__(self, session_id, arrival_time, num_chunks):
+        self.session_id = session_id
+        self.arrival_time = arrival_time
+        self.departure_time = None
+        self.num_chunks = num_chunks
+
+        self.sat_id = None
+        self.next_sat_id = None
+        self.in_handover = False
+
+        self.chunk_counter = 0
+        self.quality = DEFAULT_QUALITY
+        self.last_quality = DEFAULT_QUALITY
+        self.remain = 0  # bytes left of the chunk in flight
+        self.request_time = None
+        self.buffer_size = 0  # millisec
+
+        self.download_bw = []
+        self.qoe = 0
+        self.rebuf = 0
+        self.bitrate_sum = 0
+        self.num_handover = 0
+
+    def get_info(self):
+        return {"session_id": self.session_id, "arrival": self.arrival_time, "departure": self.departure_time,
+                "chunks": self.chunk_counter, "qoe": self.qoe, "rebuf": self.rebuf,
+                "bitrate": self.bitrate_sum / max(self.chunk_counter, 1), "handover": self.num_handover}
+
+
+class SatelliteQueue:
+    """
+    Fluid resource-fair sharing of one satellite among its connected sessions.
+
+    Every connected session gets bw / num_conn, so instead of tracking each download
+    we keep one virtual clock `served` (bytes delivered to any single session so far)
+    and store each active download as the value of `served` at which it completes.
+    Joining, leaving and finding the next completion are heap operations.
+    """
+
+    def __init__(self, sat_id, sat_bw):
+        self.sat_id = sat_id
+        self.sat_bw = sat_bw
+        self.conn = set()
+        self.active = {}  # session_id -> finishing value of served
+        self.heap = []
+        self.served = 0
+        self.rate = 0  # bytes per sec for the whole satellite
+        self.last_time = 0
+        self.version = 0
+
+    def advance(self, now):
+        if self.conn:
+            self.served += self.rate / len(self.conn) * (now - self.last_time)
+        self.last_time = now
+
+    def set_bw(self, bw, now):
+        self.advance(now)
+        self.rate = bw * B_IN_MB / BITS_IN_BYTE * PACKET_PAYLOAD_PORTION
+
+    def connect(self, session_id, now):
+        self.advance(now)
+        self.conn.add(session_id)
+
+    def disconnect(self, session_id, now):
+        self.advance(now)
+        self.conn.discard(session_id)
+        return self.stop(session_id)
+
+    def start(self, session_id, remain):
+        target = self.served + remain
+        self.active[session_id] = target
+        heapq.heappush(self.heap, (target, session_id))
+
+    def stop(self, session_id):
+        # Returns the bytes still to download, the heap entry is dropped lazily
+        if session_id not in self.active:
+            return 0
+        return max(self.active.pop(session_id) - self.served, 0)
+
+    def head(self):
+        while self.heap:
+            target, session_id = self.heap[0]
+            if self.active.get(session_id) == target:
+                return target, session_id
+            heapq.heappop(self.heap)
+        return None
+
+    def pop(self):
+        target, session_id = self.head()
+        heapq.heappop(self.heap)
+        del self.active[session_id]
+        return session_id
+
+    def next_completion(self, now):
+        head = self.head()
+        if head is None or self.rate <= 0:
+            return None
+        return now + max(head[0] - self.served, 0) * len(self.conn) / self.rate
+
+    def user_num(self):
+        return len(self.conn)
+
+
+class Environment:
+    """
+    Discrete-event multi-session simulator.
+
+    Sessions arrive as a Poisson process, attach to a satellite, download their chunks
+    under resource-fair sharing and depart once the video is played out. The event queue
+    holds trace ticks, satellite rise/set, handover completions, chunk completions and
+    requests, and session arrivals/departures; each event costs O(log n) heap work, so
+    hours of trace with thousands of sessions run without polling every agent.
+
+    abr_policy(env, session) returns the quality of the next chunk and sat_policy(env, session)
+    optionally returns a satellite to hand over to at a chunk boundary.
+    """
+
+    def __init__(self, all_cooked_time, all_cooked_bw, random_seed=RANDOM_SEED, arrival_rate=ARRIVAL_RATE,
+                 session_chunks=SESSION_CHUNKS, abr_policy=None, sat_policy=None):
+        assert len(all_cooked_time) == len(all_cooked_bw)
+        assert arrival_rate > 0
+        self.log = structlog.get_logger()
+
+        self.rng = np.random.default_rng(random_seed)
+        self.all_cooked_time = all_cooked_time
+        self.all_cooked_bw = all_cooked_bw
+        self.arrival_rate = arrival_rate
+        self.session_chunks = session_chunks
+        self.abr_policy = abr_policy if abr_policy else rate_based_policy
+        self.sat_policy = sat_policy
+
+        self.video_size = {}  # in bytes
+        for bitrate in range(BITRATE_LEVELS):
+            self.video_size[bitrate] = []
+            with open(VIDEO_SIZE_FILE + str(bitrate)) as f:
+                for line in f:
+                    self.video_size[bitrate].append(int(line.split()[0]))
+
+        self.trace_arrays = {}
+        self.reset()
+
+    def seed(self, random_seed):
+        self.rng = np.random.default_rng(random_seed)
+
+    def reset(self, trace_idx=None, start_ptr=None):
+        if trace_idx is None:
+            trace_idx = self.rng.integers(len(self.all_cooked_time))
+        self.trace_idx = trace_idx
+        if trace_idx not in self.trace_arrays:
+            self.trace_arrays[trace_idx] = (np.asarray(self.all_cooked_time[trace_idx], dtype=float),
+                                            {sat_id: np.asarray(sat_bw, dtype=float)
+                                             for sat_id, sat_bw in self.all_cooked_bw[trace_idx].items()})
+        self.cooked_time, self.cooked_bw = self.trace_arrays[trace_idx]
+
+        if start_ptr is None:
+            start_ptr = 1
+        assert 1 <= start_ptr < len(self.cooked_time)
+        # The bandwidth at mahimahi_ptr holds until cooked_time[mahimahi_ptr]
+        self.mahimahi_ptr = start_ptr
+        self.now = self.cooked_time[start_ptr - 1]
+        self.end_time = self.cooked_time[-1]
+
+        self.events = []
+        self.event_seq = itertools.count()
+        self.session_ids = itertools.count()
+        self.sessions = {}
+        self.finished_sessions = []
+        self.waiting = set()
+        self.num_events = 0
+
+        self.cur_satellite = {}
+        self.visible = set()
+        for sat_id, sat_bw in self.cooked_bw.items():
+            sat = SatelliteQueue(sat_id, sat_bw)
+            sat.set_bw(sat_bw[start_ptr], self.now)
+            self.cur_satellite[sat_id] = sat
+            if sat_bw[start_ptr] != 0:
+                self.visible.add(sat_id)
+
+            # Rise and set happen on the tick where the visibility flips
+            seen = sat_bw != 0
+            for index in np.flatnonzero(seen[start_ptr + 1:] != seen[start_ptr:-1]) + start_ptr + 1:
+                self.push(self.cooked_time[index - 1], SAT_RISE if seen[index] else SAT_SET, sat_id)
+
+        self.push(self.cooked_time[start_ptr], TRACE_TICK, start_ptr)
+        self.push(self.now + self.rng.exponential(1 / self.arrival_rate), SESSION_ARRIVAL, None)
+
+    def push(self, time, kind, key, version=None):
+        heapq.heappush(self.events, (time, kind, next(self.event_seq), key, version))
+
+    def check_end(self):
+        return not self.events or self.events[0][0] >= self.end_time
+
+    def run(self, until=None):
+        if until is None:
+            until = self.end_time
+        while self.events and self.events[0][0] < min(until, self.end_time):
+            self.step()
+        return self.finished_sessions
+
+    def step(self):
+        time, kind, _, key, version = heapq.heappop(self.events)
+        self.now = time
+        self.num_events += 1
+
+        if kind == TRACE_TICK:
+            self.on_trace_tick(key)
+        elif kind == SAT_SET:
+            self.on_sat_set(key)
+        elif kind == SAT_RISE:
+            self.on_sat_rise(key)
+        elif kind == HANDOVER_DONE:
+            self.on_handover_done(key)
+        elif kind == CHUNK_DONE:
+            if version == self.cur_satellite[key].version:
+                self.on_chunk_done(key)
+        elif kind == CHUNK_REQUEST:
+            self.on_chunk_request(key)
+        elif kind == SESSION_DEPARTURE:
+            self.on_session_departure(key)
+        elif kind == SESSION_ARRIVAL:
+            self.on_session_arrival()
+        else:
+            print("Cannot happen")
+            raise Exception
+        return time, kind
+
+    def reschedule(self, sat_id):
+        # Only the newest completion event of a satellite is live, older ones are skipped
+        sat = self.cur_satellite[sat_id]
+        sat.version += 1
+        finish_time = sat.next_completion(self.now)
+        if finish_time is not None:
+            self.push(finish_time, CHUNK_DONE, sat_id, sat.version)
+
+    def on_trace_tick(self, mahimahi_ptr):
+        self.mahimahi_ptr = mahimahi_ptr + 1
+        if self.mahimahi_ptr >= len(self.cooked_time):
+            return
+        for sat_id, sat in self.cur_satellite.items():
+            bw = sat.sat_bw[self.mahimahi_ptr]
+            if bw == sat.sat_bw[mahimahi_ptr]:
+                continue
+            sat.set_bw(bw, self.now)
+            if sat.active:
+                self.reschedule(sat_id)
+        self.push(self.cooked_time[self.mahimahi_ptr], TRACE_TICK, self.mahimahi_ptr)
+
+    def on_sat_set(self, sat_id):
+        self.visible.discard(sat_id)
+        sat = self.cur_satellite[sat_id]
+        for session_id in sorted(sat.conn):
+            self.start_handover(self.sessions[session_id], self.get_best_sat_id())
+        self.reschedule(sat_id)
+
+    def on_sat_rise(self, sat_id):
+        self.visible.add(sat_id)
+        for session_id in sorted(self.waiting):
+            self.start_handover(self.sessions[session_id], sat_id)
+
+    def start_handover(self, session, sat_id):
+        if session.sat_id is not None:
+            sat = self.cur_satellite[session.sat_id]
+            if session.session_id in sat.active:
+                session.remain = sat.disconnect(session.session_id, self.now)
+            else:
+                sat.disconnect(session.session_id, self.now)
+            self.reschedule(session.sat_id)
+            session.num_handover += 1
+        session.sat_id = None
+        if sat_id is None:
+            # Nothing visible, wait for the next satellite to rise
+            self.waiting.add(session.session_id)
+            return
+        self.waiting.discard(session.session_id)
+        session.next_sat_id = sat_id
+        session.in_handover = True
+        self.push(self.now + HANDOVER_DELAY, HANDOVER_DONE, session.session_id)
+
+    def on_handover_done(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None or not session.in_handover:
+            return
+        session.in_handover = False
+        sat_id = session.next_sat_id
+        session.next_sat_id = None
+        if sat_id not in self.visible:
+            self.start_handover(session, self.get_best_sat_id())
+            return
+        self.attach(session, sat_id)
+
+    def attach(self, session, sat_id):
+        sat = self.cur_satellite[sat_id]
+        sat.connect(session.session_id, self.now)
+        session.sat_id = sat_id
+        if session.request_time is not None and session.remain > 0:
+            sat.start(session.session_id, session.remain)
+        self.reschedule(sat_id)
+
+    def on_session_arrival(self):
+        session = Session(next(self.session_ids), self.now, self.session_chunks)
+        self.sessions[session.session_id] = session
+        self.log.debug("Session arrival", session_id=session.session_id, time=self.now)
+
+        sat_id = self.get_best_sat_id()
+        if sat_id is None:
+            self.waiting.add(session.session_id)
+        else:
+            self.attach(session, sat_id)
+        self.on_chunk_request(session.session_id)
+
+        self.push(self.now + self.rng.exponential(1 / self.arrival_rate), SESSION_ARRIVAL, None)
+
+    def on_chunk_request(self, session_id):
+        session = self.sessions[session_id]
+
+        if self.sat_policy and session.sat_id is not None:
+            sat_id = self.sat_policy(self, session)
+            if sat_id is not None and sat_id != session.sat_id and sat_id in self.visible:
+                self.start_handover(session, sat_id)
+
+        quality = self.abr_policy(self, session)
+        assert 0 <= quality < BITRATE_LEVELS
+        session.quality = quality
+        session.remain = self.video_size[quality][session.chunk_counter % len(self.video_size[quality])]
+        session.request_time = self.now
+
+        if session.sat_id is not None:
+            sat = self.cur_satellite[session.sat_id]
+            sat.advance(self.now)
+            sat.start(session_id, session.remain)
+            self.reschedule(session.sat_id)
+
+    def on_chunk_done(self, sat_id):
+        sat = self.cur_satellite[sat_id]
+        sat.advance(self.now)
+        session = self.sessions[sat.pop()]
+        self.reschedule(sat_id)
+
+        chunk_size = self.video_size[session.quality][session.chunk_counter % len(self.video_size[session.quality])]
+        delay = (self.now - session.request_time) * MILLISECONDS_IN_SECOND + LINK_RTT
+        session.remain = 0
+        session.request_time = None
+
+        rebuf = np.maximum(delay - session.buffer_size, 0.0)
+        session.buffer_size = np.maximum(session.buffer_size - delay, 0.0) + VIDEO_CHUNCK_LEN
+
+        sleep_time = 0
+        if session.buffer_size > BUFFER_THRESH:
+            drain_buffer_time = session.buffer_size - BUFFER_THRESH
+            sleep_time = np.ceil(drain_buffer_time / DRAIN_BUFFER_SLEEP_TIME) * DRAIN_BUFFER_SLEEP_TIME
+            session.buffer_size -= sleep_time
+
+        session.download_bw.append(float(chunk_size) / delay / M_IN_K * BITS_IN_BYTE)
+        session.qoe += VIDEO_BIT_RATE[session.quality] / M_IN_K \
+            - REBUF_PENALTY * rebuf / MILLISECONDS_IN_SECOND \
+            - SMOOTH_PENALTY * np.abs(VIDEO_BIT_RATE[session.quality] -
+                                      VIDEO_BIT_RATE[session.last_quality]) / M_IN_K
+        session.rebuf += rebuf / MILLISECONDS_IN_SECOND
+        session.bitrate_sum += VIDEO_BIT_RATE[session.quality]
+        session.last_quality = session.quality
+        session.chunk_counter += 1
+
+        if session.chunk_counter >= session.num_chunks:
+            # Leave once the rest of the buffer is played out
+            self.push(self.now + (LINK_RTT + session.buffer_size) / MILLISECONDS_IN_SECOND, SESSION_DEPARTURE,
+                      session.session_id)
+        else:
+            self.push(self.now + (LINK_RTT + sleep_time) / MILLISECONDS_IN_SECOND, CHUNK_REQUEST, session.session_id)
+
+    def on_session_departure(self, session_id):
+        session = self.sessions.pop(session_id)
+        if session.sat_id is not None:
+            self.cur_satellite[session.sat_id].disconnect(session_id, self.now)
+            self.reschedule(session.sat_id)
+        self.waiting.discard(session_id)
+        session.in_handover = False
+        session.departure_time = self.now
+        self.finished_sessions.append(session.get_info())
+        self.log.debug("Session departure", session_id=session_id, time=self.now, qoe=session.qoe)
+
+    def get_best_sat_id(self):
+        # Best share a newcomer would get on each visible satellite
+        best_sat_id = None
+        best_sat_bw = 0
+        for sat_id in sorted(self.visible):
+            sat = self.cur_satellite[sat_id]
+            real_sat_bw = sat.sat_bw[self.mahimahi_ptr] / (sat.user_num() + 1)
+            if best_sat_bw < real_sat_bw:
+                best_sat_id = sat_id
+                best_sat_bw = real_sat_bw
+        return best_sat_id
+
+    def get_num_of_user_sat(self, sat_id):
+        if sat_id == "all":
+            return {tmp_sat_id: sat.user_num() for tmp_sat_id, sat in self.cur_satellite.items() if sat.user_num()}
+        return self.cur_satellite[sat_id].user_num()
+
+
+def rate_based_policy(env, session):
+    # Highest bitrate below the harmonic mean of the last chunk throughputs
+    past_bws = session.download_bw[-MPC_PAST_CHUNK_COUNT:]
+    if not past_bws:
+        return DEFAULT_QUALITY
+    harmonic_bw = len(past_bws) / sum(1 / float(past_bw) for past_bw in past_bws) * M_IN_K
+    quality = DEFAULT_QUALITY
+    for bitrate in range(BITRATE_LEVELS):
+        if VIDEO_BIT_RATE[bitrate] <= harmonic_bw:
+            quality = bitrate
+    return quality
@@ -1,9 +1,7 @@
 import itertools
 
 import structlog
-from scipy.optimize import minimize, LinearConstraint
-from statsmodels.tsa.api import ExponentialSmoothing
-import pandas as pd
+from util.backends import minimize, LinearConstraint, ExponentialSmoothing, pd
 import numpy as np
 import copy
 import multiprocessing as mp
@@ -42,7 +40,7 @@ class Environment:
         assert len(all_cooked_time) == len(all_cooked_bw)
         self.log = structlog.get_logger()
 
-        np.random.seed(random_seed)
+        self.rng = np.random.default_rng(random_seed)
         self.num_agents = num_agents
         self.reward_func = reward_func
 
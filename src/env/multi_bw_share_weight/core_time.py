@@ -1,9 +1,6 @@
 import itertools
 
 import structlog
-from scipy.optimize import minimize, LinearConstraint
-from statsmodels.tsa.api import ExponentialSmoothing
-import pandas as pd
 import numpy as np
 import copy
 
@@ -39,14 +36,14 @@ class Environment:
         assert len(all_cooked_time) == len(all_cooked_bw)
         self.log = structlog.get_logger()
 
-        np.random.seed(random_seed)
+        self.rng = np.random.default_rng(random_seed)
         self.num_agents = num_agents
 
         self.all_cooked_time = all_cooked_time
         self.all_cooked_bw = all_cooked_bw
 
         # pick a random trace file
-        self.trace_idx = np.random.randint(len(self.all_cooked_time))
+        self.trace_idx = self.rng.integers(len(self.all_cooked_time))
         self.cooked_time = self.all_cooked_time[self.trace_idx]
         self.cooked_bw = self.all_cooked_bw[self.trace_idx]
 
@@ -56,24 +53,21 @@ class Environment:
         # randomize the start point of the trace
         # note: trace file starts with time 0
 
-        self.mahimahi_ptr = [np.random.randint(1, len(self.cooked_time) - TOTAL_VIDEO_CHUNKS)] * self.num_agents
+        self.mahimahi_ptr = [int(self.rng.integers(1, len(self.cooked_time) - TOTAL_VIDEO_CHUNKS))] * self.num_agents
 
         self.last_mahimahi_time = [self.mahimahi_ptr[i] - 1 for i in range(self.num_agents)]
 
         # Centralization
         self.user_qoe_log = [{} for _ in range(self.num_agents)]
         self.num_of_user_sat = {}
-        self.num_sat_info = {}
         self.cur_satellite = {}
 
         for sat_id, sat_bw in self.cooked_bw.items():
-            self.num_sat_info[sat_id] = [0 for _ in range(len(sat_bw))]
             self.num_of_user_sat[sat_id] = 0
             self.cur_satellite[sat_id] = Satellite(sat_id, sat_bw, SAT_STRATEGY)
 
         self.cur_user = [User(i, SNR_MIN) for i in range(self.num_agents)]
 
-        # print(self.num_sat_info)
         self.prev_best_combos = [[DEFAULT_QUALITY] * MPC_FUTURE_CHUNK_COUNT] * self.num_agents
 
         # multiuser setting
@@ -223,7 +217,7 @@ class Environment:
         delay += LINK_RTT
 
         # add a multiplicative noise to the delay
-        delay *= np.random.uniform(NOISE_LOW, NOISE_HIGH)
+        delay *= self.rng.uniform(NOISE_LOW, NOISE_HIGH)
 
         # rebuffer time
         rebuf = np.maximum(delay - self.buffer_size[agent], 0.0)
@@ -344,44 +338,50 @@ class Environment:
                next_sat_bandwidth, next_sat_bw_logs, cur_sat_user_num, next_sat_user_num, cur_sat_bw_logs, connected_time, \
                self.cur_sat_id[agent], runner_up_sat_ids, ho_stamps, best_combos, final_rate
 
-    def reset(self):
-        self.video_chunk_counter = [0 for _ in range(self.num_agents)]
-        self.buffer_size = [0 for _ in range(self.num_agents)]
-        self.video_chunk_counter_sent = [0 for _ in range(self.num_agents)]
-        self.video_chunk_remain = [TOTAL_VIDEO_CHUNKS for _ in range(self.num_agents)]
-        self.end_of_video = [False for _ in range(self.num_agents)]
-        self.next_video_chunk_sizes = [[] for _ in range(self.num_agents)]
-        # self.next_sat_bandwidth = [[] for _ in range(self.num_agents)]
-        self.next_sat_id = [[] for _ in range(self.num_agents)]
-        self.delay = [0 for _ in range(self.num_agents)]
-        self.num_of_user_sat = {}
-        self.download_bw = [[] for _ in range(self.num_agents)]
-        self.cur_satellite = {}
+    def seed(self, random_seed):
+        self.rng = np.random.default_rng(random_seed)
 
-        self.trace_idx = np.random.randint(len(self.all_cooked_time))
+    def reset(self):
+        # Reuse the per-agent containers and the satellite/user objects of the previous episode,
+        # so that the turnover cost does not depend on the trace length
+        for agent in range(self.num_agents):
+            self.video_chunk_counter[agent] = 0
+            self.buffer_size[agent] = 0
+            self.video_chunk_counter_sent[agent] = 0
+            self.video_chunk_remain[agent] = TOTAL_VIDEO_CHUNKS
+            self.end_of_video[agent] = False
+            self.next_video_chunk_sizes[agent] = []
+            self.next_sat_id[agent] = []
+            self.delay[agent] = 0
+            self.download_bw[agent].clear()
+            self.cur_user[agent].reset()
+
+        self.trace_idx = self.rng.integers(len(self.all_cooked_time))
         self.cooked_time = self.all_cooked_time[self.trace_idx]
         self.cooked_bw = self.all_cooked_bw[self.trace_idx]
 
+        for sat_id in list(self.cur_satellite.keys()):
+            if sat_id not in self.cooked_bw:
+                del self.cur_satellite[sat_id]
+        self.num_of_user_sat.clear()
         for sat_id, sat_bw in self.cooked_bw.items():
-            self.num_sat_info[sat_id] = [0 for _ in range(len(sat_bw))]
             self.num_of_user_sat[sat_id] = 0
-            self.cur_satellite[sat_id] = Satellite(sat_id, sat_bw, SAT_STRATEGY)
-
-        self.cur_user = []
-        for agent_id in range(self.num_agents):
-            self.cur_user.append(User(agent_id, SNR_MIN))
+            if sat_id in self.cur_satellite:
+                self.cur_satellite[sat_id].reset(sat_bw)
+            else:
+                self.cur_satellite[sat_id] = Satellite(sat_id, sat_bw, SAT_STRATEGY)
 
-        self.mahimahi_ptr = [np.random.randint(1, len(self.cooked_time) - TOTAL_VIDEO_CHUNKS)] * self.num_agents
-        self.last_mahimahi_time = [self.mahimahi_ptr[i] - 1 for i in range(self.num_agents)]
+        start_ptr = int(self.rng.integers(1, len(self.cooked_time) - TOTAL_VIDEO_CHUNKS))
+        for agent in range(self.num_agents):
+            self.mahimahi_ptr[agent] = start_ptr
+            self.last_mahimahi_time[agent] = start_ptr - 1
 
-        self.cur_sat_id = []
         for agent in range(self.num_agents):
             cur_sat_id = self.get_best_sat_id(agent)
             # self.connection[cur_sat_id] = agent
-            self.cur_sat_id.append(cur_sat_id)
+            self.cur_sat_id[agent] = cur_sat_id
             self.update_sat_info(cur_sat_id, self.last_mahimahi_time[agent], agent, 1)
-
-        self.last_delay = [MPC_PAST_CHUNK_COUNT for _ in range(self.num_agents)]
+            self.last_delay[agent] = MPC_PAST_CHUNK_COUNT
 
     def check_end(self):
         # End if all users finish
@@ -44,6 +44,26 @@ class Satellite:
         self.log = structlog.get_logger(sat_id=self.sat_id)
         self.log.debug('Satellite init', sharing_model=self.sharing_model)
 
+    def reset(self, sat_bw):
+        # Reuse this object for a new episode: rebind the trace and clear the logs in place
+        self.sat_bw = sat_bw
+        self.conn_use_log.clear()
+        self.data_rate_ratio_log.clear()
+
+    def snapshot(self):
+        # The trace itself is shared, only the connection and ratio logs are copied
+        return self.sat_bw, {ptr: list(logs) for ptr, logs in self.conn_use_log.items()}, \
+            dict(self.data_rate_ratio_log)
+
+    def restore(self, state):
+        sat_bw, conn_use_log, data_rate_ratio_log = state
+        self.sat_bw = sat_bw
+        self.conn_use_log.clear()
+        for ptr, logs in conn_use_log.items():
+            self.conn_use_log[ptr] = list(logs)
+        self.data_rate_ratio_log.clear()
+        self.data_rate_ratio_log.update(data_rate_ratio_log)
+
     def copy_satellite(self, mahimahi_ptr):
         return Satellite(self.sat_id, copy.deepcopy(self.sat_bw), self.sharing_model, self.get_conn_use_log(mahimahi_ptr),
                          self.get_data_rate_ratio_log(mahimahi_ptr))
@@ -0,0 +1,58 @@
+from env.object.satellite import Satellite
+
+
+class SnapshotFields:
+    """
+    The mutable episode state of a simulation Environment, declared by attribute name, with the snapshot()/restore()
+    shared by every environment that has one.
+
+    scalars are kept as they are (traces are shared, never copied), lists and dicts get a shallow copy,
+    nested_lists a copy of every per-agent list and nested_dicts a copy of every list in the per-agent dicts.
+    Satellites, users and the RNG are always part of the snapshot.
+    """
+    def __init__(self, scalars=(), lists=(), dicts=(), nested_lists=(), nested_dicts=()):
+        self.scalars = scalars
+        self.lists = lists
+        self.dicts = dicts
+        self.nested_lists = nested_lists
+        self.nested_dicts = nested_dicts
+
+    def snapshot(self, env):
+        token = {"cur_satellite": {sat_id: sat.snapshot() for sat_id, sat in env.cur_satellite.items()},
+                 "cur_user": [user.snapshot() for user in env.cur_user],
+                 "rng": env.rng.bit_generator.state}
+        for name in self.scalars:
+            token[name] = getattr(env, name)
+        for name in self.lists:
+            token[name] = list(getattr(env, name))
+        for name in self.dicts:
+            token[name] = dict(getattr(env, name))
+        for name in self.nested_lists:
+            token[name] = [list(elem) for elem in getattr(env, name)]
+        for name in self.nested_dicts:
+            token[name] = [{key: list(value) for key, value in elem.items()} for elem in getattr(env, name)]
+        return token
+
+    def restore(self, env, token, sharing_model):
+        # The token is left untouched, so the same snapshot can be restored for any number of branches
+        for name in self.scalars:
+            setattr(env, name, token[name])
+        for name in self.lists:
+            setattr(env, name, list(token[name]))
+        for name in self.dicts:
+            setattr(env, name, dict(token[name]))
+        for name in self.nested_lists:
+            setattr(env, name, [list(elem) for elem in token[name]])
+        for name in self.nested_dicts:
+            setattr(env, name, [{key: list(value) for key, value in elem.items()} for elem in token[name]])
+
+        for sat_id in list(env.cur_satellite.keys()):
+            if sat_id not in token["cur_satellite"]:
+                del env.cur_satellite[sat_id]
+        for sat_id, state in token["cur_satellite"].items():
+            if sat_id not in env.cur_satellite:
+                env.cur_satellite[sat_id] = Satellite(sat_id, state[0], sharing_model)
+            env.cur_satellite[sat_id].restore(state)
+        for user, state in zip(env.cur_user, token["cur_user"]):
+            user.restore(state)
+        env.rng.bit_generator.state = token["rng"]
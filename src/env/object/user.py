@@ -174,6 +174,23 @@ class User:
     def __repr__(self):
         return str(self.agent_id)
 
+    def reset(self):
+        # Reuse this object for a new episode
+        self.index = -1
+        self.download_log.clear()
+        self.sat_log.clear()
+
+    def snapshot(self):
+        return self.index, dict(self.download_log), dict(self.sat_log)
+
+    def restore(self, state):
+        index, download_log, sat_log = state
+        self.index = index
+        self.download_log.clear()
+        self.download_log.update(download_log)
+        self.sat_log.clear()
+        self.sat_log.update(sat_log)
+
     def get_snr_noise(self, mahimahi_ptr=None):
         # return self.snr_noise[-1]
         # mahimahi_ptr = int(mahimahi_ptr)
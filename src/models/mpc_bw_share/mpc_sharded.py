@@ -0,0 +1,240 @@
+import numpy as np
+import structlog
+import os
+import sys
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir + '/../')
+
+from concurrent.futures import ProcessPoolExecutor
+import importlib
+import logging
+import multiprocessing as mp
+
+from env.multi_bw_share import fixed_env_time as env, inner_pool
+from util.decision_profile import DecisionProfile
+from util.holt import get_holt_params
+from util.constants import VIDEO_BIT_RATE, M_IN_K, REBUF_PENALTY, SMOOTH_PENALTY, DEFAULT_QUALITY, \
+    MPC_FUTURE_CHUNK_COUNT, BITRATE_REWARD, INNER_PROCESS_NUMS, HOLT_FIT_TRACES, TEST_TRACES, TEST_NOAA_TRACES, \
+    TEST_REAL_TRACES, TEST_TIGHT_TRACES
+
+# Same evaluation as mpc.py and its _noaa, _real and _tight copies, with the test traces spread over a process
+# pool. Every trace runs in an environment of its own, so its log and summary entry do not depend on how many
+# workers there are or which trace a worker ran before; the summary is merged in trace order.
+# Each environment is seeded with RANDOM_SEED + trace id. mpc.py instead carries one RNG stream across the traces,
+# so the runs that draw from it (the random runner-up satellite) do not reproduce mpc.py trace for trace.
+RANDOM_SEED = 42
+REWARD_FUNC = "LIN"  # LIN
+
+# --traces: (trace loader module, trace folder)
+TRACE_SETS = {"test": ("env.multi_bw_share.load_trace", TEST_TRACES),
+              "noaa": ("env.multi_bw_share.load_trace_noaa", TEST_NOAA_TRACES),
+              "real": ("env.multi_bw_share.load_trace_real", TEST_REAL_TRACES),
+              "tight": ("env.multi_bw_share.load_trace", TEST_TIGHT_TRACES)}
+
+import argparse
+
+parser = argparse.ArgumentParser(description='Trace-sharded MPC evaluation',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--user', type=int, default=3)
+parser.add_argument('--workers', type=int, default=os.cpu_count())
+parser.add_argument('--mpc-type', type=str, default="DualMPC-Centralization-Reduced")
+parser.add_argument('--traces', type=str, default="test", choices=sorted(TRACE_SETS))
+parser.add_argument('--summary-dir', type=str, default='MPC_sharded/')
+args = parser.parse_args()
+
+USERS = args.user
+MPC_TYPE = args.mpc_type
+SUMMARY_DIR = args.summary_dir
+LOG_FILE = SUMMARY_DIR + 'log_sim_cent'
+SUMMARY_PATH = SUMMARY_DIR + 'summary'
+
+structlog.configure(
+    wrapper_class=structlog.make_filtering_bound_logger(logging.INFO),
+)
+
+# Loaded once per worker by init_worker
+WORKER_TRACES = None
+
+
+def load_traces(trace_set):
+    loader, trace_folder = TRACE_SETS[trace_set]
+    return importlib.import_module(loader).load_trace(trace_folder)
+
+
+def init_worker(trace_set, inner_processes):
+    global WORKER_TRACES
+    WORKER_TRACES = load_traces(trace_set)
+    # The workers already run side by side, so each keeps a share of the inner reward pool
+    inner_pool.set_inner_pool_size(inner_processes)
+
+
+def run_trace(trace_id):
+    """
+    The serve loop of mpc.py on one trace.
+
+    :return: per-trace results merged by main(), in the order the summary writes them
+    """
+    np.random.seed(RANDOM_SEED + trace_id)
+    all_cooked_time, all_cooked_bw, all_file_names = WORKER_TRACES
+    net_env = env.Environment(all_cooked_time=[all_cooked_time[trace_id]],
+                              all_cooked_bw=[all_cooked_bw[trace_id]],
+                              all_cooked_name=[all_file_names[trace_id]],
+                              random_seed=RANDOM_SEED + trace_id,
+                              num_agents=USERS,
+                              reward_func=REWARD_FUNC)
+    if HOLT_FIT_TRACES:
+        # Fitted on the whole test set, as a single environment over every trace would be
+        net_env.holt_params = get_holt_params(all_cooked_bw)
+
+    log_file = open(LOG_FILE + '_' + all_file_names[trace_id], 'w')
+
+    time_stamp = [0 for _ in range(USERS)]
+    last_bit_rate = [DEFAULT_QUALITY for _ in range(USERS)]
+    bit_rate = [DEFAULT_QUALITY for _ in range(USERS)]
+
+    tmp_reward_1 = []
+    tmp_reward_2 = []
+    tmp_reward_3 = []
+    tmp_results = []
+    best_user_infos = []
+
+    ho_stamps_log = [MPC_FUTURE_CHUNK_COUNT for _ in range(USERS)]
+    combo_log = [[DEFAULT_QUALITY] for _ in range(USERS)]
+
+    while True:
+        agent = net_env.get_first_agent()
+        if agent == -1:
+            break
+
+        # Priority on handover
+        if 0 in ho_stamps_log:
+            agent = ho_stamps_log.index(0)
+
+        if combo_log[agent]:
+            bit_rate[agent] = combo_log[agent].pop(0)
+
+        ho_point = ho_stamps_log[agent]
+
+        if ho_stamps_log[agent] == 0 or ho_stamps_log[agent] == 1:
+            ho_stamps_log[agent] = -1
+        elif ho_stamps_log[agent] != MPC_FUTURE_CHUNK_COUNT:
+            ho_stamps_log[agent] -= 1
+        do_mpc = True
+
+        delay, sleep_time, buffer_size, rebuf, \
+        video_chunk_size, next_video_chunk_sizes, \
+        end_of_video, video_chunk_remain, is_handover, sat_status, _, _, _, _, _, _, cur_sat_id, \
+        next_sat_id, ho_stamps, best_combos, best_user_info, quality, _, _, _ \
+            = net_env.get_video_chunk(bit_rate[agent], agent, MPC_TYPE, None, ho_point, do_mpc)
+
+        # The runner-up satellites are picked by the MPC inside the environment, only the plan is kept here
+        if best_combos:
+            ho_stamps_log = ho_stamps
+            combo_log = best_combos
+
+        time_stamp[agent] += delay  # in ms
+        time_stamp[agent] += sleep_time  # in ms
+
+        if best_user_info:
+            best_user_info["time"] = time_stamp[agent] / M_IN_K
+            best_user_infos.append(best_user_info)
+
+        # reward is video quality - rebuffer penalty
+        if REWARD_FUNC == "LIN":
+            reward = VIDEO_BIT_RATE[quality] / M_IN_K \
+                     - REBUF_PENALTY * rebuf \
+                     - SMOOTH_PENALTY * np.abs(VIDEO_BIT_RATE[quality] -
+                                               VIDEO_BIT_RATE[last_bit_rate[agent]]) / M_IN_K
+            tmp_reward_1.append(VIDEO_BIT_RATE[quality] / M_IN_K)
+            tmp_reward_2.append(-REBUF_PENALTY * rebuf)
+            tmp_reward_3.append(- SMOOTH_PENALTY * np.abs(VIDEO_BIT_RATE[quality] -
+                                                          VIDEO_BIT_RATE[last_bit_rate[agent]]) / M_IN_K)
+        elif REWARD_FUNC == "HD":
+            reward = BITRATE_REWARD[quality] \
+                     - 8 * rebuf - np.abs(BITRATE_REWARD[quality] - BITRATE_REWARD[last_bit_rate[agent]])
+
+            tmp_reward_1.append(BITRATE_REWARD[quality])
+            tmp_reward_2.append(-8 * rebuf)
+            tmp_reward_3.append(-np.abs(BITRATE_REWARD[quality] - BITRATE_REWARD[last_bit_rate[agent]]))
+        else:
+            raise Exception
+        tmp_results.append(reward)
+
+        last_bit_rate[agent] = quality
+
+        log_file.write("{: <15} {: <10} {: <10} {: <15} {: <15} {: <15}"
+                       " {: <15} {: <15} {: <15} {: <15} {: <15} {: <15} {: <15}\n"
+                       .format(str(round(time_stamp[agent] / M_IN_K, 3)), str(agent),
+                               str(VIDEO_BIT_RATE[quality]), str(round(buffer_size, 3)),
+                               str(round(rebuf, 3)),
+                               str(round(video_chunk_size, 3)), str(round(delay, 3)), str(round(reward, 3)),
+                               str(cur_sat_id), str(is_handover), str(sat_status), str(ho_stamps),
+                               str(best_user_info)))
+        log_file.flush()
+
+    log_file.write('\n')
+    log_file.close()
+    inner_pool.close_inner_pool()
+
+    return {"name": all_file_names[trace_id], "best_user_infos": best_user_infos, "results": tmp_results[1:],
+            "reward_parts": (np.mean(tmp_reward_1[1:]), np.mean(tmp_reward_2[1:]), np.mean(tmp_reward_3[1:])),
+            "profile": net_env.profile.records, "pred_cache": net_env.get_pred_cache_stats(),
+            "anytime": net_env.get_anytime_stats()}
+
+
+def main():
+    all_file_names = load_traces(args.traces)[2]
+
+    os.system('rm -r ' + SUMMARY_DIR)
+    if not os.path.exists(SUMMARY_DIR):
+        os.makedirs(SUMMARY_DIR)
+
+    workers = max(1, min(args.workers, len(all_file_names)))
+    inner_processes = max(1, INNER_PROCESS_NUMS // workers)
+    # Forked, not pool-daemonic workers: the ratio MPC starts an inner pool of its own in each of them
+    with ProcessPoolExecutor(workers, mp_context=mp.get_context("fork"), initializer=init_worker,
+                             initargs=(args.traces, inner_processes)) as executor:
+        trace_results = list(executor.map(run_trace, range(len(all_file_names))))
+
+    results = []
+    reward_1 = []
+    reward_2 = []
+    reward_3 = []
+    profile = DecisionProfile()
+    summary_file = open(SUMMARY_PATH, 'w')
+    for trace_result in trace_results:
+        print(trace_result["name"], "prediction cache", trace_result["pred_cache"],
+              "anytime search", trace_result["anytime"])
+        summary_file.write(trace_result["name"])
+        summary_file.write('\n')
+        summary_file.write(str(trace_result["best_user_infos"]))
+        summary_file.write('\n')
+        summary_file.write(str(sum(trace_result["results"]) / len(trace_result["results"])))
+        summary_file.write('\n')
+
+        results += trace_result["results"]
+        reward_1.append(trace_result["reward_parts"][0])
+        reward_2.append(trace_result["reward_parts"][1])
+        reward_3.append(trace_result["reward_parts"][2])
+        profile.records += trace_result["profile"]
+
+    print(sum(results) / len(results))
+    summary_file.write('\n')
+    summary_file.write(str(sum(results) / len(results)))
+    summary_file.close()
+
+    reward_file = open(SUMMARY_PATH + '_reward_parts', 'w')
+    reward_file.write(' '.join(str(elem) for elem in reward_1))
+    reward_file.write('\n')
+    reward_file.write(' '.join(str(elem) for elem in reward_2))
+    reward_file.write('\n')
+    reward_file.write(' '.join(str(elem) for elem in reward_3))
+    reward_file.write('\n')
+    reward_file.close()
+
+    # Decision latency per phase, combo counts and pruning ratios
+    profile.write_histograms(SUMMARY_PATH + '_latency')
+
+
+if __name__ == '__main__':
+    main()
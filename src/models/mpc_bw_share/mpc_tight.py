@@ -123,6 +123,8 @@ def main():
             net_env.reset()
 
             print("network count", video_count)
+            print("prediction cache", net_env.get_pred_cache_stats())
+            print("anytime search", net_env.get_anytime_stats())
             print(sum(tmp_results[1:]) / len(tmp_results[1:]))
             summary_file = open(SUMMARY_PATH, 'a')
             summary_file.write(net_env.get_file_name())
@@ -260,6 +262,9 @@ def main():
     reward_file.write(' '.join(str(elem) for elem in reward_3))
     reward_file.write('\n')
 
+    # Decision latency per phase, combo counts and pruning ratios
+    net_env.profile.write_histograms(SUMMARY_PATH + '_latency')
+
 
 if __name__ == '__main__':
     main()
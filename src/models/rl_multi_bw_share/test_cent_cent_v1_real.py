@@ -41,7 +41,7 @@ REWARD_FUNC = "LIN"
 
 
 def main():
-    np.random.seed(RANDOM_SEED)
+    rng = np.random.default_rng(RANDOM_SEED)
 
     # assert len(VIDEO_BIT_RATE) == A_DIM
 
@@ -310,7 +310,7 @@ def main():
             # state[agent][8, :PAST_LEN] = next_sat_user_num[:5]
 
             action_prob = actor.predict(np.reshape(state[agent], (1, S_INFO, PAST_LEN)))
-            noise = np.random.gumbel(size=len(action_prob))
+            noise = rng.gumbel(size=len(action_prob))
             action = np.argmax(np.log(action_prob) + noise)
 
             sat[agent] = action // A_DIM
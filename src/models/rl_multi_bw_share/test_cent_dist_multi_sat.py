@@ -39,7 +39,7 @@ REWARD_FUNC = "LIN"
 
 
 def main():
-    np.random.seed(RANDOM_SEED)
+    rng = np.random.default_rng(RANDOM_SEED)
 
     # assert len(VIDEO_BIT_RATE) == A_DIM
 
@@ -291,7 +291,7 @@ def main():
                 state[agent][(9 + i), :PAST_LEN] = np.array(sat_bw) / 10
 
             action_prob = actor.predict(np.reshape(state[agent], (1, S_INFO, PAST_LEN)))
-            noise = np.random.gumbel(size=len(action_prob))
+            noise = rng.gumbel(size=len(action_prob))
             action = np.argmax(np.log(action_prob) + noise)
 
             sat[agent] = action // A_DIM
@@ -198,6 +198,7 @@ def central_agent(net_params_queues, exp_queues):
 
 def agent(agent_id, net_params_queue, exp_queue):
     env = ABREnv(agent_id, num_agents=USERS, reward_func=REWARD_FUNC, train_traces=TRAIN_TRACES)
+    rng = np.random.default_rng(np.random.SeedSequence(RANDOM_SEED, spawn_key=(agent_id,)))
     with tf.Session() as sess:
         actor = network.Network(sess,
                                 state_dim=S_DIM, action_dim=A_DIM * MAX_SAT,
@@ -222,7 +223,7 @@ def agent(agent_id, net_params_queue, exp_queue):
                     np.reshape(obs[user_id], (1, S_DIM[0], S_DIM[1])))
 
                 # gumbel noise
-                noise = np.random.gumbel(size=len(action_prob[user_id]))
+                noise = rng.gumbel(size=len(action_prob[user_id]))
                 bit_rate[user_id] = np.argmax(np.log(action_prob[user_id]) + noise)
 
                 sat[user_id] = bit_rate[user_id] // A_DIM
@@ -256,7 +257,7 @@ def agent(agent_id, net_params_queue, exp_queue):
                         np.reshape(obs[agent], (1, S_DIM[0], S_DIM[1])))
 
                     # gumbel noise
-                    noise = np.random.gumbel(size=len(action_prob[agent]))
+                    noise = rng.gumbel(size=len(action_prob[agent]))
                     bit_rate[agent] = np.argmax(np.log(action_prob[agent]) + noise)
 
                     sat[agent] = bit_rate[agent] // A_DIM
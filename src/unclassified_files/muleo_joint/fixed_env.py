@@ -39,6 +39,11 @@ SMOOTH_PENALTY = 1
 # Multi-user setting
 NUM_AGENTS = 16
 
+# Agent states of the tick engine
+DOWNLOADING = 0
+REBUFFING = 1
+WAITING = 2
+
 
 class Environment:
     def __init__(self, all_cooked_time, all_cooked_bw, random_seed=RANDOM_SEED, num_agents=NUM_AGENTS):
@@ -52,44 +57,25 @@ class Environment:
 
         self.last_quality = DEFAULT_QUALITY
 
+        self.video_size = {}  # in bytes
+        for bitrate in range(BITRATE_LEVELS):
+            self.video_size[bitrate] = []
+            with open(VIDEO_SIZE_FILE + str(bitrate)) as f:
+                for line in f:
+                    self.video_size[bitrate].append(int(line.split()[0]))
+        # [bitrate, chunk] table for the vectorized lookups
+        self.video_size_table = np.array([self.video_size[bitrate] for bitrate in range(BITRATE_LEVELS)])
+
         # pick a random trace file
         self.trace_idx = 0
-        self.cooked_time = self.all_cooked_time[self.trace_idx]
-        self.cooked_bw = self.all_cooked_bw[self.trace_idx]
-
-        self.connection = {}
-        for sat_id, sat_bw in self.cooked_bw.items():
-            self.connection[sat_id] = -1
+        self.set_trace()
 
-        self.mahimahi_start_ptr = [1 for _ in range(self.num_agents)]
+        self.mahimahi_start_ptr = np.ones(self.num_agents, dtype=int)
         # randomize the start point of the trace
         # note: trace file starts with time 0
-        self.mahimahi_ptr = [1 for _ in range(self.num_agents)]
+        self.mahimahi_ptr = self.mahimahi_start_ptr.copy()
 
-        # multiuser setting
-        self.cur_sat_id = []
         self.prev_sat_id = [None for _ in range(self.num_agents)]
-        for agent in range(self.num_agents):
-            cur_sat_id = self.get_best_sat_id(agent)
-            self.connection[cur_sat_id] = agent
-            self.cur_sat_id.append(cur_sat_id)
-
-        # self.available_sat_list = self.get_available_sats_id()
-        self.delay = [0 for _ in range(self.num_agents)]
-        self.rebuf = [0 for _ in range(self.num_agents)]
-        self.state = [0 for _ in range(self.num_agents)]
-        self.video_chunk_counter = [0 for _ in range(self.num_agents)]
-        self.buffer_size = [0 for _ in range(self.num_agents)]
-        self.sleep_time = [0 for _ in range(self.num_agents)]
-        self.video_chunk_size = [0 for _ in range(self.num_agents)]
-        self.video_chunk_counter_sent = [0 for _ in range(self.num_agents)]
-        self.last_mahimahi_time = [
-            self.cooked_time[self.mahimahi_ptr[i] - 1] for i in range(self.num_agents)]
-        self.return_buffer_size = [0 for _ in range(self.num_agents)]
-        self.video_chunk_remain = [0 for _ in range(self.num_agents)]
-        self.end_of_video = [False for _ in range(self.num_agents)]
-        self.next_video_chunk_sizes = [[] for _ in range(self.num_agents)]
-        self.take_action = [False for _ in range(self.num_agents)]
         self.bit_rate = None
         self.download_bw = [[] for _ in range(self.num_agents)]
         self.past_download_ests = [[] for _ in range(self.num_agents)]
@@ -97,156 +83,141 @@ class Environment:
         self.past_bw_ests = [{} for _ in range(self.num_agents)]
         self.past_bw_errors = [{} for _ in range(self.num_agents)]
 
-        self.video_size = {}  # in bytes
-        for bitrate in range(BITRATE_LEVELS):
-            self.video_size[bitrate] = []
-            with open(VIDEO_SIZE_FILE + str(bitrate)) as f:
-                for line in f:
-                    self.video_size[bitrate].append(int(line.split()[0]))
+        self.reset()
+
+    def set_trace(self):
+        self.cooked_time = self.all_cooked_time[self.trace_idx]
+        self.cooked_bw = self.all_cooked_bw[self.trace_idx]
+
+        # [sat, time] bandwidth matrix so every agent's throughput is one fancy index per tick
+        self.sat_ids = list(self.cooked_bw.keys())
+        self.sat_index = {sat_id: index for index, sat_id in enumerate(self.sat_ids)}
+        self.time_array = np.asarray(self.cooked_time, dtype=float)
+        self.bw_matrix = np.array([self.cooked_bw[sat_id] for sat_id in self.sat_ids], dtype=float)
+
+    def switch_sat(self, agent, sat_id):
+        self.connection[self.cur_sat_id[agent]] = -1
+        self.connection[sat_id] = agent
+        self.prev_sat_id[agent] = self.cur_sat_id[agent]
+        self.cur_sat_id[agent] = sat_id
+        self.cur_sat_idx[agent] = self.sat_index[sat_id]
 
-    def chunk_end(self, agent):
-        self.return_buffer_size[agent] = self.buffer_size[agent]
+    def chunk_end(self, mask):
+        self.return_buffer_size[mask] = self.buffer_size[mask]
 
-        self.video_chunk_counter[agent] += 1
-        self.video_chunk_remain[agent] = TOTAL_VIDEO_CHUNCK - \
-            self.video_chunk_counter[agent]
+        self.video_chunk_counter[mask] += 1
+        self.video_chunk_remain[mask] = TOTAL_VIDEO_CHUNCK - self.video_chunk_counter[mask]
 
-        if self.video_chunk_counter[agent] >= TOTAL_VIDEO_CHUNCK:
-            self.end_of_video[agent] = True
-            self.buffer_size[agent] = 0
-            self.video_chunk_counter[agent] = 0
+        finished = mask & (self.video_chunk_counter >= TOTAL_VIDEO_CHUNCK)
+        self.end_of_video[finished] = True
+        self.buffer_size[finished] = 0
+        self.video_chunk_counter[finished] = 0
 
-        self.next_video_chunk_sizes[agent] = []
-        for i in range(BITRATE_LEVELS):
-            self.next_video_chunk_sizes[agent].append(
-                self.video_size[i][self.video_chunk_counter[agent]])
+        self.next_video_chunk_sizes[mask] = self.video_size_table[:, self.video_chunk_counter[mask]].T
 
         # Mark the end of chunk
-        self.take_action[agent] = True
-        self.state[agent] = 2
+        self.take_action[mask] = True
+        self.state[mask] = WAITING
 
-    def rebuffing(self, agent):
-        duration = self.cooked_time[self.mahimahi_ptr[agent]] \
-            - self.last_mahimahi_time[agent]
-        if duration > self.sleep_time[agent] / MILLISECONDS_IN_SECOND:
-            self.last_mahimahi_time[agent] += self.sleep_time[agent] / \
-                MILLISECONDS_IN_SECOND
-            self.chunk_end(agent)
+    def rebuffing(self, mask):
+        duration = self.time_array[self.mahimahi_ptr] - self.last_mahimahi_time
+        woke = mask & (duration > self.sleep_time / MILLISECONDS_IN_SECOND)
+        sleeping = mask & ~woke
 
-        self.sleep_time[agent] -= duration * MILLISECONDS_IN_SECOND
-        self.last_mahimahi_time[agent] = self.cooked_time[self.mahimahi_ptr[agent]]
+        self.last_mahimahi_time[woke] += self.sleep_time[woke] / MILLISECONDS_IN_SECOND
+        self.chunk_end(woke)
 
-    def buffering(self, agent):
+        self.sleep_time[sleeping] -= duration[sleeping] * MILLISECONDS_IN_SECOND
+        self.last_mahimahi_time[sleeping] = self.time_array[self.mahimahi_ptr[sleeping]]
 
-        self.delay[agent] *= MILLISECONDS_IN_SECOND
-        self.delay[agent] += LINK_RTT
+    def buffering(self, mask):
+        self.delay[mask] *= MILLISECONDS_IN_SECOND
+        self.delay[mask] += LINK_RTT
 
         # rebuffer time
-        self.rebuf[agent] = np.maximum(
-            self.delay[agent] - self.buffer_size[agent], 0.0)
+        self.rebuf[mask] = np.maximum(self.delay[mask] - self.buffer_size[mask], 0.0)
 
         # update the buffer
-        self.buffer_size[agent] = np.maximum(
-            self.buffer_size[agent] - self.delay[agent], 0.0)
+        self.buffer_size[mask] = np.maximum(self.buffer_size[mask] - self.delay[mask], 0.0)
 
         # add in the new chunk
-        self.buffer_size[agent] += VIDEO_CHUNCK_LEN
+        self.buffer_size[mask] += VIDEO_CHUNCK_LEN
 
         # sleep if buffer gets too large
-        self.sleep_time[agent] = 0
-        if self.buffer_size[agent] > BUFFER_THRESH:
-            # exceed the buffer limit
-            # we need to skip some network bandwidth here
-            # but do not add up the delay
-            drain_buffer_time = self.buffer_size[agent] - BUFFER_THRESH
-            self.sleep_time[agent] = np.ceil(drain_buffer_time / DRAIN_BUFFER_SLEEP_TIME) * \
-                DRAIN_BUFFER_SLEEP_TIME
-            self.buffer_size[agent] -= self.sleep_time[agent]
-        else:
-            self.chunk_end(agent)
-
-    def downloading(self, agent):
-        cur_sat_id = self.cur_sat_id[agent]
-        throughput = self.cooked_bw[cur_sat_id][self.mahimahi_ptr[agent]] \
-            * B_IN_MB / BITS_IN_BYTE
-
-        if throughput == 0.0:
+        self.sleep_time[mask] = 0
+        exceed = mask & (self.buffer_size > BUFFER_THRESH)
+        # exceed the buffer limit
+        # we need to skip some network bandwidth here
+        # but do not add up the delay
+        drain_buffer_time = self.buffer_size[exceed] - BUFFER_THRESH
+        self.sleep_time[exceed] = np.ceil(drain_buffer_time / DRAIN_BUFFER_SLEEP_TIME) * DRAIN_BUFFER_SLEEP_TIME
+        self.buffer_size[exceed] -= self.sleep_time[exceed]
+        self.state[exceed] = REBUFFING
+
+        self.chunk_end(mask & ~exceed)
+
+    def downloading(self, mask):
+        throughput = self.bw_matrix[self.cur_sat_idx, self.mahimahi_ptr] * B_IN_MB / BITS_IN_BYTE
+
+        # Forced handover is a transition, handle those agents one by one
+        for agent in np.flatnonzero(mask & (throughput == 0.0)):
             cur_sat_id = self.get_best_sat_id(agent)
-            pre_sat_id = self.cur_sat_id[agent]
-            self.prev_sat_id[agent] = pre_sat_id
-            self.connection[pre_sat_id] = -1
-            self.connection[cur_sat_id] = agent
-            self.cur_sat_id[agent] = cur_sat_id
+            if cur_sat_id is None:
+                continue
+            self.switch_sat(agent, cur_sat_id)
             self.delay[agent] += HANDOVER_DELAY
-            print("never")
-            # self.download_bw[agent] = []
-            # self.past_download_ests[agent] = []
-            # self.past_download_bw_errors[agent] = []
-            # self.past_bw_ests[agent] = {}
-            # self.past_bw_errors[agent] = {}
-
-        duration = self.cooked_time[self.mahimahi_ptr[agent]] \
-            - self.last_mahimahi_time[agent]
+            throughput[agent] = self.bw_matrix[self.cur_sat_idx[agent], self.mahimahi_ptr[agent]] \
+                * B_IN_MB / BITS_IN_BYTE
 
+        duration = self.time_array[self.mahimahi_ptr] - self.last_mahimahi_time
         packet_payload = throughput * duration * PACKET_PAYLOAD_PORTION
 
-        if self.video_chunk_counter_sent[agent] + packet_payload > self.video_chunk_size[agent]:
-            fractional_time = (self.video_chunk_size[agent] - self.video_chunk_counter_sent[agent]) / \
-                throughput / PACKET_PAYLOAD_PORTION
+        done = mask & (self.video_chunk_counter_sent + packet_payload > self.video_chunk_size)
+        going = mask & ~done
 
-            self.delay[agent] += fractional_time
-            self.last_mahimahi_time[agent] += fractional_time
-            self.state[agent] = 1
-            self.buffering(agent)
+        fractional_time = (self.video_chunk_size[done] - self.video_chunk_counter_sent[done]) / \
+            throughput[done] / PACKET_PAYLOAD_PORTION
+        self.delay[done] += fractional_time
+        self.last_mahimahi_time[done] += fractional_time
+        self.buffering(done)
+        for agent in np.flatnonzero(done):
             self.download_bw[agent].append(float(
                 self.video_chunk_size[agent]) / float(self.delay[agent]) / M_IN_K * BITS_IN_BYTE)
 
-        self.video_chunk_counter_sent[agent] += packet_payload
-        self.delay[agent] += duration
-        self.last_mahimahi_time[agent] = self.cooked_time[self.mahimahi_ptr[agent]]
-
-    def step_agent(self, agent):
-        if self.end_of_video[agent] == False:
-            if self.state[agent] == 0:
-                self.downloading(agent)
-            elif self.state[agent] == 2:
-                self.state[agent] = 0
-                self.downloading(agent)
-            else:
-                self.rebuffing(agent)
+        self.video_chunk_counter_sent[going] += packet_payload[going]
+        self.delay[going] += duration[going]
+        self.last_mahimahi_time[going] = self.time_array[self.mahimahi_ptr[going]]
 
     def step(self):
-        for i in range(self.num_agents):
-            self.step_agent(i)
-            self.mahimahi_ptr[i] += 1
-            # print('--------------------------', self.mahimahi_ptr)
-            # print(self.cur_sat_id)
-            if self.mahimahi_ptr[i] >= len(self.cooked_bw[self.cur_sat_id[agent]]):
-                print('--------------------------')
-                # print(self.mahimahi_ptr, len(self.cooked_bw[self.cur_sat_id[agent]]))
-                # loop back in the beginning
-                # note: trace file starts with time 0
-                self.mahimahi_ptr[i] = 1
-                self.last_mahimahi_time = [0 for _ in range(self.num_agents)]
-                # self.end_of_video[i] = True
-                # continue
+        active = ~self.end_of_video
+        downloading = active & (self.state == DOWNLOADING)
+        rebuffing = active & (self.state == REBUFFING)
 
-        for agent in range(self.num_agents):
-            if self.end_of_video[agent] == False:
-                return False
+        self.downloading(downloading)
+        # Agents that just started to sleep use up the rest of this tick as well
+        self.rebuffing(rebuffing | (downloading & (self.state == REBUFFING)))
+
+        self.mahimahi_ptr += 1
+        wrapped = self.mahimahi_ptr >= len(self.time_array)
+        if wrapped.any():
+            # loop back in the beginning
+            # note: trace file starts with time 0
+            self.mahimahi_ptr[wrapped] = 1
+            self.last_mahimahi_time[wrapped] = 0
+
+        if not self.end_of_video.all():
+            return False
 
         self.trace_idx += 1
         if self.trace_idx >= len(self.all_cooked_time):
             self.trace_idx = 0
 
-        self.cooked_time = self.all_cooked_time[self.trace_idx]
-        self.cooked_bw = self.all_cooked_bw[self.trace_idx]
+        self.set_trace()
 
         # randomize the start point of the video
         # note: trace file starts with time 0
-        for i in range(self.num_agents):
-            self.mahimahi_ptr[i] = self.mahimahi_start_ptr[i]
-            self.last_mahimahi_time[i] = self.cooked_time[self.mahimahi_ptr[i] - 1]
+        self.mahimahi_ptr[:] = self.mahimahi_start_ptr
+        self.last_mahimahi_time[:] = self.time_array[self.mahimahi_ptr - 1]
 
         return True
 
@@ -257,29 +228,29 @@ class Environment:
             self.connection[sat_id] = -1
 
         # multiuser setting
-
         self.cur_sat_id = []
+        self.cur_sat_idx = np.zeros(self.num_agents, dtype=int)
         for agent in range(self.num_agents):
             cur_sat_id = self.get_best_sat_id(agent)
             self.connection[cur_sat_id] = agent
             self.cur_sat_id.append(cur_sat_id)
+            self.cur_sat_idx[agent] = self.sat_index.get(cur_sat_id, 0)
 
         # self.available_sat_list = self.get_available_sats_id()
-        self.delay = [0 for _ in range(self.num_agents)]
-        self.rebuf = [0 for _ in range(self.num_agents)]
-        self.state = [0 for _ in range(self.num_agents)]
-        self.video_chunk_counter = [0 for _ in range(self.num_agents)]
-        self.buffer_size = [0 for _ in range(self.num_agents)]
-        self.sleep_time = [0 for _ in range(self.num_agents)]
-        self.video_chunk_size = [0 for _ in range(self.num_agents)]
-        self.video_chunk_counter_sent = [0 for _ in range(self.num_agents)]
-        self.last_mahimahi_time = [
-            self.cooked_time[self.mahimahi_ptr[i] - 1] for i in range(self.num_agents)]
-        self.return_buffer_size = [0 for _ in range(self.num_agents)]
-        self.video_chunk_remain = [0 for _ in range(self.num_agents)]
-        self.end_of_video = [False for _ in range(self.num_agents)]
-        self.next_video_chunk_sizes = [[] for _ in range(self.num_agents)]
-        self.take_action = [False for _ in range(self.num_agents)]
+        self.delay = np.zeros(self.num_agents)
+        self.rebuf = np.zeros(self.num_agents)
+        self.state = np.full(self.num_agents, DOWNLOADING)
+        self.video_chunk_counter = np.zeros(self.num_agents, dtype=int)
+        self.buffer_size = np.zeros(self.num_agents)
+        self.sleep_time = np.zeros(self.num_agents)
+        self.video_chunk_size = np.zeros(self.num_agents)
+        self.video_chunk_counter_sent = np.zeros(self.num_agents)
+        self.last_mahimahi_time = self.time_array[self.mahimahi_ptr - 1]
+        self.return_buffer_size = np.zeros(self.num_agents)
+        self.video_chunk_remain = np.zeros(self.num_agents, dtype=int)
+        self.end_of_video = np.zeros(self.num_agents, dtype=bool)
+        self.next_video_chunk_sizes = np.zeros((self.num_agents, BITRATE_LEVELS), dtype=int)
+        self.take_action = np.zeros(self.num_agents, dtype=bool)
 
     def get_result(self, agent, model_type):
         is_handover, new_sat_id, bit_rate = self.run_mpc(agent, model_type)
@@ -295,7 +266,7 @@ class Environment:
             bit_rate, is_handover, new_sat_id
 
     def get_action(self):
-        return self.take_action
+        return self.take_action.tolist()
 
     def set_video_chunk(self, quality, is_handover, new_sat_id, agent):
         assert quality >= 0
@@ -307,20 +278,17 @@ class Environment:
         self.delay[agent] = 0.0  # in ms
 
         if is_handover:
-            self.connection[self.cur_sat_id[agent]] = -1
-            self.connection[new_sat_id] = agent
-            self.prev_sat_id[agent] = self.cur_sat_id[agent]
-            self.cur_sat_id[agent] = new_sat_id
+            self.switch_sat(agent, new_sat_id)
             self.delay[agent] += HANDOVER_DELAY
             # self.download_bw[agent] = []
             # self.past_download_ests[agent] = []
             # self.past_download_bw_errors[agent] = []
             # self.past_bw_ests[agent] = {}
             # self.past_bw_errors[agent] = {}
-            
 
         self.video_chunk_counter_sent[agent] = 0  # in bytes
         self.take_action[agent] = False
+        self.state[agent] = DOWNLOADING
 
         self.last_quality = quality
 
@@ -0,0 +1,44 @@
+import importlib
+
+# scipy / statsmodels / pandas are only needed by the Holt-Winters predictors and the SLSQP ratio solver,
+# so they are imported on first use instead of when an environment module is loaded.
+HEAVY_MODULES = ("scipy", "statsmodels", "pandas")
+
+
+class LazyModule:
+    def __init__(self, module_name):
+        self.module_name = module_name
+        self.module = None
+
+    def load(self):
+        if self.module is None:
+            self.module = importlib.import_module(self.module_name)
+        return self.module
+
+    def __getattr__(self, attr):
+        if attr in ("module_name", "module"):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+
+class LazyAttr:
+    def __init__(self, module_name, attr):
+        self.module_name = module_name
+        self.attr = attr
+        self.target = None
+
+    def load(self):
+        if self.target is None:
+            self.target = getattr(importlib.import_module(self.module_name), self.attr)
+        return self.target
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+
+pd = LazyModule("pandas")
+minimize = LazyAttr("scipy.optimize", "minimize")
+LinearConstraint = LazyAttr("scipy.optimize", "LinearConstraint")
+ExponentialSmoothing = LazyAttr("statsmodels.tsa.api", "ExponentialSmoothing")
+SimpleExpSmoothing = LazyAttr("statsmodels.tsa.api", "SimpleExpSmoothing")
+Holt = LazyAttr("statsmodels.tsa.api", "Holt")
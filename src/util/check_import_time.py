@@ -0,0 +1,41 @@
+import subprocess
+import sys
+
+from util.backends import HEAVY_MODULES
+
+# Run from src/: python -m util.check_import_time
+IMPORT_TIME_BUDGET = 1.0  # seconds, per module in a fresh interpreter
+ENV_MODULES = [
+    "env.multi_bw_share.core_time",
+    "env.multi_bw_share.core_cent_time",
+    "env.multi_bw_share.fixed_env_time",
+    "env.multi_bw_share.fixed_env",
+    "env.multi_bw_share_weight.core_time",
+    "env.multi_bw_share_weight.fixed_env_time",
+    "env.multi_bw_share_multi_session.core_implicit_time",
+    "env.multi_bw_share_multi_session.fixed_env_time",
+]
+
+PROBE = """
+import sys, time
+start = time.time()
+import {module}
+print(time.time() - start)
+print(",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def check_module(module):
+    out = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                         capture_output=True, text=True, check=True).stdout.split("\n")
+    return float(out[0]), [m for m in out[1].split(",") if m]
+
+
+if __name__ == "__main__":
+    failed = False
+    for module in ENV_MODULES:
+        elapsed, loaded = check_module(module)
+        ok = elapsed <= IMPORT_TIME_BUDGET and not loaded
+        failed |= not ok
+        print("%-52s %.3fs %s %s" % (module, elapsed, "ok" if ok else "OVER BUDGET", ",".join(loaded)))
+    sys.exit(1 if failed else 0)
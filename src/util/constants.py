@@ -1,7 +1,8 @@
 SUPPORTED_SHARING = {'max-cap', 'resource-fair', 'ratio-based'}
-CENT_MPC_MODELS = ["DualMPC-Centralization-Reduced", "DualMPC-Centralization-Exhaustive", "Oracle"]
+CENT_MPC_MODELS = ["DualMPC-Centralization-Reduced", "DualMPC-Centralization-Exhaustive", "Oracle",
+                   "DualMPC-Centralization-Coordinated"]
 DIST_MPC_MODELS = ["ManifoldMPC", "DualMPC", "DualMPC-Centralization"]
-SEP_MPC_MODELS = ["MVT", "MRSS", "MRSS-Smart", "MB"]
+SEP_MPC_MODELS = ["MVT", "MRSS", "MRSS-Smart", "MB", "FastMPC"]
 VIDEO_BIT_RATE = [300, 750, 1200, 1850, 2850, 4300]  # Kbps
 BITRATE_REWARD = [1, 2, 3, 12, 15, 20]
 BUFFER_NORM_FACTOR = 10.0
@@ -38,6 +39,11 @@ SNR_NOISE_UNIT = 0.005
 
 MPC_FUTURE_CHUNK_COUNT = 3
 MPC_PAST_CHUNK_COUNT = 5
+# Holt additive-trend smoothing for the holt-winter bandwidth predictors; HOLT_FIT_TRACES refits them
+# once per trace corpus instead
+HOLT_ALPHA = 0.5
+HOLT_BETA = 0.1
+HOLT_FIT_TRACES = False
 
 # Multi-user config in the trace files
 # NUM_USERS = 10
@@ -52,6 +58,22 @@ PAST_SAT_LOG_LEN = 3
 
 NO_EXHAUSTIVE = True
 ADAPTIVE_BUF = False
+# Exact branch and bound instead of scanning every chunk combo in the reduced centralized MPC
+BNB_SEARCH = True
+# Dynamic programming over (position, quality, buffer bin) for the per-user chunk searches of the single-user,
+# distributed and branch-and-bound centralized MPCs. It costs horizon x levels^2 x buffer bins instead of
+# levels^horizon, so MPC_FUTURE_CHUNK_COUNT = 5 stays affordable, but plans with the buffer rounded down to
+# DP_BUFFER_STEP and keeps a single sequence per user
+DP_SEARCH = False
+DP_BUFFER_STEP = 0.1  # sec
+# Score every satellite and handover position of the distributed MPC in one vectorized pass instead of one
+# combo table per option, same decisions. The DP_SEARCH combos are still found one option at a time
+DIST_BATCH_SCORING = True
+# Coordinate-descent sweeps of the coordinated centralized MPC (util/coordinated_mpc.py)
+COORD_ITERATIONS = 3
+# Wall-clock budget in seconds of one centralized or oracle MPC decision. At the deadline the search returns
+# the best plan found so far; None searches to the end
+MPC_DECISION_BUDGET = None
 TEST_TRACES = '../../data/sat_data/test/'
 TRAIN_TRACES = '../../data/sat_data/train/'
 TEST_REAL_TRACES = '../../data/sat_data/real_test/'
@@ -62,6 +84,9 @@ TRAIN_NOAA_TRACES = '../../data/sat_data/noaa_train_trace/'
 TEST_NOAA_TRACES = '../../data/sat_data/noaa_test_trace/'
 
 VIDEO_SIZE_FILE = '../../data/video_data/envivio/video_size_'
+# Precomputed FastMPC decision tables, one per video manifest and reward function, built from src/ with
+# python -m util.fastmpc (src/data/fastmpc/ as seen from the model scripts)
+FASTMPC_TABLE_DIR = '../../data/fastmpc/'
 
 BUF_RATIO = 0.7
 BUF_RATIO_COMBO = 0.8
@@ -0,0 +1,274 @@
+import argparse
+import time
+
+import numpy as np
+
+from util.constants import MPC_FUTURE_CHUNK_COUNT, BITRATE_LEVELS, CHUNK_TIL_VIDEO_END_CAP, COORD_ITERATIONS, \
+    DP_SEARCH
+from util.mpc_kernel import get_chunk_sizes, get_download_times, get_ho_combos, solve_user_combo
+from util.fastmpc import load_video_size
+
+# Manifest of the gap report, relative to src/ where it is run (VIDEO_SIZE_FILE is relative to the model scripts)
+REPORT_VIDEO_SIZE_FILE = 'data/video_data/envivio/video_size_'
+
+
+class CoordinatedSearch:
+    """
+    Approximate centralized MPC over handover plans, by coordinate descent with per-satellite prices.
+
+    Under resource-fair sharing users are only coupled through how many of them sit on each satellite at each
+    position, so for a fixed plan every user solves its own chunk MPC. Instead of enumerating every plan, each
+    sweep prices one more user on a satellite at a position by the reward its current users would lose, and
+    every user in turn moves to the handover position that is best for itself net of the prices it puts on the
+    others. Sweeps stop when no user moves or after the given number of iterations, and the best plan seen is
+    kept. A sweep costs about users x (2 x horizon + 1) single-user solves, linear in the users.
+    """
+    def __init__(self, chunk_sizes, cur_bws, next_bws, cur_sat_ids, runner_up_sat_ids, sat_user_nums, ho_options,
+                 start_buffers, last_qualities, lengths, reward_func, pinned_qualities, ho_delay, dp=DP_SEARCH):
+        self.chunk_sizes = chunk_sizes
+        self.cur_bws = cur_bws
+        self.next_bws = next_bws
+        self.cur_sat_ids = cur_sat_ids
+        self.runner_up_sat_ids = runner_up_sat_ids
+        self.sat_user_nums = sat_user_nums
+        self.ho_options = ho_options
+        self.start_buffers = start_buffers
+        self.last_qualities = last_qualities
+        self.lengths = lengths
+        self.reward_func = reward_func
+        self.pinned_qualities = pinned_qualities
+        self.ho_delay = ho_delay
+        self.dp = dp
+        self.num_users = len(cur_bws)
+        # (user, handover position, user counts of its two satellites) -> (sequence, reward)
+        self.solved = {}
+        self.plans = {}
+
+    def get_sat_id(self, user, ho_position, position):
+        return self.cur_sat_ids[user] if ho_position > position else self.runner_up_sat_ids[user]
+
+    def get_counts(self, ho_positions):
+        # Users on every satellite at every position, as the reduced MPC counts them
+        counts = {sat_id: np.array([num] * MPC_FUTURE_CHUNK_COUNT) for sat_id, num in self.sat_user_nums.items()}
+        for user, ho_position in enumerate(ho_positions):
+            if self.runner_up_sat_ids[user] is not None:
+                counts[self.cur_sat_ids[user]][ho_position:] -= 1
+                counts[self.runner_up_sat_ids[user]][ho_position:] += 1
+        return counts
+
+    def move(self, counts, user, ho_position, new_ho_position):
+        counts = {sat_id: nums.copy() for sat_id, nums in counts.items()}
+        if self.runner_up_sat_ids[user] is not None:
+            counts[self.cur_sat_ids[user]][ho_position:] += 1
+            counts[self.runner_up_sat_ids[user]][ho_position:] -= 1
+            counts[self.cur_sat_ids[user]][new_ho_position:] -= 1
+            counts[self.runner_up_sat_ids[user]][new_ho_position:] += 1
+        return counts
+
+    def solve_user(self, user, ho_position, counts):
+        """
+        The user's own chunk MPC under the plan, with the bandwidth arithmetic of Environment.get_plan_schedule.
+        """
+        if self.cur_bws[user] is None:
+            return None, np.nan
+        length = int(self.lengths[user])
+        cur_nums = counts[self.cur_sat_ids[user]]
+        next_nums = counts[self.runner_up_sat_ids[user]] if self.runner_up_sat_ids[user] is not None else cur_nums
+        key = (user, ho_position, tuple(cur_nums[:length]), tuple(next_nums[:length]))
+        if key not in self.solved:
+            bws = np.full((1, MPC_FUTURE_CHUNK_COUNT), np.nan)
+            ho_delays = np.zeros((1, MPC_FUTURE_CHUNK_COUNT))
+            for position in range(length):
+                if ho_position > position:
+                    bws[0, position] = self.cur_bws[user] / cur_nums[position]
+                else:
+                    bws[0, position] = self.next_bws[user] / next_nums[position]
+                    if ho_position == position:
+                        ho_delays[0, position] = self.ho_delay
+            download_times = get_download_times(self.chunk_sizes[user:user + 1], bws, ho_delays)[0]
+            self.solved[key] = solve_user_combo(download_times.tolist(), self.start_buffers[user],
+                                                self.last_qualities[user], length, self.reward_func,
+                                                self.pinned_qualities[user], self.dp)
+        return self.solved[key]
+
+    def evaluate(self, ho_positions):
+        # Every user's solution under the plan and their mean reward, nan if no user has a bandwidth
+        key = tuple(ho_positions)
+        if key not in self.plans:
+            counts = self.get_counts(ho_positions)
+            solutions = [self.solve_user(user, ho_positions[user], counts) for user in range(self.num_users)]
+            rewards = [reward for _, reward in solutions]
+            score = np.nanmean(rewards) if not np.isnan(rewards).all() else np.nan
+            self.plans[key] = (solutions, score)
+        return self.plans[key]
+
+    def get_prices(self, ho_positions, counts):
+        """
+        {sat_id: [horizon]} reward the users of a satellite lose if one more user joins it at a position, and the
+        [users, horizon] share of every user in the price of the satellite it is on.
+        """
+        prices = {sat_id: np.zeros(MPC_FUTURE_CHUNK_COUNT) for sat_id in counts}
+        shares = np.zeros((self.num_users, MPC_FUTURE_CHUNK_COUNT))
+        for user in range(self.num_users):
+            _, reward = self.solve_user(user, ho_positions[user], counts)
+            if np.isnan(reward):
+                continue
+            for position in range(int(self.lengths[user])):
+                sat_id = self.get_sat_id(user, ho_positions[user], position)
+                crowded = {key: nums.copy() for key, nums in counts.items()}
+                crowded[sat_id][position] += 1
+                _, crowded_reward = self.solve_user(user, ho_positions[user], crowded)
+                shares[user, position] = max(reward - crowded_reward, 0.0)
+                prices[sat_id][position] += shares[user, position]
+        return prices, shares
+
+    def best_response(self, user, ho_positions, counts, prices, shares):
+        # Handover position with the best own reward net of the prices, staying put on ties
+        best_ho_position = ho_positions[user]
+        best_score = -np.inf
+        for ho_position in [ho_positions[user]] + [p for p in self.ho_options[user] if p != ho_positions[user]]:
+            moved = self.move(counts, user, ho_positions[user], ho_position)
+            _, reward = self.solve_user(user, ho_position, moved)
+            score = 0.0 if np.isnan(reward) else reward
+            for position in range(MPC_FUTURE_CHUNK_COUNT):
+                sat_id = self.get_sat_id(user, ho_position, position)
+                # Its own share is not a cost to the others
+                own_share = shares[user, position] \
+                    if sat_id == self.get_sat_id(user, ho_positions[user], position) else 0.0
+                score -= prices[sat_id][position] - own_share
+            if score > best_score:
+                best_ho_position, best_score = ho_position, score
+        return best_ho_position
+
+    def descend(self, ho_positions, order, iterations):
+        # Best plan seen from one starting plan and the sweeps run
+        ho_positions = list(ho_positions)
+        best_ho_positions = list(ho_positions)
+        best_score = self.evaluate(ho_positions)[1]
+        sweeps = 0
+        for _ in range(iterations):
+            sweeps += 1
+            counts = self.get_counts(ho_positions)
+            prices, shares = self.get_prices(ho_positions, counts)
+            moved = False
+            for user in order:
+                ho_position = self.best_response(user, ho_positions, counts, prices, shares)
+                if ho_position != ho_positions[user]:
+                    counts = self.move(counts, user, ho_positions[user], ho_position)
+                    ho_positions[user] = ho_position
+                    moved = True
+            score = self.evaluate(ho_positions)[1]
+            if np.isnan(best_score) or score > best_score:
+                best_ho_positions, best_score = list(ho_positions), score
+            if not moved:
+                break
+        return best_ho_positions, best_score, sweeps
+
+    def solve(self, start_plans, first_user=0, iterations=COORD_ITERATIONS):
+        """
+        Descent from every starting plan, as single moves get stuck where several users would have to move at once.
+
+        :param start_plans: plans with every position in the user's ho_options, see get_start_plans
+        :param first_user: user moved first in every sweep, the others follow in order
+        :return: best plan, its per-user (sequence, reward) solutions, its mean reward and the sweeps run
+        """
+        order = [first_user] + [user for user in range(self.num_users) if user != first_user]
+        best_ho_positions, best_score = None, np.nan
+        sweeps = 0
+        for start_plan in start_plans:
+            ho_positions, score, plan_sweeps = self.descend(start_plan, order, iterations)
+            sweeps += plan_sweeps
+            if best_ho_positions is None or score > best_score or (np.isnan(best_score) and not np.isnan(score)):
+                best_ho_positions, best_score = ho_positions, score
+        return best_ho_positions, self.evaluate(best_ho_positions)[0], best_score, sweeps
+
+
+def get_start_plans(ho_options, ho_positions=None):
+    """
+    ho_positions (every user staying if None) and every user handing over at once, moved into the options.
+    """
+    start_plans = []
+    for plan in [ho_positions or [MPC_FUTURE_CHUNK_COUNT] * len(ho_options), [0] * len(ho_options)]:
+        start_plan = [position if position in options else options[-1] for position, options in zip(plan, ho_options)]
+        if start_plan not in start_plans:
+            start_plans.append(start_plan)
+    return start_plans
+
+
+def get_random_instance(video_size, num_users, num_sats, rng, reward_func, ho_delay):
+    # Users spread over num_sats satellites with a runner-up each, bandwidths in Mbps like Environment.predict_bw
+    cur_sat_ids = rng.integers(num_sats, size=num_users).tolist()
+    runner_up_sat_ids = [int((sat_id + rng.integers(1, num_sats)) % num_sats) for sat_id in cur_sat_ids]
+    sat_bws = rng.uniform(2, 30, size=num_sats)
+    cur_bws = [float(sat_bws[sat_id]) for sat_id in cur_sat_ids]
+    next_bws = [float(sat_bws[sat_id]) for sat_id in runner_up_sat_ids]
+    sat_user_nums = {sat_id: cur_sat_ids.count(sat_id) for sat_id in range(num_sats)}
+    video_chunk_remain = rng.integers(1, int(CHUNK_TIL_VIDEO_END_CAP) + 1, size=num_users)
+    lengths = np.minimum(video_chunk_remain, MPC_FUTURE_CHUNK_COUNT)
+    chunk_sizes = get_chunk_sizes(video_size, [int(CHUNK_TIL_VIDEO_END_CAP - r) for r in video_chunk_remain],
+                                  lengths, MPC_FUTURE_CHUNK_COUNT)
+    ho_options = [list(range(MPC_FUTURE_CHUNK_COUNT + 1)) for _ in range(num_users)]
+    return CoordinatedSearch(chunk_sizes, cur_bws, next_bws, cur_sat_ids, runner_up_sat_ids, sat_user_nums,
+                             ho_options, rng.uniform(0, 20, size=num_users).tolist(),
+                             rng.integers(BITRATE_LEVELS, size=num_users).tolist(), lengths, reward_func,
+                             [None] * num_users, ho_delay)
+
+
+def report_gap(video_size, reward_func, users, samples, num_sats=3, exhaustive_users=4, ho_delay=0.2, seed=0):
+    """
+    Mean reward the coordinated search gives up against scoring every handover plan, both with the same exact
+    per-user chunk solves, on random decisions. Past exhaustive_users only the coordinated latency is reported.
+    """
+    rng = np.random.default_rng(seed)
+    for num_users in users:
+        gaps = []
+        exact = 0
+        sweeps = []
+        exhaustive_time = 0
+        coordinated_time = 0
+        for _ in range(samples):
+            search = get_random_instance(video_size, num_users, num_sats, rng, reward_func, ho_delay)
+            start = time.perf_counter()
+            _, _, score, sweep_count = search.solve(get_start_plans(search.ho_options))
+            coordinated_time += time.perf_counter() - start
+            sweeps.append(sweep_count)
+            if num_users > exhaustive_users:
+                continue
+
+            # A fresh search, so the exhaustive scan does not reuse the coordinated solves
+            search = CoordinatedSearch(search.chunk_sizes, search.cur_bws, search.next_bws, search.cur_sat_ids,
+                                       search.runner_up_sat_ids, search.sat_user_nums, search.ho_options,
+                                       search.start_buffers, search.last_qualities, search.lengths, reward_func,
+                                       search.pinned_qualities, ho_delay)
+            start = time.perf_counter()
+            best_score = max(search.evaluate(ho_positions)[1] for ho_positions in get_ho_combos(search.ho_options))
+            exhaustive_time += time.perf_counter() - start
+            gaps.append(best_score - score)
+            exact += best_score - score <= 1e-9
+
+        print("users", num_users, "reward", reward_func, "samples", samples, "sweeps mean %.2f max %d" % (
+            np.mean(sweeps), max(sweeps)))
+        if gaps:
+            gaps = np.array(gaps)
+            print("exact plan %.4f" % (exact / samples))
+            print("mean QoE gap per decision: mean %.5f p50 %.5f p99 %.5f max %.5f" % (
+                gaps.mean(), np.percentile(gaps, 50), np.percentile(gaps, 99), gaps.max()))
+            print("latency per decision: exhaustive %.1f ms, coordinated %.1f ms" % (
+                exhaustive_time / samples * 1e3, coordinated_time / samples * 1e3))
+        else:
+            print("latency per decision: coordinated %.1f ms" % (coordinated_time / samples * 1e3))
+
+
+if __name__ == "__main__":
+    # Run from src/: python -m util.coordinated_mpc
+    parser = argparse.ArgumentParser(description='QoE gap of the coordinated MPC against every handover plan')
+    parser.add_argument('--video-size-file', default=REPORT_VIDEO_SIZE_FILE)
+    parser.add_argument('--reward', nargs='+', default=["LIN", "HD"])
+    parser.add_argument('--users', type=int, nargs='+', default=[2, 3, 4, 8, 16])
+    parser.add_argument('--exhaustive-users', type=int, default=4)
+    parser.add_argument('--samples', type=int, default=200)
+    args = parser.parse_args()
+
+    manifest = load_video_size(args.video_size_file)
+    for reward in args.reward:
+        report_gap(manifest, reward, args.users, args.samples, exhaustive_users=args.exhaustive_users)
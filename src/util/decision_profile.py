@@ -0,0 +1,114 @@
+import time
+
+import numpy as np
+
+# Parts of one MPC decision, every stretch of its wall time is charged to exactly one of them
+PROFILE_PHASES = ("setup", "prediction", "combo_generation", "plan_scoring", "reward_eval", "pool_dispatch",
+                  "ratio_optimization", "selection")
+# Histogram edges: latencies in seconds (log spaced, 10us to 10s), counts (powers of two) and pruning ratios
+LATENCY_BINS = np.logspace(-5, 1, 19)
+COUNT_BINS = np.concatenate([[0], 2 ** np.arange(25)])
+RATIO_BINS = np.linspace(0, 1, 11)
+# (name, kept count, total count) of the pruning ratios derived from the decision counts
+PRUNING_RATIOS = (("plan_pruning", "ho_plans_searched", "ho_plans"),
+                  ("combo_pruning", "combos_scored", "combos"))
+
+
+class DecisionProfile:
+    """
+    Lap timer for MPC decisions.
+
+    begin() opens a decision, lap(phase) charges the time since the previous lap to phase and end() closes the
+    decision, charging what is left to selection. Laps and counts outside a decision are ignored, so code shared
+    with the non-MPC paths can lap freely. Time spent by inner pool workers is kept apart under workers, as it
+    overlaps with the pool_dispatch wall time of the parent.
+    """
+    def __init__(self):
+        self.records = []
+        self.current = None
+        self.start = None
+        self.last_lap = None
+
+    def begin(self, model_type):
+        self.current = {"model": model_type, "phases": dict.fromkeys(PROFILE_PHASES, 0.0),
+                        "workers": dict.fromkeys(PROFILE_PHASES, 0.0), "counts": {}}
+        self.start = self.last_lap = time.perf_counter()
+
+    def lap(self, phase):
+        if self.current is None:
+            return
+        now = time.perf_counter()
+        self.current["phases"][phase] += now - self.last_lap
+        self.last_lap = now
+
+    def count(self, name, value=1):
+        if self.current is None:
+            return
+        self.current["counts"][name] = self.current["counts"].get(name, 0) + value
+
+    def end(self, keep=True):
+        if self.current is None:
+            return None
+        self.lap("selection")
+        record = self.current
+        record["total"] = self.last_lap - self.start
+        self.current = None
+        if keep:
+            self.records.append(record)
+        return record
+
+    def merge_workers(self, worker_results):
+        # worker_results: [(result, worker record)] as returned by inner_pool.run_inner_reward
+        results = []
+        for result, record in worker_results:
+            if self.current is not None and record is not None:
+                for phase, seconds in record["phases"].items():
+                    self.current["workers"][phase] += seconds
+                for name, value in record["counts"].items():
+                    self.count(name, value)
+            results.append(result)
+        return results
+
+    def get_series(self):
+        # {model: {series name: [value per decision]}}
+        series = {}
+        for record in self.records:
+            model_series = series.setdefault(record["model"], {})
+            model_series.setdefault("total", []).append(record["total"])
+            for phase in PROFILE_PHASES:
+                model_series.setdefault(phase, []).append(record["phases"][phase])
+                if record["workers"][phase]:
+                    model_series.setdefault("worker_" + phase, []).append(record["workers"][phase])
+            for name, value in record["counts"].items():
+                model_series.setdefault(name, []).append(value)
+            for name, kept, total in PRUNING_RATIOS:
+                if record["counts"].get(total):
+                    model_series.setdefault(name, []).append(
+                        1 - record["counts"].get(kept, 0) / record["counts"][total])
+        return series
+
+    def write_histograms(self, path):
+        """
+        One block per model and series: decision count, mean, percentiles and the histogram counts, with the bin
+        edges written once at the top of the file. Phases a model never enters are left out.
+        """
+        ratio_names = [name for name, _, _ in PRUNING_RATIOS]
+        with open(path, 'w') as histogram_file:
+            histogram_file.write('latency_bins ' + ' '.join(str(edge) for edge in LATENCY_BINS) + '\n')
+            histogram_file.write('count_bins ' + ' '.join(str(edge) for edge in COUNT_BINS) + '\n')
+            histogram_file.write('ratio_bins ' + ' '.join(str(edge) for edge in RATIO_BINS) + '\n')
+            for model, model_series in self.get_series().items():
+                for name, values in model_series.items():
+                    values = np.asarray(values, dtype=float)
+                    if name in ratio_names:
+                        counts, _ = np.histogram(values, RATIO_BINS)
+                    elif name == "total" or name in PROFILE_PHASES or name.startswith("worker_"):
+                        if not values.any():
+                            continue
+                        counts, _ = np.histogram(np.clip(values, LATENCY_BINS[0], LATENCY_BINS[-1]), LATENCY_BINS)
+                    else:
+                        counts, _ = np.histogram(np.clip(values, COUNT_BINS[0], COUNT_BINS[-1]), COUNT_BINS)
+                    histogram_file.write('{} {} n={} mean={} p50={} p95={} max={}\n'.format(
+                        model, name, len(values), values.mean(), np.percentile(values, 50),
+                        np.percentile(values, 95), values.max()))
+                    histogram_file.write(' '.join(str(count) for count in counts) + '\n')
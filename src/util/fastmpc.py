@@ -0,0 +1,235 @@
+import argparse
+import hashlib
+import math
+import os
+import time
+
+import numpy as np
+
+from util.constants import MPC_FUTURE_CHUNK_COUNT, CHUNK_TIL_VIDEO_END_CAP, BITRATE_LEVELS, B_IN_MB, BITS_IN_BYTE, \
+    VIDEO_CHUNCK_LEN, MILLISECONDS_IN_SECOND, QUALITY_FACTOR, REBUF_PENALTY, SMOOTH_PENALTY, VIDEO_SIZE_FILE, \
+    FASTMPC_TABLE_DIR
+from util.mpc_kernel import get_combo_table, get_chunk_sizes, get_quality_terms, calculate_combo_rewards, \
+    calculate_qoe, select_best_combo, get_sequence_ids
+
+# Quantization of the single-user MPC state. A state is looked up at the grid point just below it, so the
+# table never plans with more buffer or bandwidth than the exact MPC was given.
+FASTMPC_BUFFER_STEP = 0.5  # sec
+FASTMPC_BUFFER_BINS = 121  # 0 to 60 sec, the buffer cap of the environments
+FASTMPC_MIN_BW = 0.05  # Mbps
+FASTMPC_MAX_BW = 200.0  # Mbps
+FASTMPC_BW_BINS = 128  # log-spaced between FASTMPC_MIN_BW and FASTMPC_MAX_BW
+
+# Tables opened in this process, keyed by get_table_key
+FASTMPC_TABLES = {}
+
+# Paths of the table build, relative to src/ where it is run (the constants are relative to the model scripts)
+REPORT_VIDEO_SIZE_FILE = 'data/video_data/envivio/video_size_'
+REPORT_TABLE_DIR = 'data/fastmpc/'
+
+
+def get_buffer_grid():
+    return np.arange(FASTMPC_BUFFER_BINS) * FASTMPC_BUFFER_STEP
+
+
+def get_bw_grid():
+    return np.geomspace(FASTMPC_MIN_BW, FASTMPC_MAX_BW, FASTMPC_BW_BINS)
+
+
+def load_video_size(video_size_file=VIDEO_SIZE_FILE):
+    # Same layout as Environment.video_size
+    video_size = {}
+    for bitrate in range(BITRATE_LEVELS):
+        video_size[bitrate] = []
+        with open(video_size_file + str(bitrate)) as f:
+            for line in f:
+                video_size[bitrate].append(int(line.split()[0]))
+    return video_size
+
+
+def get_table_key(video_size, reward_func):
+    """
+    Digest of everything a table depends on: the manifest, the reward function, the grid and the MPC constants.
+    """
+    digest = hashlib.md5()
+    for bitrate in range(BITRATE_LEVELS):
+        digest.update(np.asarray(video_size[bitrate], dtype=np.int64).tobytes())
+    digest.update(repr((reward_func, MPC_FUTURE_CHUNK_COUNT, CHUNK_TIL_VIDEO_END_CAP, get_combo_table(1, 1).tolist(),
+                        FASTMPC_BUFFER_STEP, FASTMPC_BUFFER_BINS, FASTMPC_MIN_BW, FASTMPC_MAX_BW, FASTMPC_BW_BINS,
+                        QUALITY_FACTOR, REBUF_PENALTY, SMOOTH_PENALTY, VIDEO_CHUNCK_LEN)).encode())
+    return reward_func + "_" + digest.hexdigest()[:16]
+
+
+def build_fastmpc_table(video_size, reward_func):
+    """
+    Best combo of the single-user MPC (Environment.calculate_mpc) at every grid state.
+
+    :return: combo ids into get_combo_table(1, MPC_FUTURE_CHUNK_COUNT) as a
+             [chunks remaining, last quality, buffer bin, bandwidth bin] uint8 array, and their rewards as float16
+    """
+    combos = get_combo_table(1, MPC_FUTURE_CHUNK_COUNT)
+    assert len(combos) <= np.iinfo(np.uint8).max + 1
+    first_qualities = combos[:, 0, 0]
+    buffers = get_buffer_grid()
+    bws = get_bw_grid()
+    shape = (int(CHUNK_TIL_VIDEO_END_CAP) + 1, BITRATE_LEVELS, len(buffers), len(bws))
+    table = np.zeros(shape, dtype=np.uint8)
+    table_rewards = np.zeros(shape, dtype=np.float16)
+
+    for video_chunk_remain in range(shape[0]):
+        future_chunk_length = min(video_chunk_remain, MPC_FUTURE_CHUNK_COUNT)
+        last_index = int(CHUNK_TIL_VIDEO_END_CAP - video_chunk_remain)
+        chunk_sizes = get_chunk_sizes(video_size, [last_index], [future_chunk_length], MPC_FUTURE_CHUNK_COUNT)[0]
+
+        # The buffer recursion of calculate_combo_rewards over [combo, buffer, bandwidth] at once
+        curr_rebuffer_time = np.zeros((len(combos), len(buffers), len(bws)))
+        curr_buffer = np.broadcast_to(buffers[None, :, None], curr_rebuffer_time.shape)
+        for position in range(future_chunk_length):
+            sizes = chunk_sizes[combos[:, 0, position], position]
+            download_time = 0.0 + (sizes[:, None, None] / B_IN_MB) / bws[None, None, :] * BITS_IN_BYTE
+            rebuffer = curr_buffer < download_time
+            curr_rebuffer_time = np.where(rebuffer, curr_rebuffer_time + (download_time - curr_buffer),
+                                          curr_rebuffer_time)
+            curr_buffer = np.where(rebuffer, 0.0, curr_buffer - download_time) \
+                + VIDEO_CHUNCK_LEN / MILLISECONDS_IN_SECOND
+
+        for last_quality in range(BITRATE_LEVELS):
+            bitrate_sum, smoothness_diffs = get_quality_terms(MPC_FUTURE_CHUNK_COUNT, future_chunk_length,
+                                                              last_quality, reward_func)
+            rewards = calculate_qoe(bitrate_sum[:, None, None], curr_rebuffer_time,
+                                    smoothness_diffs[:, None, None], reward_func)
+            # select_best_combo on every grid state: the best reward, then the highest first quality,
+            # then the last combo in table order
+            best = rewards.max(axis=0)
+            tie_rank = np.where(rewards == best, first_qualities[:, None, None] * len(combos)
+                                + np.arange(len(combos))[:, None, None], -1)
+            best_index = tie_rank.argmax(axis=0)
+            table[video_chunk_remain, last_quality] = best_index
+            table_rewards[video_chunk_remain, last_quality] = best
+    return table, table_rewards
+
+
+class FastMPCTable:
+    """
+    FastMPC lookup table of the single-user MPC, see build_fastmpc_table.
+    """
+
+    def __init__(self, table, rewards):
+        self.table = table
+        self.rewards = rewards
+        self.combos = get_combo_table(1, MPC_FUTURE_CHUNK_COUNT)[:, 0, :].tolist()
+        self.log_min_bw = math.log(FASTMPC_MIN_BW)
+        self.log_bw_step = (math.log(FASTMPC_MAX_BW) - self.log_min_bw) / (FASTMPC_BW_BINS - 1)
+
+    def get_bins(self, start_buffer, cur_download_bw):
+        buffer_bin = min(max(int(start_buffer / FASTMPC_BUFFER_STEP), 0), FASTMPC_BUFFER_BINS - 1)
+        if cur_download_bw <= FASTMPC_MIN_BW:
+            return buffer_bin, 0
+        # A hair of slack so a bandwidth sitting on a grid point is not pushed one bin down by rounding
+        bw_bin = int((math.log(cur_download_bw) - self.log_min_bw) / self.log_bw_step + 1e-9)
+        return buffer_bin, min(bw_bin, FASTMPC_BW_BINS - 1)
+
+    def lookup(self, video_chunk_remain, last_quality, start_buffer, cur_download_bw):
+        """
+        :return: (best combo over the future chunks, its reward at the grid state)
+        """
+        video_chunk_remain = min(max(int(video_chunk_remain), 0), self.table.shape[0] - 1)
+        buffer_bin, bw_bin = self.get_bins(start_buffer, cur_download_bw)
+        combo_id = self.table[video_chunk_remain, last_quality, buffer_bin, bw_bin]
+        future_chunk_length = min(video_chunk_remain, MPC_FUTURE_CHUNK_COUNT)
+        return self.combos[combo_id][:future_chunk_length], \
+            float(self.rewards[video_chunk_remain, last_quality, buffer_bin, bw_bin])
+
+
+def get_fastmpc_table(video_size, reward_func, table_dir=FASTMPC_TABLE_DIR, build=False):
+    """
+    Table of the given manifest and reward function, memory-mapped from table_dir.
+
+    The tables are built ahead of time by running this module, a missing table is only built here with build=True.
+    """
+    key = get_table_key(video_size, reward_func)
+    if key not in FASTMPC_TABLES:
+        combo_path = os.path.join(table_dir, "fastmpc_" + key + "_combos.npy")
+        reward_path = os.path.join(table_dir, "fastmpc_" + key + "_rewards.npy")
+        if not os.path.exists(combo_path) or not os.path.exists(reward_path):
+            if not build:
+                raise Exception("No FastMPC table " + key + " in " + table_dir
+                                + ", build it from src/ with: python -m util.fastmpc --reward " + reward_func)
+            table, rewards = build_fastmpc_table(video_size, reward_func)
+            os.makedirs(table_dir, exist_ok=True)
+            np.save(reward_path, rewards)
+            np.save(combo_path, table)
+        # Plain array views of the maps, scalar indexing through np.memmap costs a few microseconds more
+        FASTMPC_TABLES[key] = FastMPCTable(np.asarray(np.load(combo_path, mmap_mode="r")),
+                                           np.asarray(np.load(reward_path, mmap_mode="r")))
+    return FASTMPC_TABLES[key]
+
+
+def solve_exact(video_size, reward_func, video_chunk_remain, last_quality, start_buffer, cur_download_bw):
+    # Environment.calculate_mpc without the environment
+    future_chunk_length = min(video_chunk_remain, MPC_FUTURE_CHUNK_COUNT)
+    last_index = int(CHUNK_TIL_VIDEO_END_CAP - video_chunk_remain)
+    combos = get_combo_table(1, MPC_FUTURE_CHUNK_COUNT)
+    chunk_sizes = get_chunk_sizes(video_size, [last_index], [future_chunk_length], MPC_FUTURE_CHUNK_COUNT)
+    rewards = calculate_combo_rewards(combos, chunk_sizes, np.full((1, MPC_FUTURE_CHUNK_COUNT), cur_download_bw),
+                                      np.zeros((1, MPC_FUTURE_CHUNK_COUNT)), [start_buffer], [last_quality],
+                                      [future_chunk_length], reward_func)[:, 0]
+    best_index = select_best_combo(rewards, combos[:, 0, 0], -10000000, -1)
+    return combos[best_index, 0, :future_chunk_length].tolist(), rewards
+
+
+def report_gap(video_size, reward_func, table, samples, seed=0):
+    """
+    QoE the lookup gives up against the exact single-user MPC on random states, both scored by the MPC model.
+    """
+    rng = np.random.default_rng(seed)
+    combos = get_combo_table(1, MPC_FUTURE_CHUNK_COUNT)[:, 0, :]
+    gaps = []
+    same_quality = 0
+    exact_time = 0
+    fast_time = 0
+    for _ in range(samples):
+        video_chunk_remain = int(rng.integers(1, CHUNK_TIL_VIDEO_END_CAP + 1))
+        last_quality = int(rng.integers(BITRATE_LEVELS))
+        start_buffer = float(rng.uniform(0, (FASTMPC_BUFFER_BINS - 1) * FASTMPC_BUFFER_STEP))
+        cur_download_bw = float(np.exp(rng.uniform(np.log(FASTMPC_MIN_BW), np.log(FASTMPC_MAX_BW))))
+
+        start = time.perf_counter()
+        best_combo, rewards = solve_exact(video_size, reward_func, video_chunk_remain, last_quality, start_buffer,
+                                          cur_download_bw)
+        exact_time += time.perf_counter() - start
+        start = time.perf_counter()
+        fast_combo, _ = table.lookup(video_chunk_remain, last_quality, start_buffer, cur_download_bw)
+        fast_time += time.perf_counter() - start
+
+        # The lookup combo is padded like the table rows so it can be scored with the exact rewards
+        padded = fast_combo + combos[0, len(fast_combo):].tolist()
+        gaps.append(np.nanmax(rewards) - rewards[int(get_sequence_ids(np.array([[padded]]))[0, 0])])
+        same_quality += fast_combo[0] == best_combo[0]
+
+    gaps = np.array(gaps)
+    print("reward", reward_func, "samples", samples)
+    print("first quality agreement %.4f" % (same_quality / samples))
+    print("QoE gap per decision: mean %.5f p50 %.5f p99 %.5f max %.5f" % (
+        gaps.mean(), np.percentile(gaps, 50), np.percentile(gaps, 99), gaps.max()))
+    print("latency per decision: exact %.1f us, table %.2f us" % (exact_time / samples * 1e6,
+                                                                  fast_time / samples * 1e6))
+
+
+if __name__ == "__main__":
+    # Run from src/: python -m util.fastmpc
+    parser = argparse.ArgumentParser(description='Build the FastMPC tables and report their QoE gap')
+    parser.add_argument('--video-size-file', default=REPORT_VIDEO_SIZE_FILE)
+    parser.add_argument('--table-dir', default=REPORT_TABLE_DIR)
+    parser.add_argument('--reward', nargs='+', default=["LIN", "HD"])
+    parser.add_argument('--samples', type=int, default=2000)
+    args = parser.parse_args()
+
+    manifest = load_video_size(args.video_size_file)
+    for reward in args.reward:
+        start_time = time.time()
+        fastmpc_table = get_fastmpc_table(manifest, reward, args.table_dir, build=True)
+        print("table", get_table_key(manifest, reward), fastmpc_table.table.shape,
+              "%.1f MB" % ((fastmpc_table.table.nbytes + fastmpc_table.rewards.nbytes) / 1e6),
+              "ready in %.1fs" % (time.time() - start_time))
+        report_gap(manifest, reward, fastmpc_table, args.samples)
@@ -0,0 +1,73 @@
+import numpy as np
+
+from util.constants import HOLT_ALPHA, HOLT_BETA
+
+# Smoothing parameters tried when fitting a trace corpus
+HOLT_ALPHA_GRID = np.linspace(0.05, 1.0, 20)
+HOLT_BETA_GRID = np.linspace(0.0, 1.0, 21)
+
+# Fitted (alpha, beta) per trace corpus, keyed like TRACE_MATRICES
+HOLT_PARAMS = {}
+
+
+def new_holt_state(shape=()):
+    # (level, trend, samples since the last zero)
+    return np.zeros(shape), np.zeros(shape), np.zeros(shape, dtype=int)
+
+
+def holt_update(state, values, alpha=HOLT_ALPHA, beta=HOLT_BETA):
+    """
+    Feed samples into a Holt additive-trend state, O(1) per sample.
+
+    The state may hold arrays, so one call moves a whole bank of satellites forward with each row of
+    values holding one sample per satellite. A zero sample (satellite out of sight) restarts the series,
+    as the window fits did by dropping leading zeros. The first sample sets the level and the second the
+    trend, like statsmodels' heuristic initialization.
+    """
+    level, trend, count = state
+    for value in values:
+        value = np.asarray(value, dtype=float)
+        new_level = np.where(count < 2, value, alpha * value + (1 - alpha) * (level + trend))
+        new_trend = np.where(count == 0, 0.0,
+                             np.where(count == 1, value - level, beta * (new_level - level) + (1 - beta) * trend))
+        visible = value != 0
+        level = np.where(visible, new_level, 0.0)
+        trend = np.where(visible, new_trend, 0.0)
+        count = np.where(visible, count + 1, 0)
+    return level, trend, count
+
+
+def holt_forecast(state, steps=1):
+    level, trend, _ = state
+    return level + steps * trend
+
+
+def fit_holt_params(series, alphas=HOLT_ALPHA_GRID, betas=HOLT_BETA_GRID):
+    """
+    Grid search of the (alpha, beta) pair with the lowest one-step-ahead squared error.
+
+    :param series: [N, T] array, e.g. a trace matrix from get_trace_matrix
+    """
+    series = np.asarray(series, dtype=float)
+    alpha = alphas[:, None, None]
+    beta = betas[None, :, None]
+    state = new_holt_state((len(alphas), len(betas), series.shape[0]))
+    sq_error = np.zeros((len(alphas), len(betas)))
+    for value in series.T:
+        scored = (state[2] >= 2) & (value != 0)
+        sq_error += np.where(scored, (holt_forecast(state) - value) ** 2, 0.0).sum(axis=-1)
+        state = holt_update(state, [value], alpha, beta)
+    best_alpha, best_beta = np.unravel_index(sq_error.argmin(), sq_error.shape)
+    return float(alphas[best_alpha]), float(betas[best_beta])
+
+
+def get_holt_params(all_cooked_bw):
+    """
+    Smoothing parameters fitted once on every satellite series of a trace corpus.
+    """
+    key = id(all_cooked_bw)
+    if key not in HOLT_PARAMS or HOLT_PARAMS[key][0] is not all_cooked_bw:
+        series = [sat_bw for cooked_bw in all_cooked_bw for sat_bw in cooked_bw.values()]
+        length = min(len(sat_bw) for sat_bw in series)
+        HOLT_PARAMS[key] = (all_cooked_bw, fit_holt_params([sat_bw[:length] for sat_bw in series]))
+    return HOLT_PARAMS[key][1]
@@ -0,0 +1,464 @@
+import itertools
+
+import numpy as np
+
+from util.constants import BITRATE_LEVELS, BITRATE_WEIGHT, B_IN_MB, BITS_IN_BYTE, VIDEO_CHUNCK_LEN, \
+    MILLISECONDS_IN_SECOND, VIDEO_BIT_RATE, BITRATE_REWARD, QUALITY_FACTOR, REBUF_PENALTY, SMOOTH_PENALTY, M_IN_K, \
+    DP_BUFFER_STEP
+
+
+# Combo tables and per-sequence QoE terms only depend on their key, so every decision reuses the same
+# read-only arrays instead of rebuilding them from itertools.product.
+COMBO_TABLES = {}
+CHUNK_COMBOS = {}
+HO_TABLES = {}
+QUALITY_TERMS = {}
+
+# Slack on the branch-and-bound pruning test so float rounding in a bound never drops a tied optimum
+BOUND_TOLERANCE = 1e-6
+
+
+def read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+def get_combo_table(num_users, horizon):
+    """
+    All bitrate combinations as a [C, users, horizon] int array, in itertools.product order.
+    """
+    key = (num_users, horizon)
+    if key not in COMBO_TABLES:
+        qualities = [BITRATE_WEIGHT * x for x in range(int(BITRATE_LEVELS / BITRATE_WEIGHT))]
+        table = np.array(list(itertools.product(qualities, repeat=horizon * num_users)), dtype=int)
+        COMBO_TABLES[key] = read_only(table.reshape(-1, num_users, horizon))
+    return COMBO_TABLES[key]
+
+
+def get_ho_table(num_users, horizon):
+    """
+    All handover positions as a [C, users] int array in itertools.product order, horizon meaning no handover.
+    """
+    key = (num_users, horizon)
+    if key not in HO_TABLES:
+        table = np.array(list(itertools.product(range(horizon + 1), repeat=num_users)), dtype=int)
+        HO_TABLES[key] = read_only(table.reshape(-1, num_users))
+    return HO_TABLES[key]
+
+
+def get_sequence_ids(combos):
+    """
+    [C, users] index of every user's quality sequence in a single-user combo table of the same horizon.
+    """
+    horizon = combos.shape[2]
+    base = int(BITRATE_LEVELS / BITRATE_WEIGHT)
+    return (combos // BITRATE_WEIGHT) @ (base ** np.arange(horizon - 1, -1, -1))
+
+
+def get_bitrate_table(reward_func):
+    if reward_func == "LIN":
+        return np.array(VIDEO_BIT_RATE)
+    elif reward_func == "HD":
+        return np.array(BITRATE_REWARD)
+    else:
+        raise Exception
+
+
+def calculate_qoe(bitrate_sum, rebuffer_time, smoothness_diffs, reward_func):
+    if reward_func == "LIN":
+        return bitrate_sum * QUALITY_FACTOR / M_IN_K - (REBUF_PENALTY * rebuffer_time) \
+               - SMOOTH_PENALTY * smoothness_diffs / M_IN_K
+    else:
+        return bitrate_sum - (8 * rebuffer_time) - smoothness_diffs
+
+
+def get_quality_terms(horizon, length, last_quality, reward_func):
+    """
+    Bitrate sum and smoothness of every single-user quality sequence over its first length positions,
+    indexed like get_sequence_ids.
+    """
+    key = (horizon, length, last_quality, reward_func)
+    if key not in QUALITY_TERMS:
+        bitrate_table = get_bitrate_table(reward_func)
+        sequences = get_combo_table(1, horizon)[:, 0, :]
+        bitrate_sum = np.zeros(len(sequences), dtype=bitrate_table.dtype)
+        smoothness_diffs = np.zeros(len(sequences), dtype=bitrate_table.dtype)
+        last_bitrate = np.full(len(sequences), bitrate_table[last_quality])
+        for position in range(min(length, horizon)):
+            bitrate = bitrate_table[sequences[:, position]]
+            bitrate_sum = bitrate_sum + bitrate
+            smoothness_diffs = smoothness_diffs + np.abs(bitrate - last_bitrate)
+            last_bitrate = bitrate
+        QUALITY_TERMS[key] = (read_only(bitrate_sum), read_only(smoothness_diffs))
+    return QUALITY_TERMS[key]
+
+
+def get_chunk_sizes(video_size, last_indexes, lengths, horizon):
+    """
+    [users, BITRATE_LEVELS, horizon] chunk sizes in bytes, nan past each user's remaining chunks.
+    """
+    chunk_sizes = np.full((len(last_indexes), BITRATE_LEVELS, horizon), np.nan)
+    for user, (last_index, length) in enumerate(zip(last_indexes, lengths)):
+        for quality in range(BITRATE_LEVELS):
+            chunk_sizes[user, quality, :length] = video_size[quality][last_index:last_index + length]
+    return chunk_sizes
+
+
+def calculate_combo_rewards(combos, chunk_sizes, bws, ho_delays, start_buffers, last_qualities, lengths,
+                            reward_func):
+    """
+    QoE of every combo for every user, the same arithmetic as the per-combo loops in the environments.
+
+    :param combos: [C, users, horizon] bitrate indexes
+    :param chunk_sizes: [users, BITRATE_LEVELS, horizon] from get_chunk_sizes
+    :param bws: [users, horizon] predicted download bandwidth per position, all nan for users without one
+    :param ho_delays: [users, horizon] handover delay in seconds each chunk pays, 0 without a handover
+    :param lengths: number of positions that count for each user
+    :return: [C, users] rewards
+    """
+    num_combos, num_users, horizon = combos.shape
+    user_index = np.arange(num_users)
+    lengths = np.asarray(lengths)
+
+    # Bitrate and smoothness terms only depend on each user's own sequence, so they come from the cache
+    sequence_ids = get_sequence_ids(combos)
+    bitrate_sum = []
+    smoothness_diffs = []
+    for user in range(num_users):
+        user_bitrate_sum, user_smoothness_diffs = get_quality_terms(horizon, int(lengths[user]),
+                                                                    int(last_qualities[user]), reward_func)
+        bitrate_sum.append(user_bitrate_sum[sequence_ids[:, user]])
+        smoothness_diffs.append(user_smoothness_diffs[sequence_ids[:, user]])
+    bitrate_sum = np.stack(bitrate_sum, axis=1)
+    smoothness_diffs = np.stack(smoothness_diffs, axis=1)
+
+    curr_rebuffer_time = np.zeros((num_combos, num_users))
+    curr_buffer = np.tile(np.asarray(start_buffers, dtype=float), (num_combos, 1))
+
+    # Only the buffer recursion is sequential, every combo and user moves one position per pass
+    for position in range(horizon):
+        active = lengths > position
+        if not active.any():
+            break
+        chunk_quality = combos[:, :, position]
+        download_time = ho_delays[:, position] + (chunk_sizes[user_index, chunk_quality, position] / B_IN_MB) \
+                        / bws[:, position] * BITS_IN_BYTE
+
+        rebuffer = curr_buffer < download_time
+        curr_rebuffer_time = np.where(active & rebuffer, curr_rebuffer_time + (download_time - curr_buffer),
+                                      curr_rebuffer_time)
+        next_buffer = np.where(rebuffer, 0.0, curr_buffer - download_time) + VIDEO_CHUNCK_LEN / MILLISECONDS_IN_SECOND
+        curr_buffer = np.where(active, next_buffer, curr_buffer)
+
+    rewards = calculate_qoe(bitrate_sum, curr_rebuffer_time, smoothness_diffs, reward_func)
+    return np.where(np.isnan(bws).all(axis=1), np.nan, rewards)
+
+
+def select_best_combo(scores, first_qualities, max_score, best_first_quality):
+    """
+    Index the per-combo scan keeps: a higher score wins, an equal score wins if its first quality is >= the kept one.
+
+    :param max_score: score kept before the scan
+    :param best_first_quality: first quality of the combo kept before the scan
+    :return: the index, or None if the kept combo survives
+    """
+    valid = ~np.isnan(scores)
+    if not valid.any():
+        return None
+    best = scores[valid].max()
+    if best < max_score:
+        return None
+    ties = np.flatnonzero(scores == best)
+    tie_qualities = first_qualities[ties]
+    top_quality = tie_qualities.max()
+    if best == max_score and not top_quality >= best_first_quality:
+        return None
+    return int(ties[np.flatnonzero(tie_qualities == top_quality)[-1]])
+
+
+def get_chunk_combos(num_users, horizon, pinned_qualities):
+    """
+    Chunk combos as [C, users * horizon] in itertools.product order, built only over the users that are free.
+
+    :param pinned_qualities: per user the quality it repeats at every position, None for a free user
+    :return: the rows the full product would keep after dropping every pinned user's other qualities
+    """
+    qualities = [BITRATE_WEIGHT * x for x in range(int(BITRATE_LEVELS / BITRATE_WEIGHT))]
+    pinned_qualities = tuple(None if q is None else qualities[qualities.index(q)] if q in qualities else -1
+                             for q in pinned_qualities)
+    key = (num_users, horizon, pinned_qualities)
+    if key not in CHUNK_COMBOS:
+        free_users = [i for i in range(num_users) if pinned_qualities[i] is None]
+        if -1 in pinned_qualities:
+            free_combos = np.zeros((0, len(free_users), horizon), dtype=int)
+        else:
+            free_combos = get_combo_table(len(free_users), horizon)
+        combos = np.empty((len(free_combos), num_users, horizon), dtype=int)
+        for i in range(num_users):
+            if pinned_qualities[i] is None:
+                combos[:, i, :] = free_combos[:, free_users.index(i), :]
+            else:
+                combos[:, i, :] = pinned_qualities[i]
+        CHUNK_COMBOS[key] = read_only(combos.reshape(len(free_combos), num_users * horizon))
+    return CHUNK_COMBOS[key]
+
+
+def get_ho_combos(ho_options, skip_all_zero=False):
+    """
+    Handover positions per user in itertools.product order, ho_options[i] being the positions user i can take.
+    """
+    return [list(combo) for combo in itertools.product(*ho_options) if not (skip_all_zero and not any(combo))]
+
+
+def get_download_times(chunk_sizes, bws, ho_delays):
+    """
+    [users, BITRATE_LEVELS, horizon] seconds to fetch every chunk, with the arithmetic of calculate_combo_rewards.
+    """
+    return ho_delays[:, None, :] + (chunk_sizes / B_IN_MB) / bws[:, None, :] * BITS_IN_BYTE
+
+
+def get_user_qualities(pinned_quality):
+    qualities = [BITRATE_WEIGHT * x for x in range(int(BITRATE_LEVELS / BITRATE_WEIGHT))]
+    if pinned_quality is None:
+        return qualities
+    if pinned_quality not in qualities:
+        return []
+    return [qualities[qualities.index(pinned_quality)]]
+
+
+class UserComboSearch:
+    """
+    Depth-first branch and bound over one user's quality sequence for a fixed bandwidth schedule.
+
+    The bound of a prefix takes the top bitrate for every remaining chunk, no further smoothness cost and the
+    rebuffering of fetching the smallest chunk at each remaining position, which no real suffix can beat.
+    Every sequence within BOUND_TOLERANCE of the best is kept, so ties in the mean over users are not lost.
+    """
+    def __init__(self, download_times, start_buffer, last_quality, length, reward_func, pinned_quality=None):
+        self.download_times = download_times
+        self.start_buffer = float(start_buffer)
+        self.length = length
+        self.reward_func = reward_func
+        self.qualities = get_user_qualities(pinned_quality)
+        self.bitrate_table = get_bitrate_table(reward_func).tolist()
+        self.last_bitrate = self.bitrate_table[int(last_quality)]
+        self.top_bitrate = max([self.bitrate_table[q] for q in self.qualities], default=0)
+        self.fastest = [min([download_times[q][p] for q in self.qualities], default=np.inf) for p in range(length)]
+        self.chunk_len = VIDEO_CHUNCK_LEN / MILLISECONDS_IN_SECOND
+        self.best_reward = -np.inf
+        self.candidates = []
+        self.nodes = 0
+
+    def rebuffer_floor(self, position, buffer):
+        rebuffer_time = 0.0
+        for p in range(position, self.length):
+            if buffer < self.fastest[p]:
+                rebuffer_time += self.fastest[p] - buffer
+                buffer = 0.0 + self.chunk_len
+            else:
+                buffer = buffer - self.fastest[p] + self.chunk_len
+        return rebuffer_time
+
+    def get_bound(self, position=0, buffer=None, rebuffer_time=0.0, bitrate_sum=0, smoothness_diffs=0):
+        if buffer is None:
+            buffer = self.start_buffer
+        return calculate_qoe(bitrate_sum + (self.length - position) * self.top_bitrate,
+                             rebuffer_time + self.rebuffer_floor(position, buffer), smoothness_diffs, self.reward_func)
+
+    def search(self, position, buffer, rebuffer_time, bitrate_sum, smoothness_diffs, last_bitrate, sequence):
+        self.nodes += 1
+        if position == self.length:
+            # Same arithmetic as calculate_combo_rewards, so equal sequences give bit-equal rewards
+            reward = calculate_qoe(bitrate_sum, rebuffer_time, smoothness_diffs, self.reward_func)
+            if reward >= self.best_reward - BOUND_TOLERANCE:
+                self.candidates.append((list(sequence), reward))
+                self.best_reward = max(self.best_reward, reward)
+            return
+        if self.get_bound(position, buffer, rebuffer_time, bitrate_sum, smoothness_diffs) \
+                < self.best_reward - BOUND_TOLERANCE:
+            return
+        # Highest quality first, it usually sets a good incumbent early
+        for quality in reversed(self.qualities):
+            download_time = self.download_times[quality][position]
+            if buffer < download_time:
+                next_rebuffer_time = rebuffer_time + (download_time - buffer)
+                next_buffer = 0.0 + self.chunk_len
+            else:
+                next_rebuffer_time = rebuffer_time
+                next_buffer = buffer - download_time + self.chunk_len
+            bitrate = self.bitrate_table[quality]
+            sequence.append(quality)
+            self.search(position + 1, next_buffer, next_rebuffer_time, bitrate_sum + bitrate,
+                        smoothness_diffs + abs(bitrate - last_bitrate), bitrate, sequence)
+            sequence.pop()
+
+    def solve(self):
+        """
+        :return: [(sequence, reward)] within BOUND_TOLERANCE of the best, in itertools.product order
+        """
+        if not self.qualities:
+            return []
+        self.search(0, self.start_buffer, 0.0, 0, 0, self.last_bitrate, [])
+        return sorted([candidate for candidate in self.candidates
+                       if candidate[1] >= self.best_reward - BOUND_TOLERANCE])
+
+
+def get_sequence_reward(download_times, start_buffer, last_quality, sequence, reward_func):
+    # Reward of one user's sequence, with the arithmetic of calculate_combo_rewards
+    bitrate_table = get_bitrate_table(reward_func).tolist()
+    chunk_len = VIDEO_CHUNCK_LEN / MILLISECONDS_IN_SECOND
+    buffer = float(start_buffer)
+    rebuffer_time = 0.0
+    bitrate_sum = 0
+    smoothness_diffs = 0
+    last_bitrate = bitrate_table[int(last_quality)]
+    for position, quality in enumerate(sequence):
+        download_time = download_times[quality][position]
+        if buffer < download_time:
+            rebuffer_time = rebuffer_time + (download_time - buffer)
+            buffer = 0.0 + chunk_len
+        else:
+            buffer = buffer - download_time + chunk_len
+        bitrate = bitrate_table[quality]
+        bitrate_sum = bitrate_sum + bitrate
+        smoothness_diffs = smoothness_diffs + abs(bitrate - last_bitrate)
+        last_bitrate = bitrate
+    return calculate_qoe(bitrate_sum, rebuffer_time, smoothness_diffs, reward_func)
+
+
+def solve_user_dp(download_times, start_buffer, last_quality, length, reward_func, pinned_quality=None,
+                  buffer_step=DP_BUFFER_STEP):
+    """
+    One user's best quality sequence for a fixed bandwidth schedule, by dynamic programming.
+
+    The QoE is a sum of per-chunk terms that only look back at the previous quality and the buffer, so after each
+    position only the best prefix landing in each (quality, buffer bin) state is kept, with its exact buffer. A
+    stage relaxes at most levels x levels x buffer bins moves instead of enumerating levels^length sequences;
+    merging prefixes of nearby buffers is what makes it approximate. Ties go to the higher quality, then the
+    fuller buffer.
+
+    :param download_times: [BITRATE_LEVELS, horizon] seconds to fetch every chunk, see get_download_times
+    :return: the sequence over the first length positions and its exact reward, (None, nan) if no quality is allowed
+    """
+    qualities = get_user_qualities(pinned_quality)
+    if not qualities:
+        return None, np.nan
+    bitrate_table = get_bitrate_table(reward_func)
+    bitrates = bitrate_table[qualities]
+    chunk_len = VIDEO_CHUNCK_LEN / MILLISECONDS_IN_SECOND
+
+    # States of the current position: reward so far, exact buffer and bitrate of the last chunk
+    values = np.zeros(1)
+    buffers = np.array([float(start_buffer)])
+    last_bitrates = bitrate_table[[int(last_quality)]]
+    back_pointers = []
+    for position in range(length):
+        # [states, qualities] moves, each chunk term added with the arithmetic of calculate_qoe
+        download_time = np.asarray([download_times[quality][position] for quality in qualities], dtype=float)
+        rebuffer = buffers[:, None] < download_time[None, :]
+        rebuffer_time = np.where(rebuffer, download_time[None, :] - buffers[:, None], 0.0)
+        next_buffers = np.where(rebuffer, 0.0, buffers[:, None] - download_time[None, :]) + chunk_len
+        moves = values[:, None] + calculate_qoe(bitrates[None, :], rebuffer_time,
+                                                np.abs(bitrates[None, :] - last_bitrates[:, None]), reward_func)
+
+        # Best move into every (quality, buffer bin), moves to -inf (a zero bandwidth) or nan are dropped
+        bins = int(np.nanmax(next_buffers) / buffer_step) + 1
+        keys = np.arange(len(qualities))[None, :] * bins + (next_buffers / buffer_step).astype(int)
+        keys = np.where(np.isfinite(moves), keys, -1).ravel()
+        order = np.lexsort((next_buffers.ravel(), moves.ravel(), keys))
+        order = order[keys[order] >= 0]
+        if not len(order):
+            # Every sequence is at -inf, the full table keeps its last row of the top quality
+            sequence = [qualities[-1]] * length
+            return sequence, get_sequence_reward(download_times, start_buffer, last_quality, sequence, reward_func)
+        winners = order[np.append(keys[order][1:] != keys[order][:-1], True)]
+
+        values = moves.ravel()[winners]
+        buffers = next_buffers.ravel()[winners]
+        last_bitrates = bitrates[winners % len(qualities)]
+        back_pointers.append((winners % len(qualities), winners // len(qualities)))
+
+    sequence = []
+    if length:
+        state = np.lexsort((buffers, last_bitrates, values))[-1]
+        for chosen_qualities, parents in reversed(back_pointers):
+            sequence.append(qualities[chosen_qualities[state]])
+            state = parents[state]
+        sequence.reverse()
+    return sequence, get_sequence_reward(download_times, start_buffer, last_quality, sequence, reward_func)
+
+
+def solve_user_combo(download_times, start_buffer, last_quality, length, reward_func, pinned_quality=None,
+                     dp=False):
+    """
+    One user's best sequence for a fixed bandwidth schedule. Among tied sequences it keeps the one
+    select_best_combo would, the highest first quality and then the last in itertools.product order.
+
+    :return: the sequence over the first length positions and its reward, (None, nan) if no quality is allowed
+    """
+    if dp:
+        return solve_user_dp(download_times, start_buffer, last_quality, length, reward_func, pinned_quality)
+    if not get_user_qualities(pinned_quality):
+        return None, np.nan
+    best_sequence, best_reward = None, -np.inf
+    for sequence, reward in UserComboSearch(download_times, start_buffer, last_quality, length, reward_func,
+                                            pinned_quality).solve():
+        if best_sequence is None or reward > best_reward \
+                or (reward == best_reward and sequence[:1] >= best_sequence[:1]):
+            best_sequence, best_reward = sequence, reward
+    return best_sequence, best_reward
+
+
+def solve_best_combo(chunk_sizes, bws, ho_delays, start_buffers, last_qualities, lengths, reward_func,
+                     pinned_qualities, dp=False):
+    """
+    Combos of one handover plan that can tie for the best mean reward, found by branch and bound.
+
+    Users only share the mean, so each one is searched on its own and only the sequences close to its best are
+    combined. Positions past a user's length take the top quality, as the last tied row of the full table does,
+    so select_best_combo over the result picks what it picks over calculate_combo_rewards on the whole
+    get_chunk_combos table. With dp every user keeps the single sequence of solve_user_dp instead, which is
+    cheaper at long horizons but no longer exact.
+
+    :return: [K, users, horizon] combos in itertools.product order and their [K, users] rewards
+    """
+    num_users, horizon = bws.shape
+    download_times = get_download_times(chunk_sizes, bws, ho_delays)
+    user_candidates = []
+    for user in range(num_users):
+        qualities = get_user_qualities(pinned_qualities[user])
+        if not qualities:
+            return np.zeros((0, num_users, horizon), dtype=int), np.zeros((0, num_users))
+        length = int(lengths[user])
+        if np.isnan(bws[user]).all():
+            user_candidates.append([([qualities[-1]] * horizon, np.nan)])
+            continue
+        if dp:
+            sequence, reward = solve_user_dp(download_times[user].tolist(), start_buffers[user], last_qualities[user],
+                                             length, reward_func, pinned_qualities[user])
+            user_candidates.append([(sequence + [qualities[-1]] * (horizon - length), reward)])
+            continue
+        search = UserComboSearch(download_times[user].tolist(), start_buffers[user], last_qualities[user], length,
+                                 reward_func, pinned_qualities[user])
+        user_candidates.append([(sequence + [qualities[-1]] * (horizon - length), reward)
+                                for sequence, reward in search.solve()])
+
+    rows = list(itertools.product(*user_candidates))
+    combos = np.array([[sequence for sequence, _ in row] for row in rows], dtype=int).reshape(-1, num_users, horizon)
+    rewards = np.array([[reward for _, reward in row] for row in rows], dtype=float).reshape(-1, num_users)
+    return combos, rewards
+
+
+def get_combo_upper_bound(chunk_sizes, bws, ho_delays, start_buffers, last_qualities, lengths, reward_func,
+                          pinned_qualities):
+    """
+    Upper bound on the mean reward solve_best_combo can reach for one handover plan, nan if no user has a bandwidth.
+    """
+    download_times = get_download_times(chunk_sizes, bws, ho_delays)
+    bounds = []
+    for user in range(len(lengths)):
+        if np.isnan(bws[user]).all():
+            continue
+        bounds.append(UserComboSearch(download_times[user].tolist(), start_buffers[user], last_qualities[user],
+                                      int(lengths[user]), reward_func, pinned_qualities[user]).get_bound())
+    return np.mean(bounds) if bounds else np.nan
@@ -0,0 +1,131 @@
+import numpy as np
+
+from util.constants import EPSILON
+
+# Bisection steps for the simplex projection and for the multiplier of the sum-to-one constraint
+PROJECTION_ITERATIONS = 60
+MULTIPLIER_ITERATIONS = 64
+# Width of the log-multiplier bracket below the multiplier that pins every user at the lower bound
+MULTIPLIER_LOG_RANGE = 60.0
+
+
+def get_rebuffer(offsets, scales, ratios):
+    """
+    Rebuffer time of each user at the given ratios.
+
+    With the download time of chunk i being a fixed part plus scales_i / ratio, the buffer recursion
+    of the MPC loops collapses to max(0, max_i(offsets_i + scales_i / ratio)), where offsets_i holds the
+    fixed download time up to chunk i minus the start buffer and the i chunks played meanwhile.
+
+    :param offsets: [..., users, horizon], -inf past each user's last chunk
+    :param scales: [..., users, horizon] cumulative download time at the full bandwidth, 0 past the last chunk
+    :param ratios: [..., users]
+    :return: [..., users]
+    """
+    return np.maximum(0.0, (offsets + scales / ratios[..., None]).max(axis=-1))
+
+
+def get_min_ratios(offsets, scales, lower, upper):
+    """
+    Smallest ratio at which each user's rebuffer time stops improving, clipped to the bounds.
+    """
+    floor = np.maximum(0.0, offsets.max(axis=-1, keepdims=True))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        needed = np.where(scales > 0, scales / (floor - offsets), 0.0)
+    return np.clip(needed.max(axis=-1), lower, upper)
+
+
+def project_ratios(x0, lower, upper):
+    """
+    Euclidean projection of x0 onto {lower <= x <= upper, sum(x) = 1}, row by row.
+    """
+    low = np.full(x0.shape[:-1] + (1,), -1.0)
+    high = np.full(x0.shape[:-1] + (1,), 1.0)
+    for _ in range(PROJECTION_ITERATIONS):
+        mid = (low + high) / 2
+        over = np.clip(x0 + mid, lower, upper).sum(axis=-1, keepdims=True) > 1
+        high = np.where(over, mid, high)
+        low = np.where(over, low, mid)
+    return np.clip(x0 + low, lower, upper)
+
+
+def get_kink_ratios(offsets, scales, lower, upper):
+    """
+    Ratios where a user's rebuffer time is not smooth: pieces crossing each other or crossing zero.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crossings = (scales[..., :, None] - scales[..., None, :]) / (offsets[..., None, :] - offsets[..., :, None])
+        zeros = -scales / offsets
+    kinks = np.concatenate([crossings.reshape(crossings.shape[:-2] + (-1,)), zeros,
+                            np.broadcast_to(np.array([lower, upper]), offsets.shape[:-1] + (2,))], axis=-1)
+    kinks = np.where(np.isfinite(kinks) & (kinks > lower) & (kinks < upper), kinks, lower)
+    return kinks
+
+
+def get_dual_ratios(offsets, scales, kinks, kink_rebuffer, multiplier, lower, upper):
+    """
+    Minimiser of rebuffer(x) + multiplier * x for every user. The function is convex, so the minimum
+    sits on a kink or on the stationary point of one of its pieces.
+    """
+    stationary = np.clip(np.sqrt(scales / multiplier[..., None]), lower, upper)
+    stationary_rebuffer = np.maximum(0.0, (offsets[..., None, :] + scales[..., None, :]
+                                           / stationary[..., :, None]).max(axis=-1))
+    candidates = np.concatenate([kinks, stationary], axis=-1)
+    values = np.concatenate([kink_rebuffer, stationary_rebuffer], axis=-1) + multiplier[..., None] * candidates
+    return np.take_along_axis(candidates, values.argmin(axis=-1)[..., None], axis=-1)[..., 0]
+
+
+def solve_ratios(offsets, scales, x0=None, lower=EPSILON, upper=1 - EPSILON):
+    """
+    Bandwidth split of one satellite that minimises the total rebuffer time of its users, for a batch of
+    problems at once. Every row solves min sum_u get_rebuffer(x)_u s.t. sum(x) = 1, lower <= x <= upper,
+    the problem the ratio-based MPC used to hand to SLSQP one combo at a time.
+
+    When the rebuffer time can reach its floor for every user, the solution set is a box cut by the
+    simplex and x0 is projected onto it, so a feasible warm start is kept as is. Otherwise the sum
+    constraint binds and its multiplier is found by bisection.
+
+    :param offsets: [P, users, horizon] see get_rebuffer
+    :param scales: [P, users, horizon]
+    :param x0: [P, users] warm start, equal split when None
+    :return: [P, users] ratios
+    """
+    num_problems, num_users = offsets.shape[:2]
+    if x0 is None:
+        x0 = np.full((num_problems, num_users), 1 / num_users)
+    x0 = np.asarray(x0, dtype=float)
+    if num_users * lower > 1 or num_users * upper < 1:
+        # No feasible split, SLSQP gives up at its starting point as well
+        return x0.copy()
+
+    min_ratios = get_min_ratios(offsets, scales, lower, upper)
+    ratios = x0.copy()
+    flat = min_ratios.sum(axis=-1) <= 1
+    if flat.any():
+        ratios[flat] = project_ratios(x0[flat], min_ratios[flat], upper)
+    if flat.all():
+        return ratios
+
+    offsets, scales = offsets[~flat], scales[~flat]
+    kinks = get_kink_ratios(offsets, scales, lower, upper)
+    kink_rebuffer = np.maximum(0.0, (offsets[..., None, :] + scales[..., None, :] / kinks[..., :, None]).max(axis=-1))
+
+    # At this multiplier every user sits on the lower bound, which sums below one
+    high = np.log(scales.max(axis=(-2, -1)) / lower ** 2 + 1)
+    low = high - MULTIPLIER_LOG_RANGE
+    for _ in range(MULTIPLIER_ITERATIONS):
+        mid = (low + high) / 2
+        multiplier = np.broadcast_to(np.exp(mid)[:, None], offsets.shape[:2])
+        over = get_dual_ratios(offsets, scales, kinks, kink_rebuffer, multiplier, lower, upper).sum(axis=-1) > 1
+        low = np.where(over, mid, low)
+        high = np.where(over, high, mid)
+    multiplier = np.broadcast_to(np.exp(high)[:, None], offsets.shape[:2])
+    solved = get_dual_ratios(offsets, scales, kinks, kink_rebuffer, multiplier, lower, upper)
+
+    # Hand the bisection residual to the users with room left below the upper bound
+    room = upper - solved
+    residual = 1 - solved.sum(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        share = np.where(room.sum(axis=-1, keepdims=True) > 0, room / room.sum(axis=-1, keepdims=True), 1 / num_users)
+    ratios[~flat] = np.clip(solved + residual * share, lower, upper)
+    return ratios
@@ -0,0 +1,51 @@
+import numpy as np
+
+# [sat, time] matrices are built once per trace dict and shared by every environment using it
+TRACE_MATRICES = {}
+
+
+def get_trace_matrix(cooked_bw):
+    """
+    Return (sat_ids, sat_rows, bw_matrix, up_time_matrix) for a trace dict of sat_id -> bandwidth list.
+
+    up_time_matrix[row, t] is the number of consecutive non-zero steps of the satellite ending at t.
+    """
+    key = id(cooked_bw)
+    if key not in TRACE_MATRICES or TRACE_MATRICES[key][0] is not cooked_bw:
+        sat_ids = list(cooked_bw.keys())
+        sat_rows = {sat_id: row for row, sat_id in enumerate(sat_ids)}
+        bw_matrix = np.array([cooked_bw[sat_id] for sat_id in sat_ids], dtype=float)
+
+        index = np.arange(bw_matrix.shape[1])
+        last_zero = np.maximum.accumulate(np.where(bw_matrix == 0, index, -1), axis=1)
+        up_time_matrix = index - last_zero
+
+        TRACE_MATRICES[key] = (cooked_bw, sat_ids, sat_rows, bw_matrix, up_time_matrix)
+    return TRACE_MATRICES[key][1:]
+
+
+def get_up_time(up_time_matrix, row, mahimahi_ptr):
+    # Steps the satellite has been visible for right before mahimahi_ptr
+    if mahimahi_ptr < 1:
+        return 0
+    return int(up_time_matrix[row, mahimahi_ptr - 1])
+
+
+def get_bw_windows(bw_matrix, rows, start, end, divisors, filter_rows=None):
+    """
+    Shared-bandwidth windows over the trace steps [start, end) for several satellites at once.
+
+    :param rows: trace matrix rows to read the bandwidth from
+    :param divisors: per-row number of users the bandwidth is shared by, 0 keeps the raw bandwidth
+    :param filter_rows: per-row satellite whose zero-bandwidth steps are dropped, None keeps every step
+    :return: one list of floats per row
+    """
+    start = max(start, 0)
+    end = max(end, start)
+    window = bw_matrix[rows, start:end]
+    divisors = np.asarray(divisors, dtype=float)
+    shared = window / np.where(divisors == 0, 1, divisors)[:, None]
+    if filter_rows is None:
+        return shared.tolist()
+    keep = bw_matrix[filter_rows, start:end] != 0
+    return [shared[i][keep[i]].tolist() for i in range(len(shared))]